@@ -1,217 +1,2962 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, get_flashed_messages, send_file, session
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, flash, get_flashed_messages, send_file, session, g, jsonify, make_response, Response, stream_with_context, abort, has_app_context, has_request_context, before_render_template, template_rendered
+from datetime import date, datetime, timezone
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import Headers
+from werkzeug.http import is_resource_modified, parse_accept_header
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import ClosingIterator
 from functools import wraps
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+import numpy as np
+from urllib.parse import urlencode
+import base64
+import click
+import glob
+import gzip
+import hashlib
+import csv
+import io
+import json
+import mimetypes
 import sqlite3
 import os
+import queue
 import re
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import zlib
 
 
 app = Flask(__name__)
-DB_FILE = 'expenses.db'
-app.secret_key = 'your_secret_key_here'
 
-# 初始化資料庫
-def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
-        c = conn.cursor()
+# Defaults; create_app() overrides them from ACCOUNTING_* environment variables
+app.config.update(
+    SECRET_KEY='your_secret_key_here',
+    DATABASE=os.environ.get('EXPENSES_DB', 'expenses.db'),
+
+    # Compiled templates are cached here across restarts (None disables it)
+    JINJA_CACHE_DIR='.jinja_cache',
+
+    # Content-hashed, precompressed copies of static/ are written here at start-up
+    # (or by `flask build-assets`) and served with immutable caching (None disables it)
+    ASSET_DIR='.assets',
+    ASSET_MAX_AGE=365 * 24 * 3600,
+
+    # Compress HTML / JSON / CSV responses of at least COMPRESS_MIN_SIZE bytes with zstd
+    # (Python 3.14+) or gzip, whichever the client accepts; streamed responses are
+    # compressed chunk by chunk and still flushed as they are generated
+    COMPRESS=True,
+    COMPRESS_MIN_SIZE=1024,
+    COMPRESS_LEVEL=6,                   # gzip 1-9
+    COMPRESS_ZSTD_LEVEL=3,
+    COMPRESS_MIMETYPES=(
+        'text/html', 'text/css', 'text/csv', 'text/plain', 'text/javascript',
+        'application/json', 'application/x-ndjson', 'application/javascript', 'image/svg+xml'
+    ),
+
+    # SQLite tuning, applied to every connection we open
+    SQLITE_SYNCHRONOUS='NORMAL',        # safe with WAL, one fsync per checkpoint
+    SQLITE_CACHE_SIZE=-16000,           # negative = KiB of page cache per connection
+    SQLITE_MMAP_SIZE=64 * 1024 * 1024,
+    SQLITE_BUSY_TIMEOUT=5000,           # ms to wait for a lock before "database is locked"
+    SQLITE_POOL_SIZE=4,                 # idle connections kept per database file
+    SQLITE_POOL_MAX_IDLE=32,            # idle connections across all files; least recently used close first
+
+    # When set, each user's trips and expenses live in SHARD_DIR/user_<id>.db
+    # (users stay in DB_FILE), so different users never wait on one write lock
+    SHARD_DIR=None,
+
+    # Opt-in: send expense writes through one writer thread per worker that commits
+    # them in groups, waiting up to WRITE_GROUP_WINDOW_MS for more writes to join a group
+    WRITE_QUEUE=False,
+    WRITE_GROUP_WINDOW_MS=2,
+    WRITE_GROUP_MAX=64,
+    WRITE_TIMEOUT=30,                   # seconds a request waits for its write to commit
+    WRITE_QUEUE_SYNCHRONOUS='FULL',     # the writer fsyncs each group's COMMIT before acknowledging it
+
+    # Lookup tables are cached per worker; when shared, workers re-check the
+    # DB version stamp at most every REFERENCE_CACHE_CHECK_SECONDS
+    REFERENCE_CACHE_SHARED=False,
+    REFERENCE_CACHE_CHECK_SECONDS=5,
+
+    # Expense lists render one page and fetch the rest from the JSON API
+    EXPENSES_PAGE_SIZE=50,
+    EXPENSES_PAGE_MAX=200,
+
+    # Rows fetched per fetchmany() call while streaming an export
+    EXPORT_BATCH_SIZE=1000,
+
+    # `flask snapshot` writes here and keeps the newest BACKUP_KEEP files
+    BACKUP_DIR='backups',
+    BACKUP_KEEP=14,
+
+    # Statements slower than this (ms) are logged with their SQL
+    SLOW_QUERY_MS=100,
+    # When set, /metrics requires "Authorization: Bearer <token>"
+    METRICS_TOKEN=None,
+
+    # Re-pricing expenses after a rate change: rows per transaction, pause between
+    # batches, and how often each worker's background thread looks for queued jobs
+    RECOMPUTE_BATCH_SIZE=2000,
+    RECOMPUTE_STEP_SLEEP=0.01,
+    RECOMPUTE_POLL_SECONDS=5,
+    RECOMPUTE_WORKER=True,
+
+    # In-process LRU of rendered expense lists and their query results (0 disables it)
+    FRAGMENT_CACHE_BYTES=8 * 1024 * 1024,
+
+    # /search results per request (default / upper bound)
+    SEARCH_LIMIT=20,
+    SEARCH_LIMIT_MAX=100,
+
+    # Password hashes use Werkzeug's full method string; stored hashes made with other
+    # parameters are upgraded the next time their user logs in
+    PASSWORD_HASH_METHOD='scrypt:32768:8:1',
+    PASSWORD_SALT_LENGTH=16,
+    PASSWORD_HASH_WORKERS=4,            # threads hashing passwords per worker process
+    PASSWORD_HASH_QUEUE=16,             # hashes allowed to wait for a thread before logins get 503
+
+    # Login attempts per client address: bursts of LOGIN_RATE_BURST, refilled at
+    # LOGIN_RATE_PER_MINUTE; further attempts get 429 before any hashing
+    LOGIN_RATE_BURST=10,
+    LOGIN_RATE_PER_MINUTE=10,
+
+    # Reverse proxies in front of the app; their X-Forwarded-For / -Proto set the client
+    # address (which the login limiter keys on). Leave at 0 when clients connect directly.
+    PROXY_FIX_X_FOR=0,
+
+    # Budgets warn once their spending reaches this share of the amount
+    BUDGET_WARN_RATIO=0.8
+)
+DB_FILE = app.config['DATABASE']
+
+# Tables held by the reference-data cache
+REFERENCE_TABLES = ('categories', 'paymentMethods', 'currencies', 'countries')
+
+
+# In-process metrics, exposed in Prometheus text format at /metrics
+class Metrics:
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500)
+    GROUP_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+    # name -> (type, help)
+    DESCRIPTIONS = {
+        'accounting_requests_total': ('counter', 'Requests handled, by route, method and status.'),
+        'accounting_request_duration_seconds': ('histogram', 'Request latency by route.'),
+        'accounting_request_queries': ('histogram', 'SQL statements per request by route.'),
+        'accounting_sql_seconds_total': ('counter', 'Time spent executing and fetching SQL, by route.'),
+        'accounting_template_render_seconds_total': ('counter', 'Time spent rendering templates, by route.'),
+        'accounting_slow_queries_total': ('counter', 'Statements slower than SLOW_QUERY_MS.'),
+        'accounting_db_pool': ('gauge', 'Connection pool counters for this worker.'),
+        'accounting_fragment_cache': ('gauge', 'Fragment / query-result cache size and hit, miss and eviction counts.'),
+        'accounting_write_group_size': ('histogram', 'Writes committed together by the write queue.'),
+        'accounting_write_queue': ('gauge', 'Write queue depth and commit counters for this worker.'),
+        'accounting_login_throttled_total': ('counter', 'Login attempts rejected by the rate limiter.'),
+        'accounting_password_rehash_total': ('counter', 'Password hashes upgraded to PASSWORD_HASH_METHOD on login.'),
+        'accounting_response_bytes_total': ('counter', 'Response body bytes before compression, by route and encoding.'),
+        'accounting_compressed_bytes_total': ('counter', 'Response body bytes sent after compression, by route and encoding.')
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def observe(self, name, labels, value, buckets):
+        with self.lock:
+            hist = self.histograms.get((name, labels))
+            if hist is None:
+                hist = self.histograms[(name, labels)] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist['counts'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    # Collectors return [(name, labels, value)] gauges at scrape time
+    def add_collector(self, fn):
+        self.collectors.append(fn)
+
+    def render(self):
+        lines = []
+        samples = defaultdict(list)
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                samples[name].append(f'{name}{format_labels(labels)} {value:g}')
+
+            for (name, labels), hist in sorted(self.histograms.items(), key=lambda item: item[0]):
+                for bound, count in zip(hist['buckets'], hist['counts']):
+                    samples[name].append(f'{name}_bucket{format_labels(labels + (("le", f"{bound:g}"),))} {count}')
+                samples[name].append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {hist["count"]}')
+                samples[name].append(f'{name}_sum{format_labels(labels)} {hist["sum"]:g}')
+                samples[name].append(f'{name}_count{format_labels(labels)} {hist["count"]}')
+
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                samples[name].append(f'{name}{format_labels(labels)} {value:g}')
+
+        for name in sorted(samples):
+            kind, help_text = self.DESCRIPTIONS.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples[name])
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+metrics = Metrics()
+
+
+# Adds a statement's time to the current request and logs it when slow
+def record_sql(statement, elapsed, executed=True):
+    if has_app_context():
+        if executed:
+            g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_time = g.get('sql_time', 0.0) + elapsed
+
+    if executed and elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        metrics.inc('accounting_slow_queries_total')
+        app.logger.warning('Slow query (%.1f ms): %s', elapsed * 1000, ' '.join(str(statement).split()))
+
+
+# Cursor that times execute*() and fetch*() calls
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            record_sql(None, time.perf_counter() - started, executed=False)
+
+    def fetchmany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            record_sql(None, time.perf_counter() - started, executed=False)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            record_sql(None, time.perf_counter() - started, executed=False)
+
+
+# Connection whose cursors (including those behind conn.execute) are instrumented
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+
+# Open a connection with WAL, foreign keys and the configured pragmas
+def connect_db(path=None):
+    path = path or DB_FILE
+    conn = sqlite3.connect(path, check_same_thread=False, factory=InstrumentedConnection)
+    conn.db_path = path
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA cache_size = {int(app.config['SQLITE_CACHE_SIZE'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+# Keeps warm connections around so requests reuse their page cache. Idle connections
+# are kept per database file; past max_idle, the least recently used file's close first.
+class ConnectionPool:
+    def __init__(self, size, max_idle):
+        self.size = size
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.idle = OrderedDict()
+        self.idle_count = 0
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.evicted = 0
+
+    def acquire(self, path=None):
+        path = path or DB_FILE
+        with self.lock:
+            # Connections must not cross a fork (gunicorn --preload)
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.idle = OrderedDict()
+                self.idle_count = 0
+                self.in_use = 0
+
+            self.in_use += 1
+            conns = self.idle.get(path)
+            if conns:
+                self.idle.move_to_end(path)
+                self.idle_count -= 1
+                self.reused += 1
+                conn = conns.pop()
+                if not conns:
+                    del self.idle[path]
+                return conn
+            self.created += 1
+
+        try:
+            return connect_db(path)
+        except sqlite3.Error:
+            with self.lock:
+                self.in_use -= 1
+            raise
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+
+        closing = []
+        with self.lock:
+            self.in_use = max(self.in_use - 1, 0)
+            conns = self.idle.setdefault(conn.db_path, [])
+            self.idle.move_to_end(conn.db_path)
+
+            if self.closed or len(conns) >= self.size:
+                self.discarded += 1
+                closing.append(conn)
+            else:
+                conns.append(conn)
+                self.idle_count += 1
+
+                while self.idle_count > self.max_idle:
+                    path, oldest = next(iter(self.idle.items()))
+                    closing.append(oldest.pop(0))
+                    self.idle_count -= 1
+                    self.evicted += 1
+                    if not oldest:
+                        del self.idle[path]
+
+        for old in closing:
+            old.close()
+
+    # Close the idle connections; ones still in use are closed when they come back
+    def close(self):
+        with self.lock:
+            self.closed = True
+            closing = [conn for conns in self.idle.values() for conn in conns]
+            self.idle = OrderedDict()
+            self.idle_count = 0
+
+        for conn in closing:
+            conn.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pid': self.pid,
+                'size': self.size,
+                'max_idle': self.max_idle,
+                'files': len(self.idle),
+                'idle': self.idle_count,
+                'in_use': self.in_use,
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'evicted': self.evicted
+            }
+
+
+db_pool = ConnectionPool(app.config['SQLITE_POOL_SIZE'], app.config['SQLITE_POOL_MAX_IDLE'])
+
+
+# Database file of a user in sharded mode
+def user_db_path(user_id):
+    return os.path.join(app.config['SHARD_DIR'], f'user_{int(user_id)}.db')
+
+
+# The signed-in user's database file (DB_FILE unless SHARD_DIR is set)
+def current_db_path():
+    if app.config['SHARD_DIR'] and has_request_context() and 'user_id' in session:
+        path = user_db_path(session['user_id'])
+        ensure_db(path)
+        return path
+    return DB_FILE
+
+
+# Every database file this deployment uses: DB_FILE plus one per user when sharded
+def database_paths():
+    paths = [DB_FILE]
+    if app.config['SHARD_DIR']:
+        paths += sorted(glob.glob(os.path.join(app.config['SHARD_DIR'], 'user_*.db')))
+    return paths
+
+
+# The request's connection to path (default: the signed-in user's database);
+# all of them go back to the pool when the app context ends
+def get_db(path=None):
+    path = path or current_db_path()
+    dbs = g.setdefault('dbs', {})
+    if path not in dbs:
+        dbs[path] = db_pool.acquire(path)
+    return dbs[path]
+
+
+@app.teardown_appcontext
+def release_db(exception):
+    for conn in g.pop('dbs', {}).values():
+        db_pool.release(conn)
+
+
+# Per-request timing: latency, SQL statements and time, template render time
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.render_time = 0.0
+
+
+@app.before_request
+def start_recompute_worker():
+    if app.config['RECOMPUTE_WORKER']:
+        recompute_worker.ensure_started()
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        g.render_time = g.get('render_time', 0.0) + time.perf_counter() - started
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (('route', route),)
+    # Read by CompressionMiddleware, which runs after the request context is gone
+    request.environ['accounting.route'] = route
+
+    metrics.inc('accounting_requests_total', labels + (('method', request.method), ('status', str(response.status_code))))
+    metrics.observe('accounting_request_duration_seconds', labels, time.perf_counter() - started, Metrics.LATENCY_BUCKETS)
+    metrics.observe('accounting_request_queries', labels, g.get('sql_count', 0), Metrics.QUERY_BUCKETS)
+    metrics.inc('accounting_sql_seconds_total', labels, g.get('sql_time', 0.0))
+    metrics.inc('accounting_template_render_seconds_total', labels, g.get('render_time', 0.0))
+    return response
+
+
+metrics.add_collector(lambda: [
+    ('accounting_db_pool', (('stat', key),), value)
+    for key, value in db_pool.stats().items() if key != 'pid'
+])
+metrics.add_collector(lambda: [
+    ('accounting_fragment_cache', (('stat', key),), value)
+    for key, value in fragment_cache.stats().items()
+])
+metrics.add_collector(lambda: [
+    ('accounting_write_queue', (('stat', key),), value)
+    for key, value in write_queue.stats().items()
+])
+
+
+# Migration 1: the original schema and its reference data
+def migrate_base_schema(c):
+    # users table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT UNIQUE,
+            password_hash TEXT
+        )
+    ''')
+    
+    # trips table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS trips (
+            id INTEGER PRIMARY KEY,
+            trip_name TEXT UNIQUE,
+            start_date TEXT,
+            end_date TEXT,
+            
+            country_id INTEGER,
+            FOREIGN KEY(country_id) REFERENCES countries(id)
+        )
+    ''')
+
+    # countries table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS countries (
+            id INTEGER PRIMARY KEY,
+            country_name TEXT UNIQUE,
+            country_code TEXT UNIQUE
+        )
+    ''') 
+    
+    countries = [
+        ('Taiwan', 'TW'),
+        ('Japan', 'JP'),
+        ('South Korea', 'KR'),
+        ('Vietnam', 'VN'),
+        ('United States', 'US'),
+        ('United Kindom', 'GB')
+    ]
+    
+    c.executemany(
+        'INSERT OR IGNORE INTO countries (country_name, country_code) VALUES (?, ?)',
+        countries
+    )        
+            
+    # paymentMethods table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS paymentMethods (
+            id INTEGER PRIMARY KEY,
+            method_name TEXT UNIQUE
+        )
+    ''')
+    
+    # insert paymentMethods
+    default_paymentMethods = [
+        (1, 'card'),
+        (2, 'cash')
+    ]
+    
+    for method in default_paymentMethods:
+        c.execute('INSERT OR IGNORE INTO paymentMethods (id, method_name) VALUES (?, ?)', method)
+
+    # categories table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY,
+            cat_name TEXT UNIQUE,
+            order_index INTEGER
+        )
+    ''')
+    
+    # insert categories
+    default_categories = [
+        ('meals', 1),
+        ('activities', 2),
+        ('transportation', 3),
+        ('accommodation', 4),
+        ('others', 5)
+    ]
+
+    for cat_name, order_index in default_categories:
+        c.execute(
+            'INSERT OR IGNORE INTO categories (cat_name, order_index) VALUES (?, ?)',
+            (cat_name, order_index)
+        )
+
+    # currencies table
+    c.execute('''CREATE TABLE IF NOT EXISTS currencies (
+                 id INTEGER PRIMARY KEY, 
+                 code TEXT UNIQUE, 
+                 currency_name TEXT,
+                 symbol TEXT,
+                 is_base INTEGER DEFAULT 0
+                )
+            ''')
+            
+    default_currencies = [
+        ('NTD', 'New Taiwanese Dollar', '$'),
+        ('JPY', 'Japanese Yen', '¥'),
+        ('KRW', 'Korean Won', '₩'),
+        ('VND', 'Vietnamese Dong', '₫'),
+        ('USD', 'US Dollar', '$'),
+        ('EUR', 'Euro', '€'),
+        ('GBP', 'British Pound', '£')
+    ]
+
+    for code, currency_name, symbol in default_currencies:
+        c.execute(
+            'INSERT OR IGNORE INTO currencies (code, currency_name, symbol) VALUES (?, ?, ?)',
+            (code, currency_name, symbol)
+        )
         
-        # users table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                username TEXT UNIQUE,
-                password_hash TEXT
+    # Exchange_rates table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS exchange_rates (
+            id INTEGER PRIMARY KEY,
+            currency_id INTEGER UNIQUE,
+            rate_to_base REAL NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(currency_id) REFERENCES currencies(id)
+        )
+    ''')
+
+    default_exchange_rates = [
+        ('NTD', 1.0),
+        ('JPY', 0.2004),
+        ('KRW', 0.02114),
+        ('VND', 0.001187),
+        ('USD', 31.215),
+        ('EUR', 36.617),
+        ('GBP', 41.761)
+    ]
+
+    for code, rate in default_exchange_rates:
+        c.execute('SELECT id FROM currencies WHERE code = ?', (code,))
+        row = c.fetchone()
+        if row:
+            currency_id = row[0]
+            updated_at = datetime.now().isoformat()
+            c.execute('INSERT OR IGNORE INTO exchange_rates (currency_id, rate_to_base, updated_at)VALUES (?, ?, ?)', 
+                (currency_id, rate, updated_at)
             )
+    
+    # expenses table
+    c.execute('''CREATE TABLE IF NOT EXISTS expenses (
+                 id INTEGER PRIMARY KEY, 
+                 purchase_date TEXT,
+                 item TEXT, 
+                 amount REAL,
+                 
+                 currency_id INTEGER,
+                 method_id INTEGER, 
+                 category_id INTEGER,
+                 trip_id INTEGER,
+              
+                 FOREIGN KEY(currency_id) REFERENCES currencies(id),
+                 FOREIGN KEY(method_id) REFERENCES paymentMethods(id),
+                 FOREIGN KEY(category_id) REFERENCES categories(id),
+                 FOREIGN KEY(trip_id) REFERENCES trips(id)
+                )
+            ''')
+
+    # trip_totals table (running total per trip, kept by the write routes)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS trip_totals (
+            trip_id INTEGER PRIMARY KEY,
+            total_in_base REAL NOT NULL DEFAULT 0,
+            expense_count INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(trip_id) REFERENCES trips(id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Backfill totals for trips that don't have a row yet
+    c.execute('''
+        INSERT OR IGNORE INTO trip_totals (trip_id, total_in_base, expense_count)
+        SELECT e.trip_id, SUM(e.amount * r.rate_to_base), COUNT(*)
+        FROM expenses e
+        JOIN exchange_rates r ON e.currency_id = r.currency_id
+        GROUP BY e.trip_id
+    ''')
+
+
+# Migration 2: indexes for the per-trip queries
+def migrate_expense_indexes(c):
+    # newExpense / viewExpense: WHERE trip_id = ? ORDER BY / filter on purchase_date
+    c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_trip_date ON expenses (trip_id, purchase_date)')
+
+    # viewExpense category and payment method filters
+    c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_trip_category ON expenses (trip_id, category_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_trip_method ON expenses (trip_id, method_id)')
+
+    # set_exchange_rate: which trips use a currency
+    c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_currency_trip ON expenses (currency_id, trip_id)')
+
+
+# Migration 3: version stamp bumped by any write to the lookup tables
+def migrate_reference_version(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('reference_version', 1)")
+
+    for table in REFERENCE_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE app_meta SET value = value + 1 WHERE key = 'reference_version';
+                END
+            ''')
+
+
+# Rates before this date never existed; the rates seeded here cover every older expense
+RATE_HISTORY_START = '0001-01-01'
+
+
+# Migration 4: rates over time, so expenses convert at the rate of their purchase date
+def migrate_rate_history(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS exchange_rate_history (
+            id INTEGER PRIMARY KEY,
+            currency_id INTEGER NOT NULL,
+            effective_date TEXT NOT NULL,
+            rate_to_base REAL NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(currency_id) REFERENCES currencies(id)
+        )
+    ''')
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_rate_history_currency_date
+        ON exchange_rate_history (currency_id, effective_date)
+    ''')
+
+    # Today's rates have applied to everything recorded so far
+    c.execute('''
+        INSERT OR IGNORE INTO exchange_rate_history (currency_id, effective_date, rate_to_base, created_at)
+        SELECT currency_id, ?, rate_to_base, updated_at FROM exchange_rates
+    ''', (RATE_HISTORY_START,))
+
+    c.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('rate_version', 1)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_exchange_rate_history_{event.lower()}_version
+            AFTER {event} ON exchange_rate_history
+            BEGIN
+                UPDATE app_meta SET value = value + 1 WHERE key = 'rate_version';
+            END
         ''')
-        
-        # trips table
+
+
+# Migration 5: each expense stores its base-currency amount, priced when written
+def migrate_base_amount(c):
+    c.execute('ALTER TABLE expenses ADD COLUMN base_amount REAL')
+
+    # Priced in SQL with the same rule as RateTable: the latest rate in effect on the
+    # purchase date, or the earliest one for dates before it (migrations use no app code)
+    c.execute('''
+        UPDATE expenses AS e SET base_amount = e.amount * COALESCE(
+            (SELECT h.rate_to_base FROM exchange_rate_history h
+             WHERE h.currency_id = e.currency_id AND h.effective_date <= e.purchase_date
+             ORDER BY h.effective_date DESC LIMIT 1),
+            (SELECT h.rate_to_base FROM exchange_rate_history h
+             WHERE h.currency_id = e.currency_id
+             ORDER BY h.effective_date LIMIT 1)
+        )
+    ''')
+
+    # Trip totals read only (trip_id, base_amount)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_trip_base ON expenses (trip_id, base_amount)')
+    # Re-pricing walks one currency from a date on
+    c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_currency_date ON expenses (currency_id, purchase_date)')
+
+    # Queued re-pricing after a rate change; cursor_* is the (purchase_date, id) already done
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS base_recompute_jobs (
+            id INTEGER PRIMARY KEY,
+            currency_id INTEGER NOT NULL,
+            cursor_date TEXT NOT NULL,
+            cursor_id INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(currency_id) REFERENCES currencies(id)
+        )
+    ''')
+
+
+# Migration 6: per (trip, day, category, method) counts and base totals, kept by triggers
+def migrate_expense_rollups(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS expense_rollups (
+            trip_id INTEGER NOT NULL,
+            purchase_date TEXT NOT NULL,
+            category_id INTEGER NOT NULL,
+            method_id INTEGER NOT NULL,
+            expense_count INTEGER NOT NULL DEFAULT 0,
+            base_total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (trip_id, purchase_date, category_id, method_id)
+        ) WITHOUT ROWID
+    ''')
+
+    c.execute('''
+        INSERT OR IGNORE INTO expense_rollups
+            (trip_id, purchase_date, category_id, method_id, expense_count, base_total)
+        SELECT trip_id, COALESCE(purchase_date, ''), COALESCE(category_id, 0), COALESCE(method_id, 0),
+               COUNT(*), COALESCE(SUM(base_amount), 0)
+        FROM expenses
+        GROUP BY 1, 2, 3, 4
+    ''')
+
+    # Statements shared by the triggers; NEW / OLD select the row being added or removed
+    add = '''
+        INSERT INTO expense_rollups (trip_id, purchase_date, category_id, method_id, expense_count, base_total)
+        VALUES (NEW.trip_id, COALESCE(NEW.purchase_date, ''), COALESCE(NEW.category_id, 0),
+                COALESCE(NEW.method_id, 0), 1, COALESCE(NEW.base_amount, 0))
+        ON CONFLICT (trip_id, purchase_date, category_id, method_id) DO UPDATE SET
+            expense_count = expense_count + 1,
+            base_total = base_total + excluded.base_total;
+    '''
+    remove = '''
+        UPDATE expense_rollups
+        SET expense_count = expense_count - 1,
+            base_total = base_total - COALESCE(OLD.base_amount, 0)
+        WHERE trip_id = OLD.trip_id AND purchase_date = COALESCE(OLD.purchase_date, '')
+          AND category_id = COALESCE(OLD.category_id, 0) AND method_id = COALESCE(OLD.method_id, 0);
+        DELETE FROM expense_rollups
+        WHERE trip_id = OLD.trip_id AND purchase_date = COALESCE(OLD.purchase_date, '')
+          AND category_id = COALESCE(OLD.category_id, 0) AND method_id = COALESCE(OLD.method_id, 0)
+          AND expense_count <= 0;
+    '''
+
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_insert_rollup
+        AFTER INSERT ON expenses
+        BEGIN {add} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_delete_rollup
+        AFTER DELETE ON expenses
+        BEGIN {remove} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_update_rollup
+        AFTER UPDATE OF trip_id, purchase_date, category_id, method_id, base_amount ON expenses
+        BEGIN {remove} {add} END
+    ''')
+
+
+# Migration 7: data versions for conditional GETs. Scopes: 'global' (any trip or
+# expense write), 'trips' (the trip list itself) and 'trip:<id>' (one trip and its expenses)
+def migrate_data_versions(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        INSERT OR IGNORE INTO data_versions (scope, version, updated_at)
+        VALUES ('global', 1, CAST(strftime('%s', 'now') AS INTEGER)),
+               ('trips', 1, CAST(strftime('%s', 'now') AS INTEGER))
+    ''')
+
+    def bump(scope):
+        return f'''
+            INSERT INTO data_versions (scope, version, updated_at)
+            VALUES ({scope}, 1, CAST(strftime('%s', 'now') AS INTEGER))
+            ON CONFLICT (scope) DO UPDATE SET
+                version = version + 1,
+                updated_at = excluded.updated_at;
+        '''
+
+    for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_trips_{event.lower()}_data_version
+            AFTER {event} ON trips
+            BEGIN
+                {bump("'global'")}
+                {bump("'trips'")}
+                {bump(f"'trip:' || {row}.id")}
+            END
+        ''')
+
+    for event, rows in (('INSERT', ('NEW',)), ('UPDATE', ('OLD', 'NEW')), ('DELETE', ('OLD',))):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_expenses_{event.lower()}_data_version
+            AFTER {event} ON expenses
+            BEGIN
+                {bump("'global'")}
+                {''.join(bump(f"'trip:' || {row}.trip_id") for row in rows)}
+            END
+        ''')
+
+
+# Migration 8: full-text index over expense items. It indexes a view that adds each
+# expense's trip as a 'trip<id>' token, so a trip filter is part of the FTS match.
+def migrate_expenses_fts(c):
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS expenses_fts_source AS
+        SELECT id, item, 'trip' || trip_id AS trip FROM expenses
+    ''')
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(
+            item,
+            trip,
+            content='expenses_fts_source',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    c.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_insert_fts
+        AFTER INSERT ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (rowid, item, trip) VALUES (NEW.id, NEW.item, 'trip' || NEW.trip_id);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_delete_fts
+        AFTER DELETE ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, item, trip)
+            VALUES ('delete', OLD.id, OLD.item, 'trip' || OLD.trip_id);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_update_fts
+        AFTER UPDATE OF item, trip_id ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, item, trip)
+            VALUES ('delete', OLD.id, OLD.item, 'trip' || OLD.trip_id);
+            INSERT INTO expenses_fts (rowid, item, trip) VALUES (NEW.id, NEW.item, 'trip' || NEW.trip_id);
+        END
+    ''')
+
+
+# Migration 9: per-trip (category_id NULL) and per-category budgets. spent is a running
+# base-currency total kept by triggers, so a write adjusts it instead of re-summing the trip.
+def migrate_budgets(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS budgets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER NOT NULL,
+            category_id INTEGER,
+            amount REAL NOT NULL CHECK (amount > 0),
+            spent REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (trip_id) REFERENCES trips(id) ON DELETE CASCADE,
+            FOREIGN KEY (category_id) REFERENCES categories(id)
+        )
+    ''')
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_budgets_trip_category
+        ON budgets (trip_id, COALESCE(category_id, 0))
+    ''')
+
+    # A trip's budgets are the trip-wide row plus the row for the expense's category
+    add = '''
+        UPDATE budgets SET spent = spent + COALESCE(NEW.base_amount, 0)
+        WHERE trip_id = NEW.trip_id AND (category_id IS NULL OR category_id = NEW.category_id);
+    '''
+    remove = '''
+        UPDATE budgets SET spent = spent - COALESCE(OLD.base_amount, 0)
+        WHERE trip_id = OLD.trip_id AND (category_id IS NULL OR category_id = OLD.category_id);
+    '''
+
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_insert_budget
+        AFTER INSERT ON expenses
+        BEGIN {add} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_delete_budget
+        AFTER DELETE ON expenses
+        BEGIN {remove} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_expenses_update_budget
+        AFTER UPDATE OF trip_id, category_id, base_amount ON expenses
+        BEGIN {remove} {add} END
+    ''')
+
+
+# Applied in order; PRAGMA user_version stores how many have run
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_expense_indexes,
+    migrate_reference_version,
+    migrate_rate_history,
+    migrate_base_amount,
+    migrate_expense_rollups,
+    migrate_data_versions,
+    migrate_expenses_fts,
+    migrate_budgets
+]
+
+
+# 初始化資料庫 (runs every migration the database hasn't seen yet)
+def init_db(path=None):
+    conn = connect_db(path)
+    try:
+        c = conn.cursor()
+        c.execute('PRAGMA user_version')
+        if c.fetchone()[0] >= len(MIGRATIONS):
+            return
+
+        # Take the write lock first so workers starting together don't race
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('PRAGMA user_version')
+        current = c.fetchone()[0]
+
+        for version in range(current + 1, len(MIGRATIONS) + 1):
+            MIGRATIONS[version - 1](c)
+            c.execute(f'PRAGMA user_version = {version}')
+            app.logger.info('Applied migration %d (%s)', version, MIGRATIONS[version - 1].__name__)
+
+        conn.commit()
+        c.execute('PRAGMA optimize')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+initialized_dbs = set()
+initialized_lock = threading.Lock()
+
+
+# Bring a database file up to date once per process (creates a user's file on first use)
+def ensure_db(path):
+    if path in initialized_dbs:
+        return
+    with initialized_lock:
+        if path not in initialized_dbs:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            created = path != DB_FILE and not os.path.exists(path)
+            init_db(path)
+            if created:
+                copy_exchange_rates(path)
+            initialized_dbs.add(path)
+
+
+# A new shard only has the seeded rates; copy in the ones set-rate has recorded since
+# (matched by currency code). The shard has no expenses yet, so nothing needs re-pricing.
+def copy_exchange_rates(path):
+    conn = connect_db(path)
+    try:
+        c = conn.cursor()
+        c.execute('ATTACH DATABASE ? AS source', (DB_FILE,))
+        c.execute('BEGIN IMMEDIATE')
         c.execute('''
-            CREATE TABLE IF NOT EXISTS trips (
-                id INTEGER PRIMARY KEY,
-                trip_name TEXT UNIQUE,
-                start_date TEXT,
-                end_date TEXT,
-                
-                country_id INTEGER,
-                FOREIGN KEY(country_id) REFERENCES countries(id)
-            )
+            INSERT INTO exchange_rate_history (currency_id, effective_date, rate_to_base, created_at)
+            SELECT cur.id, h.effective_date, h.rate_to_base, h.created_at
+            FROM source.exchange_rate_history h
+            JOIN source.currencies sc ON sc.id = h.currency_id
+            JOIN currencies cur ON cur.code = sc.code
+            WHERE true
+            ON CONFLICT(currency_id, effective_date) DO UPDATE SET
+                rate_to_base = excluded.rate_to_base,
+                created_at = excluded.created_at
+        ''')
+        c.execute('''
+            INSERT INTO exchange_rates (currency_id, rate_to_base, updated_at)
+            SELECT cur.id, r.rate_to_base, r.updated_at
+            FROM source.exchange_rates r
+            JOIN source.currencies sc ON sc.id = r.currency_id
+            JOIN currencies cur ON cur.code = sc.code
+            WHERE true
+            ON CONFLICT(currency_id) DO UPDATE SET
+                rate_to_base = excluded.rate_to_base,
+                updated_at = excluded.updated_at
         ''')
+        conn.commit()
+        c.execute('DETACH DATABASE source')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# gatekeeper
+def login_required(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if 'user_id' not in session:
+            return redirect(url_for('login', next=request.path))
+        return f(*args, **kwargs)
+    return wrapper
+    
+    
+    
+# Current (version, updated_at) of each scope; scopes never written yet count as (0, 0)
+def data_versions(c, scopes):
+    c.execute(
+        'SELECT scope, version, updated_at FROM data_versions WHERE scope IN (%s)' % ','.join('?' * len(scopes)),
+        scopes
+    )
+    found = {r[0]: (r[1], r[2]) for r in c.fetchall()}
+    return [found.get(scope, (0, 0)) for scope in scopes]
+
+
+# Hash of the templates, so a deploy with changed markup never matches an old ETag
+def template_fingerprint():
+    digest = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in sorted(os.walk(folder)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(name.encode() + f.read())
+    return digest.hexdigest()
+
+
+TEMPLATE_FINGERPRINT = template_fingerprint()
+
+
+# brotli is in requirements.txt; without it assets are precompressed with gzip only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Content-hashed copies of static/ (style.css -> style.<hash>.css) with .br / .gz variants
+# in ASSET_DIR. url_for('static', ...) links the hashed names once build() or load() has run.
+class AssetManifest:
+    COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+    def __init__(self):
+        self.files = {}         # filename -> hashed filename
+        self.originals = {}     # hashed filename -> filename
+        self.encodings = {}     # hashed filename -> precompressed encodings, best first
+        self.version = ''
+
+    def folder(self):
+        return os.path.join(app.root_path, app.config['ASSET_DIR'])
+
+    def build(self):
+        files = {}
+        encodings = {}
+        for root, dirs, names in os.walk(app.static_folder):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+
+                stem, ext = os.path.splitext(filename)
+                hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+                files[filename] = hashed
+                encodings[hashed] = self.write(hashed, data, ext)
+
+        if brotli is None:
+            app.logger.warning('brotli is not installed; static assets are precompressed with gzip only')
+
+        self.save({'files': files, 'encodings': encodings})
+        self.use(files, encodings)
+        self.prune(encodings)
+        return files
+
+    # Delete the copies of earlier builds, so deploys don't pile up files in ASSET_DIR
+    def prune(self, encodings):
+        keep = {'manifest.json'}
+        for hashed in encodings:
+            keep.update(hashed + suffix for suffix in ('', '.br', '.gz'))
+
+        for root, dirs, names in os.walk(self.folder()):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.relpath(path, self.folder()).replace(os.sep, '/') not in keep:
+                    os.remove(path)
+
+    # Writes the copy and its compressed variants unless an earlier build already did
+    def write(self, hashed, data, ext):
+        variants = [('', lambda d: d)]
+        if ext in self.COMPRESSIBLE:
+            if brotli is not None:
+                variants.append(('.br', lambda d: brotli.compress(d, quality=11)))
+            variants.append(('.gz', lambda d: gzip.compress(d, 9, mtime=0)))
+
+        encodings = []
+        for suffix, compress in variants:
+            path = os.path.join(self.folder(), hashed + suffix)
+            if not os.path.exists(path):
+                body = compress(data)
+                # A variant that isn't smaller isn't worth serving
+                if suffix and len(body) >= len(data):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(body)
+                os.replace(path + '.tmp', path)
+            if suffix:
+                encodings.append('br' if suffix == '.br' else 'gzip')
+        return encodings
+
+    def save(self, manifest):
+        path = os.path.join(self.folder(), 'manifest.json')
+        os.makedirs(self.folder(), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    # Use a manifest written by `flask build-assets`; False when there is none
+    def load(self):
+        try:
+            with open(os.path.join(self.folder(), 'manifest.json')) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.use(manifest['files'], manifest['encodings'])
+        return True
+
+    def use(self, files, encodings):
+        self.files = files
+        self.originals = {hashed: filename for filename, hashed in files.items()}
+        self.encodings = encodings
+        self.version = hashlib.sha1(json.dumps(files, sort_keys=True).encode()).hexdigest()[:12]
+
+
+asset_manifest = AssetManifest()
+
+
+# url_for('static', filename='style.css') -> /static/style.<hash>.css
+@app.url_defaults
+def hashed_static_url(endpoint, values):
+    if endpoint == 'static' and asset_manifest.files:
+        filename = values.get('filename')
+        values['filename'] = asset_manifest.files.get(filename, filename)
+
+
+# Hashed names never change content, so they're cached for a year and sent precompressed
+# when the browser accepts it; anything else is served by Flask as before
+def serve_static(filename):
+    original = asset_manifest.originals.get(filename)
+    if original is None:
+        return app.send_static_file(filename)
+
+    path = os.path.join(asset_manifest.folder(), filename)
+    encoding = None
+    for name in asset_manifest.encodings.get(filename, []):
+        if request.accept_encodings[name]:
+            encoding = name
+            path += '.br' if name == 'br' else '.gz'
+            break
+
+    response = send_file(
+        path,
+        mimetype=mimetypes.guess_type(original)[0] or 'application/octet-stream',
+        max_age=app.config['ASSET_MAX_AGE']
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+app.view_functions['static'] = serve_static
+
+
+# Answers a repeated GET with 304 Not Modified (no page queries, no template) while
+# the data_versions scopes it depends on are unchanged. scopes(args) lists them.
+def conditional_get(scopes):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # Pending flash messages must be rendered
+            if request.method != 'GET' or '_flashes' in session:
+                return f(*args, **kwargs)
+
+            with get_db() as conn:
+                c = conn.cursor()
+                names = scopes(request.args)
+                versions = data_versions(c, names)
+                reference_version = reference_data().version
+
+            # Reused by trip_data_version() for the fragment cache keys
+            g.data_versions = dict(zip(names, versions))
+
+            key = '|'.join([
+                current_db_path(),
+                request.path,
+                urlencode(sorted(request.args.items(multi=True))),
+                str(session.get('user_id')),
+                ','.join(f'{name}={version}' for name, (version, _) in zip(names, versions)),
+                str(reference_version),
+                TEMPLATE_FINGERPRINT,
+                asset_manifest.version
+            ])
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            last_modified = datetime.fromtimestamp(max(updated for _, updated in versions), timezone.utc)
+
+            # Only the ETag decides: Last-Modified has one-second granularity, so a client
+            # sending just If-Modified-Since could miss a second write in the same second
+            if not is_resource_modified(request.environ, etag=etag):
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            # Weak, like the compressed 200s (CompressionMiddleware), so 304s carry the same tag
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+# Version of one trip's data, reusing the conditional GET's lookup when there was one
+def trip_data_version(c, trip_id):
+    scope = f'trip:{trip_id}'
+    known = g.setdefault('data_versions', {})
+    if scope not in known:
+        known[scope] = data_versions(c, [scope])[0]
+    return known[scope][0]
+
+
+# Rough in-memory size of a cached value in bytes
+def approximate_size(value):
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(approximate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+# Bounded LRU of rendered fragments and query results, evicted by total size. Keys carry
+# the trip's data version, so writes never need to invalidate; stale entries age out.
+class FragmentCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_set(self, key, compute):
+        max_bytes = app.config['FRAGMENT_CACHE_BYTES']
+        if max_bytes <= 0:
+            return compute()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        value = compute()
+        size = approximate_size(value)
+
+        # One entry may not push out most of the cache
+        if size > max_bytes // 4:
+            return value
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+
+            while self.bytes > max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': app.config['FRAGMENT_CACHE_BYTES'],
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+fragment_cache = FragmentCache()
+
+
+# Cache key for data derived from one trip: (database file, route, trip_id, parts...,
+# trip version, lookup-table version)
+def trip_cache_key(c, route, trip_id, *parts):
+    return (c.connection.db_path, route, trip_id, parts, trip_data_version(c, trip_id), reference_data().version)
+
+
+# Runs password hashing off the request thread on a fixed number of threads (scrypt releases
+# the GIL); past PASSWORD_HASH_QUEUE waiting hashes, callers get 503 instead of piling up
+class PasswordHasher:
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            abort(503)
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(
+            generate_password_hash, password,
+            app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH']
+        )
+
+    def verify(self, pass_hashed, password):
+        return self.run(check_password_hash, pass_hashed, password)
+
+    # Hashes made with another method string or salt length than the configured ones
+    def needs_rehash(self, pass_hashed):
+        method, _, rest = pass_hashed.partition('$')
+        salt = rest.partition('$')[0]
+        return method != app.config['PASSWORD_HASH_METHOD'] or len(salt) != app.config['PASSWORD_SALT_LENGTH']
+
+    # Stop the threads once the hashes already submitted have finished
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
+
+
+# In-memory token buckets keyed by client; each worker process keeps its own
+class RateLimiter:
+    MAX_KEYS = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    # (allowed, seconds until the next token)
+    def take(self, key, burst, per_minute):
+        rate = per_minute / 60
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            # Re-inserted at the end, so the dict stays in least recently used order
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return False, (1 - tokens) / rate
+
+            self.buckets[key] = (tokens - 1, now)
+
+            # Forget the least recently seen clients instead of growing without bound
+            while len(self.buckets) > self.MAX_KEYS:
+                self.buckets.popitem(last=False)
+            return True, 0
+
+
+login_limiter = RateLimiter()
+
+
+# Validate password strongness
+def is_strong_password(password):
+    if len(password) < 8:
+        return False, "Password must be at least 8 characters long"
+
+    if not re.search(r"[A-Z]", password):
+        return False, "Password must contain at least one uppercase letter"
+
+    if not re.search(r"[a-z]", password):
+        return False, "Password must contain at least one lowercase letter"
+
+    if not re.search(r"[0-9]", password):
+        return False, "Password must contain at least one number"
+
+    if " " in password:
+        return False, "Password cannot contain spaces"
+
+    return True, ""
+
+
+
+# Weekday names indexed by SQLite strftime('%w') (0 = Sunday)
+WEEKDAYS = ('Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat')
+
+# Totals may differ by float rounding after many incremental updates
+TOTAL_DRIFT_TOLERANCE = 0.005
+
+
+# Returns (trip_id, amount in base currency) for one expense, or None
+def expense_in_base(c, expense_id):
+    c.execute('SELECT trip_id, base_amount FROM expenses WHERE id = ? AND base_amount IS NOT NULL', (expense_id,))
+    return c.fetchone()
+
+
+# Base-currency value of an amount at the rate of its purchase date (None without a rate)
+def base_amount_for(rates, amount, currency_id, purchase_date):
+    rate = rates.rate_on(currency_id, purchase_date)
+    return amount * rate if rate is not None else None
+
+
+# Add an expense to its trip's running total (negative values remove it)
+def adjust_trip_total(c, trip_id, amount_in_base, count=1):
+    c.execute('''
+        INSERT INTO trip_totals (trip_id, total_in_base, expense_count)
+        VALUES (?, ?, ?)
+        ON CONFLICT(trip_id) DO UPDATE SET
+            total_in_base = total_in_base + excluded.total_in_base,
+            expense_count = expense_count + excluded.expense_count
+    ''', (trip_id, amount_in_base, count))
+
+
+# Expense writes. They don't commit, so they can run on the request's connection or
+# inside a write queue group (see run_write)
+
+# Insert a validated expense (see validate_expense) and add it to the trip total
+def insert_expense(c, trip_id, expense):
+    base_amount = base_amount_for(
+        rate_table(c, fresh=True), expense['amount'], expense['currency_id'], expense['purchase_date']
+    )
+    c.execute('''
+        INSERT INTO expenses (trip_id, category_id, method_id, item, amount, currency_id, purchase_date, base_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (trip_id, expense['category_id'], expense['method_id'], expense['item'],
+          expense['amount'], expense['currency_id'], expense['purchase_date'], base_amount))
+
+    if base_amount is not None:
+        adjust_trip_total(c, trip_id, base_amount)
+    return c.lastrowid
+
+
+# Update an expense and move it between trip totals
+def update_expense(c, expense_id, purchase_date, category_id, method_id, item, amount, currency_id):
+    old_expense = expense_in_base(c, expense_id)
+    base_amount = base_amount_for(rate_table(c, fresh=True), float(amount), currency_id, purchase_date)
+
+    c.execute('''
+        UPDATE expenses
+        SET purchase_date = ?, category_id = ?, method_id = ?, item = ?, amount = ?, currency_id = ?, base_amount = ?
+        WHERE id = ?
+    ''', (purchase_date, category_id, method_id, item, amount, currency_id, base_amount, expense_id))
+
+    # Move the old value out of the trip total and the new one in
+    new_expense = expense_in_base(c, expense_id)
+    if old_expense:
+        adjust_trip_total(c, old_expense[0], -old_expense[1], -1)
+    if new_expense:
+        adjust_trip_total(c, new_expense[0], new_expense[1])
+
+
+# Delete an expense and take it out of the trip total
+def delete_expense(c, expense_id):
+    old_expense = expense_in_base(c, expense_id)
+
+    c.execute('DELETE FROM expenses WHERE id = ?', (expense_id,))
+    if old_expense:
+        adjust_trip_total(c, old_expense[0], -old_expense[1], -1)
+
+
+# Recompute totals from the expenses table, keyed by trip id
+def compute_trip_totals(c, trip_ids=None):
+    query = '''
+        SELECT t.id, COALESCE(SUM(e.base_amount), 0), COUNT(e.base_amount)
+        FROM trips t
+        LEFT JOIN expenses e ON e.trip_id = t.id
+    '''
+    params = []
+    if trip_ids is not None:
+        query += ' WHERE t.id IN (%s)' % ','.join('?' * len(trip_ids))
+        params = list(trip_ids)
+    query += ' GROUP BY t.id'
+
+    c.execute(query, params)
+    return {r[0]: (r[1], r[2]) for r in c.fetchall()}
+
+
+# Overwrite stored totals with freshly computed ones
+def rebuild_trip_totals(c, trip_ids=None):
+    totals = compute_trip_totals(c, trip_ids)
+    c.executemany('''
+        INSERT INTO trip_totals (trip_id, total_in_base, expense_count)
+        VALUES (?, ?, ?)
+        ON CONFLICT(trip_id) DO UPDATE SET
+            total_in_base = excluded.total_in_base,
+            expense_count = excluded.expense_count
+    ''', [(trip_id, total, count) for trip_id, (total, count) in totals.items()])
+    return totals
+
+
+# Record a currency's rate from effective_date (default today) on and queue the
+# re-pricing of that currency's expenses from that date (see run_recompute_jobs)
+def set_exchange_rate(c, code, rate, effective_date=None):
+    effective_date = effective_date or date.today().isoformat()
+    now = datetime.now().isoformat()
+
+    c.execute('SELECT id FROM currencies WHERE code = ?', (code,))
+    row = c.fetchone()
+    if not row:
+        return False
+    currency_id = row[0]
+
+    c.execute('''
+        INSERT INTO exchange_rate_history (currency_id, effective_date, rate_to_base, created_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(currency_id, effective_date) DO UPDATE SET
+            rate_to_base = excluded.rate_to_base,
+            created_at = excluded.created_at
+    ''', (currency_id, effective_date, rate, now))
+
+    # exchange_rates keeps the latest rate
+    c.execute('SELECT MAX(effective_date) FROM exchange_rate_history WHERE currency_id = ?', (currency_id,))
+    if c.fetchone()[0] == effective_date:
+        c.execute('''
+            INSERT INTO exchange_rates (currency_id, rate_to_base, updated_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(currency_id) DO UPDATE SET
+                rate_to_base = excluded.rate_to_base,
+                updated_at = excluded.updated_at
+        ''', (currency_id, rate, now))
+
+    rate_cache.invalidate()
+
+    c.execute('''
+        INSERT INTO base_recompute_jobs (currency_id, cursor_date, cursor_id, created_at)
+        VALUES (?, ?, 0, ?)
+    ''', (currency_id, effective_date, now))
+    recompute_worker.wake.set()
+    return True
+
+
+# Re-price one batch of a currency's expenses after (cursor_date, cursor_id), moving the
+# differences into trip_totals; returns (rows changed, next cursor or None when done)
+def recompute_batch(c, currency_id, cursor_date, cursor_id, batch_size):
+    rates = rate_cache.get(c, fresh=True)
+    c.execute('''
+        SELECT id, trip_id, amount, purchase_date, base_amount
+        FROM expenses
+        WHERE currency_id = ? AND (purchase_date, id) > (?, ?)
+        ORDER BY purchase_date, id
+        LIMIT ?
+    ''', (currency_id, cursor_date, cursor_id, batch_size))
+    rows = c.fetchall()
+
+    updates = []
+    deltas = defaultdict(lambda: [0, 0])
+    for expense_id, trip_id, amount, purchase_date, old in rows:
+        new = base_amount_for(rates, amount, currency_id, purchase_date)
+        if new == old:
+            continue
+        updates.append((new, expense_id))
+        delta = deltas[trip_id]
+        delta[0] += (new or 0) - (old or 0)
+        delta[1] += (new is not None) - (old is not None)
+
+    c.executemany('UPDATE expenses SET base_amount = ? WHERE id = ?', updates)
+    for trip_id, (total, count) in deltas.items():
+        adjust_trip_total(c, trip_id, total, count)
+
+    if len(rows) < batch_size:
+        return len(updates), None
+    return len(updates), (rows[-1][3], rows[-1][0])
+
+
+# Whether any re-pricing is queued; a plain read, so idle polling never takes the write lock
+def has_recompute_jobs(conn):
+    return conn.execute('SELECT 1 FROM base_recompute_jobs LIMIT 1').fetchone() is not None
+
+
+# Work through the queued re-pricing jobs, one committed batch per transaction so
+# writers are never blocked for long and totals always match the stored amounts.
+# Batches are idempotent, so two workers draining the same job is harmless.
+def run_recompute_jobs(conn, batch_size=None):
+    batch_size = batch_size or app.config['RECOMPUTE_BATCH_SIZE']
+    c = conn.cursor()
+    changed = 0
+
+    while True:
+        if not has_recompute_jobs(conn):
+            return changed
+
+        # Re-read under the lock: another worker may have finished the job meanwhile
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            c.execute('SELECT id, currency_id, cursor_date, cursor_id FROM base_recompute_jobs ORDER BY id LIMIT 1')
+            job = c.fetchone()
+            if job is None:
+                conn.rollback()
+                return changed
+
+            count, cursor = recompute_batch(c, job[1], job[2], job[3], batch_size)
+            if cursor is None:
+                c.execute('DELETE FROM base_recompute_jobs WHERE id = ?', (job[0],))
+            else:
+                c.execute('UPDATE base_recompute_jobs SET cursor_date = ?, cursor_id = ? WHERE id = ?',
+                          (cursor[0], cursor[1], job[0]))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        changed += count
+        time.sleep(app.config['RECOMPUTE_STEP_SLEEP'])
+
+
+# A daemon thread running self.run, one per worker process. Started lazily (and again
+# after a fork or a crash) so forked workers each get their own thread.
+class BackgroundThread:
+    thread_name = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def ensure_started(self):
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.reset()
+            self.thread = threading.Thread(target=self.run, name=self.thread_name, daemon=True)
+            self.thread.start()
+
+    # Per-process state to start over with, before each (re)start
+    def reset(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError
+
+
+# Background thread per worker process that drains base_recompute_jobs. Only DB_FILE is
+# polled: every rate change queues a job there too, committed after the shards' jobs,
+# so the shards are only checked (and queued in pending) when DB_FILE has work.
+class RecomputeWorker(BackgroundThread):
+    thread_name = 'base-recompute'
+
+    def __init__(self):
+        super().__init__()
+        self.wake = threading.Event()
+        self.pending = set()
+
+    # Shards get a short-lived connection of their own, so checking them doesn't push
+    # the request connections out of the pool
+    def check(self, path, drain):
+        conn = db_pool.acquire(path) if path == DB_FILE else connect_db(path)
+        try:
+            if not drain:
+                return has_recompute_jobs(conn)
+            changed = run_recompute_jobs(conn)
+            if changed:
+                app.logger.info('Re-priced %d expenses in %s after a rate change', changed, path)
+            return True
+        except sqlite3.Error:
+            app.logger.exception('Re-pricing expenses in %s failed; retrying later', path)
+            return False
+        finally:
+            if path == DB_FILE:
+                db_pool.release(conn)
+            else:
+                conn.close()
+
+    def run(self):
+        # Jobs left behind by a process that stopped part-way through
+        self.pending.update(path for path in database_paths() if self.check(path, drain=False))
+
+        while True:
+            if self.check(DB_FILE, drain=False):
+                self.pending.add(DB_FILE)
+                self.pending.update(path for path in database_paths()[1:] if self.check(path, drain=False))
+
+            # A file stays pending until a drain succeeds
+            for path in sorted(self.pending):
+                if self.check(path, drain=True):
+                    self.pending.discard(path)
+
+            self.wake.wait(app.config['RECOMPUTE_POLL_SECONDS'])
+            self.wake.clear()
+
+
+recompute_worker = RecomputeWorker()
+
+
+# One writer thread per worker process. Requests queue a write function and wait for
+# its future; the thread runs whatever arrives within WRITE_GROUP_WINDOW_MS in one
+# transaction per database file, each write inside its own savepoint, so one fsync
+# covers the whole group and a failing write only rolls back itself.
+class WriteQueue(BackgroundThread):
+    thread_name = 'write-queue'
+
+    def __init__(self):
+        super().__init__()
+        self.queue = queue.Queue()
+        self.groups = 0
+        self.writes = 0
+        self.failed = 0
+
+    # Writes queued in the parent process before a fork are not this process's to run
+    def reset(self):
+        self.queue = queue.Queue()
+
+    # Queue fn(cursor, *args) against a database file; the future resolves after COMMIT
+    def submit(self, path, fn, *args):
+        self.ensure_started()
+        future = Future()
+        self.queue.put((path, fn, args, future))
+        return future
+
+    # Block for the first write, then take whatever else arrives within the window
+    def next_group(self):
+        group = [self.queue.get()]
+        deadline = time.monotonic() + app.config['WRITE_GROUP_WINDOW_MS'] / 1000
+        while len(group) < app.config['WRITE_GROUP_MAX']:
+            remaining = deadline - time.monotonic()
+            try:
+                group.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return group
+
+    def run(self):
+        while True:
+            group = self.next_group()
+
+            by_path = OrderedDict()
+            for path, fn, args, future in group:
+                if future.set_running_or_notify_cancel():
+                    by_path.setdefault(path, []).append((fn, args, future))
+
+            for path, writes in by_path.items():
+                self.commit_group(path, writes)
+
+    def commit_group(self, path, writes):
+        conn = db_pool.acquire(path)
+        done, rejected = [], []
+        try:
+            c = conn.cursor()
+            # WAL with synchronous=NORMAL doesn't fsync on COMMIT; the group's one fsync is
+            # what makes an acknowledged write durable
+            c.execute(f"PRAGMA synchronous = {app.config['WRITE_QUEUE_SYNCHRONOUS']}")
+            c.execute('BEGIN IMMEDIATE')
+            for fn, args, future in writes:
+                c.execute('SAVEPOINT write')
+                try:
+                    result = fn(c, *args)
+                except Exception as e:
+                    c.execute('ROLLBACK TO write')
+                    c.execute('RELEASE write')
+                    rejected.append((future, e))
+                else:
+                    c.execute('RELEASE write')
+                    done.append((future, result))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            app.logger.exception('Write group on %s failed', path)
+            rejected += [(future, e) for future, result in done]
+            done = []
+        finally:
+            conn.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+            db_pool.release(conn)
+
+        self.groups += 1
+        self.writes += len(done)
+        self.failed += len(rejected)
+        metrics.observe('accounting_write_group_size', (), len(writes), Metrics.GROUP_BUCKETS)
+
+        # Acknowledge only once the group is durable
+        for future, result in done:
+            future.set_result(result)
+        for future, e in rejected:
+            future.set_exception(e)
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'groups': self.groups,
+            'writes': self.writes,
+            'failed': self.failed
+        }
+
+
+write_queue = WriteQueue()
+
+
+# Run fn(cursor, *args) as one committed write against the request's database: directly on
+# the request connection, or through the write queue when WRITE_QUEUE is on.
+# Exceptions from fn (e.g. sqlite3.IntegrityError) reach the caller either way.
+def run_write(fn, *args):
+    if not app.config['WRITE_QUEUE']:
+        conn = get_db()
+        try:
+            result = fn(conn.cursor(), *args)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return result
+
+    # The request connection must not be holding the write lock the writer needs
+    conn = get_db()
+    if conn.in_transaction:
+        conn.commit()
 
-        # countries table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS countries (
-                id INTEGER PRIMARY KEY,
-                country_name TEXT UNIQUE,
-                country_code TEXT UNIQUE
-            )
-        ''') 
-        
-        countries = [
-            ('Taiwan', 'TW'),
-            ('Japan', 'JP'),
-            ('South Korea', 'KR'),
-            ('Vietnam', 'VN'),
-            ('United States', 'US'),
-            ('United Kindom', 'GB')
-        ]
-        
-        c.executemany(
-            'INSERT OR IGNORE INTO countries (country_name, country_code) VALUES (?, ?)',
-            countries
-        )        
-                
-        # paymentMethods table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS paymentMethods (
-                id INTEGER PRIMARY KEY,
-                method_name TEXT UNIQUE
-            )
-        ''')
-        
-        # insert paymentMethods
-        default_paymentMethods = [
-            (1, 'card'),
-            (2, 'cash')
-        ]
-        
-        for method in default_paymentMethods:
-            c.execute('INSERT OR IGNORE INTO paymentMethods (id, method_name) VALUES (?, ?)', method)
+    future = write_queue.submit(current_db_path(), fn, *args)
+    try:
+        return future.result(timeout=app.config['WRITE_TIMEOUT'])
+    except TimeoutError:
+        # A write still waiting in the queue is dropped; one the writer has started may yet commit
+        if future.cancel():
+            abort(503, description='The change timed out and was not saved. Please try again.')
+        abort(503, description='The change is taking too long and may still be saved. Reload the page before retrying.')
+
+
+
+# Lookup tables with name -> id and id -> row maps; rows keep the SELECT * tuple shape
+class ReferenceData:
+    def __init__(self, version, categories, payment_methods, currencies, countries):
+        self.version = version
+
+        self.categories = categories
+        self.payment_methods = payment_methods
+        self.currencies = currencies
+        self.countries = countries
+
+        self.category_ids = {r[1]: r[0] for r in categories}
+        self.method_ids = {r[1]: r[0] for r in payment_methods}
+        self.currency_ids = {r[1]: r[0] for r in currencies}
+        self.country_ids = {r[2]: r[0] for r in countries}
+
+        self.category_by_id = {r[0]: r for r in categories}
+        self.method_by_id = {r[0]: r for r in payment_methods}
+        self.currency_by_id = {r[0]: r for r in currencies}
+        self.country_by_id = {r[0]: r for r in countries}
+
+
+# In-process cache of the lookup tables, reloaded when its version goes stale
+class ReferenceCache:
+    version_key = 'reference_version'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Keyed by database file, so shards never see each other's rows
+        self.data = {}
+        self.checked_at = {}
+        self.loads = 0
+
+    # fresh=True always compares the DB stamp (for writes that must see the latest rows)
+    def get(self, c, fresh=False):
+        path = getattr(c.connection, 'db_path', DB_FILE)
+        data = self.data.get(path)
+        if data is not None and not fresh and not self.shared():
+            return data
+
+        now = time.monotonic()
+        if data is not None and not fresh and now - self.checked_at.get(path, 0) < app.config['REFERENCE_CACHE_CHECK_SECONDS']:
+            return data
+
+        with self.lock:
+            version = self.db_version(c)
+            data = self.data.get(path)
+            if data is None or data.version != version:
+                data = self.data[path] = self.load(c, version)
+            self.checked_at[path] = now
+            return data
+
+    # Whether other processes may change the tables (then the DB stamp is polled)
+    def shared(self):
+        return app.config['REFERENCE_CACHE_SHARED']
+
+    def db_version(self, c):
+        c.execute('SELECT value FROM app_meta WHERE key = ?', (self.version_key,))
+        row = c.fetchone()
+        return row[0] if row else 0
+
+    def load(self, c, version):
+        tables = {}
+        for table in REFERENCE_TABLES:
+            c.execute(f'SELECT * FROM {table} ORDER BY id')
+            tables[table] = c.fetchall()
+
+        self.loads += 1
+        return ReferenceData(
+            version,
+            tables['categories'],
+            tables['paymentMethods'],
+            tables['currencies'],
+            tables['countries']
+        )
+
+    # Call after writing to a lookup table; the triggers bump the DB stamp for other workers
+    def invalidate(self):
+        with self.lock:
+            self.data.clear()
+
+
+reference_cache = ReferenceCache()
 
-        # categories table
+
+# Lookup tables for the current request
+def reference_data():
+    return reference_cache.get(get_db().cursor())
+
+
+# Rate history per currency as sorted parallel lists for as-of lookups
+class RateTable:
+    def __init__(self, version, rows):
+        self.version = version
+        self.dates = defaultdict(list)
+        self.rates = defaultdict(list)
+
+        # rows are ordered by (currency_id, effective_date)
+        for currency_id, effective_date, rate in rows:
+            self.dates[currency_id].append(effective_date)
+            self.rates[currency_id].append(rate)
+
+    # Rate in effect on purchase_date; dates before the first entry use the earliest rate
+    def rate_on(self, currency_id, purchase_date):
+        dates = self.dates.get(currency_id)
+        if not dates:
+            return None
+        i = bisect_right(dates, purchase_date or '') - 1
+        return self.rates[currency_id][max(i, 0)]
+
+
+# Per-process cache of the rate history; rates are changed from the CLI, so the stamp is always polled
+class RateCache(ReferenceCache):
+    version_key = 'rate_version'
+
+    def shared(self):
+        return True
+
+    def load(self, c, version):
         c.execute('''
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY,
-                cat_name TEXT UNIQUE,
-                order_index INTEGER
-            )
+            SELECT currency_id, effective_date, rate_to_base
+            FROM exchange_rate_history
+            ORDER BY currency_id, effective_date
         ''')
-        
-        # insert categories
-        default_categories = [
-            ('meals', 1),
-            ('activities', 2),
-            ('transportation', 3),
-            ('accommodation', 4),
-            ('others', 5)
-        ]
-
-        for cat_name, order_index in default_categories:
-            c.execute(
-                'INSERT OR IGNORE INTO categories (cat_name, order_index) VALUES (?, ?)',
-                (cat_name, order_index)
-            )
+        self.loads += 1
+        return RateTable(version, c.fetchall())
 
-        # currencies table
-        c.execute('''CREATE TABLE IF NOT EXISTS currencies (
-                     id INTEGER PRIMARY KEY, 
-                     code TEXT UNIQUE, 
-                     currency_name TEXT,
-                     symbol TEXT,
-                     is_base INTEGER DEFAULT 0
-                    )
-                ''')
-                
-        default_currencies = [
-            ('NTD', 'New Taiwanese Dollar', '$'),
-            ('JPY', 'Japanese Yen', '¥'),
-            ('KRW', 'Korean Won', '₩'),
-            ('VND', 'Vietnamese Dong', '₫'),
-            ('USD', 'US Dollar', '$'),
-            ('EUR', 'Euro', '€'),
-            ('GBP', 'British Pound', '£')
-        ]
-
-        for code, currency_name, symbol in default_currencies:
-            c.execute(
-                'INSERT OR IGNORE INTO currencies (code, currency_name, symbol) VALUES (?, ?, ?)',
-                (code, currency_name, symbol)
-            )
-            
-        # Exchange_rates table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS exchange_rates (
-                id INTEGER PRIMARY KEY,
-                currency_id INTEGER UNIQUE,
-                rate_to_base REAL NOT NULL,
-                updated_at TEXT NOT NULL,
-                FOREIGN KEY(currency_id) REFERENCES currencies(id)
+
+rate_cache = RateCache()
+
+
+# Rate history, via the given cursor (usable outside a request); writes pass fresh=True
+# so an expense is never priced with a rate another process has just replaced
+def rate_table(c, fresh=False):
+    return rate_cache.get(c, fresh)
+
+
+# Keyset cursors encode the (purchase_date, id) of the last row on a page
+def encode_cursor(purchase_date, expense_id):
+    raw = f'{purchase_date}|{expense_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        purchase_date, expense_id = raw.rsplit('|', 1)
+        return purchase_date, int(expense_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+# WHERE clause for the viewExpense filters; names are resolved to ids through the cache
+def expense_filters(trip_id, purchase_date=None, category_name=None, payment_method=None):
+    ref = reference_data()
+    where = 'e.trip_id = ?'
+    params = [trip_id]
+
+    if purchase_date:
+        where += ' AND e.purchase_date = ?'
+        params.append(purchase_date)
+
+    if category_name:
+        where += ' AND e.category_id = ?'
+        params.append(ref.category_ids.get(category_name))
+
+    if payment_method:
+        where += ' AND e.method_id = ?'
+        params.append(ref.method_ids.get(payment_method))
+
+    return where, params
+
+
+# One page of a trip's expenses ordered by (purchase_date, id); returns (expenses, next_cursor)
+def fetch_expense_page(c, trip_id, purchase_date=None, category_name=None, payment_method=None,
+                       cursor=None, limit=None, descending=False):
+    ref = reference_data()
+    limit = limit or app.config['EXPENSES_PAGE_SIZE']
+    where, params = expense_filters(trip_id, purchase_date, category_name, payment_method)
+
+    if cursor:
+        where += ' AND (e.purchase_date, e.id) %s (?, ?)' % ('<' if descending else '>')
+        params.extend(cursor)
+
+    order = 'DESC' if descending else 'ASC'
+    c.execute(f'''
+        SELECT e.id, e.purchase_date, e.category_id, e.method_id, e.item, e.amount, e.currency_id
+        FROM expenses e
+        WHERE {where}
+        ORDER BY e.purchase_date {order}, e.id {order}
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = c.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+
+    expenses = [expense_dict(ref, e) for e in rows]
+    return expenses, next_cursor
+
+
+# (id, purchase_date, category_id, method_id, item, amount, currency_id) row -> the dict
+# the expense lists and the JSON API use
+def expense_dict(ref, e):
+    category = ref.category_by_id.get(e[2], (None, '', 0))
+    method = ref.method_by_id.get(e[3], (None, ''))
+    currency = ref.currency_by_id.get(e[6], (None, '', '', ''))
+    return {
+        'id': e[0],
+        'purchase_date': e[1],
+        'category': category[1],
+        'category_order': category[2],
+        'payment_method': method[1],
+        'item': e[4],
+        'amount': e[5],
+        'code': currency[1],
+        'symbol': currency[3]
+    }
+
+
+# One expense as (trip_id, expense dict), or None
+def fetch_expense(c, expense_id):
+    c.execute('''
+        SELECT id, purchase_date, category_id, method_id, item, amount, currency_id, trip_id
+        FROM expenses
+        WHERE id = ?
+    ''', (expense_id,))
+    row = c.fetchone()
+    if not row:
+        return None
+    return row[7], expense_dict(reference_data(), row)
+
+
+# Total in base currency for the viewExpense filters (the stored total when unfiltered,
+# otherwise summed from expense_rollups, which has the same filter columns)
+def filtered_trip_total(c, trip_id, purchase_date=None, category_name=None, payment_method=None):
+    if not (purchase_date or category_name or payment_method):
+        c.execute('SELECT total_in_base FROM trip_totals WHERE trip_id = ?', (trip_id,))
+        row = c.fetchone()
+        return row[0] if row and row[0] is not None else 0
+
+    where, params = expense_filters(trip_id, purchase_date, category_name, payment_method)
+    c.execute(f'''
+        SELECT SUM(e.base_total)
+        FROM expense_rollups e
+        WHERE {where}
+    ''', params)
+    row = c.fetchone()
+    return row[0] if row[0] is not None else 0
+
+
+# Per-day, per-category and per-method breakdowns plus chart series, read from
+# expense_rollups (one row per trip/day/category/method rather than per expense)
+def trip_summary(c, trip_id, purchase_date=None, category_name=None, payment_method=None):
+    ref = reference_data()
+    where, params = expense_filters(trip_id, purchase_date, category_name, payment_method)
+    c.execute(f'''
+        SELECT e.purchase_date, e.category_id, e.method_id, e.expense_count, e.base_total
+        FROM expense_rollups e
+        WHERE {where}
+        ORDER BY e.purchase_date
+    ''', params)
+
+    days = {}
+    categories = {}
+    methods = {}
+    cells = defaultdict(float)
+    for purchase_date, category_id, method_id, count, total in c.fetchall():
+        for groups, key in ((days, purchase_date), (categories, category_id), (methods, method_id)):
+            group = groups.setdefault(key, [0, 0.0])
+            group[0] += count
+            group[1] += total
+        cells[(category_id, purchase_date)] += total
+
+    # Categories in their display order
+    category_ids = sorted(categories, key=lambda i: (ref.category_by_id.get(i, (i, '', 0))[2] or 0, i))
+    labels = list(days)
+
+    return {
+        'trip_id': trip_id,
+        'expense_count': sum(d[0] for d in days.values()),
+        'total': round(sum(d[1] for d in days.values()), 2),
+        'by_day': [
+            {'date': day, 'expense_count': count, 'total': round(total, 2)}
+            for day, (count, total) in days.items()
+        ],
+        'by_category': [
+            {'category': ref.category_by_id.get(i, (i, ''))[1], 'expense_count': categories[i][0],
+             'total': round(categories[i][1], 2)}
+            for i in category_ids
+        ],
+        'by_payment_method': [
+            {'payment_method': ref.method_by_id.get(i, (i, ''))[1], 'expense_count': count,
+             'total': round(total, 2)}
+            for i, (count, total) in sorted(methods.items())
+        ],
+        # Stacked chart: one series per category, one point per day
+        'chart': {
+            'labels': labels,
+            'series': [
+                {'category': ref.category_by_id.get(i, (i, ''))[1],
+                 'data': [round(cells.get((i, day), 0), 2) for day in labels]}
+                for i in category_ids
+            ]
+        }
+    }
+
+
+# Percentiles of a single expense's base amount reported by the stats API
+STATS_PERCENTILES = (50, 75, 90, 95, 99)
+
+
+# Daily burn rate and projected spend at the end of the trip; works on scalars or per-trip
+# arrays. Spending is averaged over the trip days so far, or over the days with spending
+# for trips that haven't started yet (deposits, flights).
+def burn_and_projection(spent, trip_days, days_elapsed, spending_days):
+    basis = np.where(days_elapsed > 0, days_elapsed, np.maximum(spending_days, 1))
+    burn_rate = spent / basis
+    projected = spent + burn_rate * (trip_days - days_elapsed)
+    return burn_rate, projected
+
+
+# Base amounts of a trip at the given percentiles, interpolated like np.percentile. Only the
+# two values around each rank are read, straight from idx_expenses_trip_base (sorted by
+# amount), so large trips don't pull every expense into Python.
+def amount_percentiles(c, trip_id, percentiles):
+    c.execute('SELECT expense_count FROM trip_totals WHERE trip_id = ?', (trip_id,))
+    row = c.fetchone()
+    count = row[0] if row else 0
+    if not count:
+        return np.full(len(percentiles), np.nan)
+
+    positions = np.asarray(percentiles, dtype=float) / 100 * (count - 1)
+    ranks = np.floor(positions).astype(np.int64)
+
+    c.execute(' UNION ALL '.join(['''
+        SELECT * FROM (
+            SELECT ? AS rank, base_amount
+            FROM expenses
+            WHERE trip_id = ? AND base_amount IS NOT NULL
+            ORDER BY base_amount
+            LIMIT 2 OFFSET ?
+        )
+    '''] * len(ranks)), [p for rank in ranks.tolist() for p in (rank, trip_id, rank)])
+
+    around = defaultdict(list)
+    for rank, amount in c.fetchall():
+        around[rank].append(amount)
+    # (a rank past the end means trip_totals drifted; `flask trip-totals --rebuild` fixes it)
+    lower = np.array([(around.get(r) or [np.nan])[0] for r in ranks.tolist()])
+    upper = np.array([(around.get(r) or [np.nan])[-1] for r in ranks.tolist()])
+    return lower + (upper - lower) * (positions - ranks)
+
+
+# Spending statistics of one trip, computed with NumPy over the trip's expense_rollups rows
+# (per day / category totals) fetched as one block of columns; no per-expense Python loop.
+def trip_stats(c, trip_id, start_date, end_date, today):
+    ref = reference_data()
+    start = np.datetime64(start_date, 'D')
+    trip_days = max(int((np.datetime64(end_date, 'D') - start).astype(int)) + 1, 1)
+    days_elapsed = int(np.clip((np.datetime64(today, 'D') - start).astype(int) + 1, 0, trip_days))
+
+    c.execute('''
+        SELECT CAST(julianday(purchase_date) - julianday(?) AS INTEGER), category_id, expense_count, base_total
+        FROM expense_rollups
+        WHERE trip_id = ?
+    ''', (start_date, trip_id))
+    rollups = np.array(c.fetchall(), dtype=float).reshape(-1, 4)
+    category_ids = rollups[:, 1].astype(np.int64)
+    totals = rollups[:, 3]
+
+    # Expenses without a (valid) purchase date count in the totals but in no day (NaN offset)
+    dated = ~np.isnan(rollups[:, 0])
+    offsets = rollups[dated, 0].astype(np.int64)
+
+    # One bucket per day from the trip start (or earlier spending) to its end (or later spending)
+    first = min(0, int(offsets.min())) if offsets.size else 0
+    last = max(trip_days - 1, int(offsets.max())) if offsets.size else trip_days - 1
+    daily = np.bincount(offsets - first, weights=totals[dated], minlength=last - first + 1).astype(float)
+    running = np.cumsum(daily)
+    dates = start + np.arange(first, last + 1)
+
+    spent = float(totals.sum())
+    burn_rate, projected = burn_and_projection(spent, trip_days, days_elapsed, np.count_nonzero(daily))
+
+    by_category = np.bincount(category_ids, weights=totals) if category_ids.size else np.zeros(0)
+    order = np.argsort(-by_category, kind='stable')
+    order = order[by_category[order] > 0]
+
+    percentiles = amount_percentiles(c, trip_id, STATS_PERCENTILES)
+
+    return {
+        'trip_id': trip_id,
+        'start_date': start_date,
+        'end_date': end_date,
+        'today': str(np.datetime64(today, 'D')),
+        'trip_days': trip_days,
+        'days_elapsed': days_elapsed,
+        'expense_count': int(rollups[:, 2].sum()),
+        'total': round(spent, 2),
+        'undated_total': round(float(totals[~dated].sum()), 2),
+        'daily_burn_rate': round(float(burn_rate), 2),
+        'projected_total': round(float(projected), 2),
+        'by_day': [
+            {'date': day, 'total': total, 'running_total': run}
+            for day, total, run in zip(
+                dates.astype(str).tolist(), np.round(daily, 2).tolist(), np.round(running, 2).tolist()
             )
-        ''')
+        ],
+        'by_category': [
+            {'category': ref.category_by_id.get(i, (i, ''))[1], 'total': round(float(by_category[i]), 2),
+             'share': round(float(by_category[i] / spent), 4)}
+            for i in order.tolist()
+        ],
+        'item_cost_percentiles': {
+            f'p{p}': None if np.isnan(value) else round(float(value), 2)
+            for p, value in zip(STATS_PERCENTILES, percentiles)
+        }
+    }
 
-        default_exchange_rates = [
-            ('NTD', 1.0),
-            ('JPY', 0.2004),
-            ('KRW', 0.02114),
-            ('VND', 0.001187),
-            ('USD', 31.215),
-            ('EUR', 36.617),
-            ('GBP', 41.761)
-        ]
-
-        for code, rate in default_exchange_rates:
-            c.execute('SELECT id FROM currencies WHERE code = ?', (code,))
-            row = c.fetchone()
-            if row:
-                currency_id = row[0]
-                updated_at = datetime.now().isoformat()
-                c.execute('INSERT OR IGNORE INTO exchange_rates (currency_id, rate_to_base, updated_at)VALUES (?, ?, ?)', 
-                    (currency_id, rate, updated_at)
-                )
-        
-        # expenses table
-        c.execute('''CREATE TABLE IF NOT EXISTS expenses (
-                     id INTEGER PRIMARY KEY, 
-                     purchase_date TEXT,
-                     item TEXT, 
-                     amount REAL,
-                     
-                     currency_id INTEGER,
-                     method_id INTEGER, 
-                     category_id INTEGER,
-                     trip_id INTEGER,
-                  
-                     FOREIGN KEY(currency_id) REFERENCES currencies(id),
-                     FOREIGN KEY(method_id) REFERENCES paymentMethods(id),
-                     FOREIGN KEY(category_id) REFERENCES categories(id),
-                     FOREIGN KEY(trip_id) REFERENCES trips(id)
-                    )
-                ''')
-                
-        conn.commit()
 
+# Side-by-side numbers for every trip: one query over trips and one over expense_rollups,
+# with the per-trip arithmetic done on NumPy arrays
+def compare_trips(c, today):
+    ref = reference_data()
+    c.execute('''
+        SELECT t.id, t.trip_name, t.start_date, t.end_date, t.country_id,
+               COALESCE(tt.total_in_base, 0), COALESCE(tt.expense_count, 0)
+        FROM trips t
+        LEFT JOIN trip_totals tt ON tt.trip_id = t.id
+        ORDER BY t.start_date
+    ''')
+    trips = c.fetchall()
+    if not trips:
+        return []
 
-# gatekeeper
-def login_required(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if 'user_id' not in session:
-            return redirect(url_for('login', next=request.path))
-        return f(*args, **kwargs)
-    return wrapper
-    
-    
-    
-# Validate password strongness
-def is_strong_password(password):
-    if len(password) < 8:
-        return False, "Password must be at least 8 characters long"
+    # Joined to trips: databases from before foreign keys were enforced can hold expenses
+    # of deleted trips, which must not land on another trip's row below
+    c.execute('''
+        SELECT r.trip_id, r.category_id, SUM(r.base_total)
+        FROM expense_rollups r
+        JOIN trips t ON t.id = r.trip_id
+        GROUP BY r.trip_id, r.category_id
+    ''')
+    rollups = np.array(c.fetchall(), dtype=float).reshape(-1, 3)
 
-    if not re.search(r"[A-Z]", password):
-        return False, "Password must contain at least one uppercase letter"
+    c.execute('''
+        SELECT trip_id, COUNT(DISTINCT purchase_date)
+        FROM expense_rollups
+        WHERE base_total > 0
+        GROUP BY trip_id
+    ''')
+    spending_days_by_trip = dict(c.fetchall())
 
-    if not re.search(r"[a-z]", password):
-        return False, "Password must contain at least one lowercase letter"
+    ids = np.array([t[0] for t in trips])
+    starts = np.array([t[2] for t in trips], dtype='datetime64[D]')
+    ends = np.array([t[3] for t in trips], dtype='datetime64[D]')
+    spent = np.array([t[5] for t in trips], dtype=float)
+    counts = np.array([t[6] for t in trips], dtype=float)
+    spending_days = np.array([spending_days_by_trip.get(i, 0) for i in ids.tolist()], dtype=float)
 
-    if not re.search(r"[0-9]", password):
-        return False, "Password must contain at least one number"
+    trip_days = np.maximum((ends - starts).astype(int) + 1, 1)
+    days_elapsed = np.clip((np.datetime64(today, 'D') - starts).astype(int) + 1, 0, trip_days)
+    burn_rate, projected = burn_and_projection(spent, trip_days, days_elapsed, spending_days)
+    average = np.divide(spent, counts, out=np.zeros_like(spent), where=counts > 0)
 
-    if " " in password:
-        return False, "Password cannot contain spaces"
+    # trips x categories matrix of totals -> each trip's biggest category
+    by_id = np.argsort(ids)
+    row = by_id[np.searchsorted(ids, rollups[:, 0].astype(np.int64), sorter=by_id)]
+    matrix = np.zeros((len(ids), int(rollups[:, 1].max()) + 1 if rollups.size else 1))
+    np.add.at(matrix, (row, rollups[:, 1].astype(np.int64)), rollups[:, 2])
+    top = matrix.argmax(axis=1)
+    top_total = matrix[np.arange(len(ids)), top]
+
+    results = []
+    for i, t in enumerate(trips):
+        country = ref.country_by_id.get(t[4])
+        results.append({
+            'id': t[0],
+            'trip_name': t[1],
+            'start_date': t[2],
+            'end_date': t[3],
+            'flag': country_flag(country[2]) if country else '',
+            'trip_days': int(trip_days[i]),
+            'days_elapsed': int(days_elapsed[i]),
+            'expense_count': int(counts[i]),
+            'total': round(float(spent[i]), 2),
+            'average_expense': round(float(average[i]), 2),
+            'daily_burn_rate': round(float(burn_rate[i]), 2),
+            'projected_total': round(float(projected[i]), 2),
+            'top_category': ref.category_by_id.get(int(top[i]), (None, ''))[1] if top_total[i] > 0 else None,
+            'top_category_share': round(float(top_total[i] / spent[i]), 4) if spent[i] > 0 else 0
+        })
+    return results
+
+
+# One budget row as JSON; category is None for the trip-wide budget
+def budget_dict(ref, category_id, amount, spent):
+    return {
+        'category': ref.category_by_id[category_id][1] if category_id in ref.category_by_id else None,
+        'amount': round(amount, 2),
+        'spent': round(spent, 2),
+        'remaining': round(amount - spent, 2),
+        'warning': spent >= amount * app.config['BUDGET_WARN_RATIO'],
+        'exceeded': spent > amount
+    }
+
+
+# Budgets an expense in (trip, category) counts against, read from their running totals
+# (at most two indexed rows, whatever the trip's size). None when none apply.
+def budget_status(c, trip_id, category_id):
+    c.execute('''
+        SELECT category_id, amount, spent
+        FROM budgets
+        WHERE trip_id = ? AND (category_id IS NULL OR category_id = ?)
+        ORDER BY category_id IS NOT NULL
+    ''', (trip_id, category_id))
+    rows = c.fetchall()
+    if not rows:
+        return None
+
+    ref = reference_data()
+    budgets = [budget_dict(ref, *r) for r in rows]
+    warnings = []
+    for b in budgets:
+        name = f"{b['category']} budget" if b['category'] else 'trip budget'
+        if b['exceeded']:
+            warnings.append(f"Over the {name} by {-b['remaining']:.2f} TWD!")
+        elif b['warning']:
+            warnings.append(f"Only {b['remaining']:.2f} TWD left in the {name}.")
+
+    return {
+        'remaining': min(b['remaining'] for b in budgets),
+        'warning': bool(warnings),
+        'message': ' '.join(warnings) or None,
+        'budgets': budgets
+    }
+
+
+# Set (or with amount None, remove) a trip's budget; category_id None is the whole trip.
+# A new budget starts from the rollups' total once; the triggers keep it current after that.
+def set_budget(c, trip_id, category_id, amount):
+    if amount is None:
+        c.execute(
+            'DELETE FROM budgets WHERE trip_id = ? AND COALESCE(category_id, 0) = ?',
+            (trip_id, category_id or 0)
+        )
+        return
+
+    c.execute('''
+        INSERT INTO budgets (trip_id, category_id, amount, spent)
+        SELECT ?, ?, ?, COALESCE(SUM(base_total), 0)
+        FROM expense_rollups
+        WHERE trip_id = ? AND (? IS NULL OR category_id = ?)
+        ON CONFLICT (trip_id, COALESCE(category_id, 0)) DO UPDATE SET amount = excluded.amount
+    ''', (trip_id, category_id, amount, trip_id, category_id, category_id))
+
+
+# Every trip with its budgets in one query over the stored totals (no expense scans)
+def budget_overview(c):
+    ref = reference_data()
+    c.execute('''
+        SELECT t.id, t.trip_name, t.start_date, t.end_date, t.country_id,
+               COALESCE(tt.total_in_base, 0), b.category_id, b.amount, b.spent
+        FROM trips t
+        LEFT JOIN trip_totals tt ON tt.trip_id = t.id
+        LEFT JOIN budgets b ON b.trip_id = t.id
+        ORDER BY t.start_date, t.id, b.category_id IS NOT NULL, b.category_id
+    ''')
+
+    trips = {}
+    for r in c.fetchall():
+        trip = trips.get(r[0])
+        if trip is None:
+            country = ref.country_by_id.get(r[4])
+            trip = trips[r[0]] = {
+                'id': r[0],
+                'trip_name': r[1],
+                'start_date': r[2],
+                'end_date': r[3],
+                'flag': country_flag(country[2]) if country else '',
+                'total_in_base': round(r[5], 2),
+                'budget': None,
+                'categories': []
+            }
+        if r[7] is None:
+            continue
+        if r[6] is None:
+            trip['budget'] = budget_dict(ref, None, r[7], r[8])
+        else:
+            trip['categories'].append(budget_dict(ref, r[6], r[7], r[8]))
+    return list(trips.values())
+
+
+# Dates and categories that occur in a trip, for the viewExpense filter dropdowns
+def trip_filter_options(c, trip_id):
+    c.execute('''
+        SELECT DISTINCT purchase_date
+        FROM expense_rollups
+        WHERE trip_id = ?
+        ORDER BY purchase_date
+    ''', (trip_id,))
+    dates = [r[0] for r in c.fetchall()]
+
+    c.execute('''
+        SELECT DISTINCT c.cat_name
+        FROM categories c
+        JOIN expense_rollups e ON e.category_id = c.id
+        WHERE e.trip_id = ?
+        ORDER BY c.order_index
+    ''', (trip_id,))
+    categories = [r[0] for r in c.fetchall()]
+    return dates, categories
+
+
+# The grouped expense cards and Load More button shared by newExpense and viewExpense
+def render_expense_groups(grouped_expenses, group_by, trip_id, next_cursor, next_path, load_more_url):
+    return Markup(render_template(
+        'expenseGroups.html',
+        grouped_expenses=grouped_expenses,
+        group_by=group_by,
+        trip_id=trip_id,
+        next_cursor=next_cursor,
+        next_path=next_path,
+        load_more_url=load_more_url
+    ))
+
+
+# FTS5 query for free text: every word must match, the last one as a prefix ("osa" finds "osaka")
+def search_match_query(text, trip_id=None):
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words[:-1]] + [f'"{words[-1]}"*']
+    match = 'item : (%s)' % ' AND '.join(terms)
+    if trip_id:
+        match += f' AND trip : "trip{int(trip_id)}"'
+    return match
+
+
+# Expenses whose item matches text, best bm25 rank first; optional trip and date range filters.
+# Every match is ranked; SQLite keeps only the best LIMIT rows while sorting.
+def search_expenses(c, text, trip_id=None, date_from=None, date_to=None, limit=None):
+    match = search_match_query(text, trip_id)
+    if match is None:
+        return []
+
+    ref = reference_data()
+    where = 'expenses_fts MATCH ?'
+    params = [match]
+    if date_from:
+        where += ' AND e.purchase_date >= ?'
+        params.append(date_from)
+    if date_to:
+        where += ' AND e.purchase_date <= ?'
+        params.append(date_to)
+    params.append(limit or app.config['SEARCH_LIMIT'])
+
+    c.execute(f'''
+        SELECT e.id, e.trip_id, t.trip_name, e.purchase_date, e.category_id, e.method_id,
+               e.item, e.amount, e.currency_id, e.base_amount, bm25(expenses_fts, 1.0, 0.0) AS score
+        FROM expenses_fts
+        JOIN expenses e ON e.id = expenses_fts.rowid
+        JOIN trips t ON t.id = e.trip_id
+        WHERE {where}
+        ORDER BY score, e.purchase_date DESC, e.id DESC
+        LIMIT ?
+    ''', params)
+
+    results = []
+    for r in c.fetchall():
+        currency = ref.currency_by_id.get(r[8], (None, '', '', ''))
+        results.append({
+            'id': r[0],
+            'trip_id': r[1],
+            'trip_name': r[2],
+            'purchase_date': r[3],
+            'category': ref.category_by_id.get(r[4], (None, ''))[1],
+            'payment_method': ref.method_by_id.get(r[5], (None, ''))[1],
+            'item': r[6],
+            'amount': r[7],
+            'code': currency[1],
+            'symbol': currency[3],
+            'amount_in_base': round(r[9], 2) if r[9] is not None else None,
+            'rank': r[10]
+        })
+    return results
+
+
+# zstd ships with Python 3.14 (compression.zstd); fall back to gzip only without it
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+# compression -> (file suffix, mimetype)
+BACKUP_COMPRESSORS = {'gzip': ('.gz', 'application/gzip')}
+if zstd is not None:
+    BACKUP_COMPRESSORS['zstd'] = ('.zst', 'application/zstd')
+
+BACKUP_CHUNK_SIZE = 64 * 1024
+
+
+# gzip / zstd streams that flush after every chunk, so streamed responses keep streaming
+class GzipStream:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class ZstdStream:
+    def __init__(self, level):
+        self.compressor = zstd.ZstdCompressor(level)
+
+    def compress(self, chunk):
+        return self.compressor.compress(chunk, zstd.ZstdCompressor.FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# WSGI layer compressing text responses (see COMPRESS_*). Responses that are already
+# encoded (precompressed static files, backups), small, partial or marked no-transform
+# pass through untouched. Bytes in / out are counted per route on /metrics.
+class CompressionMiddleware:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if not app.config['COMPRESS'] or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return self.write_unsupported
+
+        body = self.wsgi_app(environ, capture)
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+
+        if not self.should_compress(status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return body
+
+        # A short body isn't worth it; when the size is known, read it whole to check
+        length = headers.get('Content-Length', type=int)
+        if length is not None:
+            try:
+                data = b''.join(body)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            if len(data) < app.config['COMPRESS_MIN_SIZE']:
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                return [data]
+            body = [data]
+
+        headers['Content-Encoding'] = encoding
+        headers.pop('Content-Length', None)
+        vary = headers.get('Vary')
+        headers['Vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+        # Different bytes than the uncompressed representation; If-None-Match still matches
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            headers['ETag'] = 'W/' + etag
+
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        # The body is closed even if the server never starts reading the compressed stream
+        return ClosingIterator(self.compress(body, encoding, environ.get('accounting.route', 'unmatched')),
+                               getattr(body, 'close', None))
+
+    @staticmethod
+    def write_unsupported(data):
+        raise RuntimeError('CompressionMiddleware does not support the WSGI write() callable')
+
+    def negotiate(self, accept_encoding):
+        accepted = parse_accept_header(accept_encoding)
+        if zstd is not None and accepted['zstd']:
+            return 'zstd'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def should_compress(self, status, headers):
+        if not status.startswith('200') or 'Content-Encoding' in headers:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        return mimetype in app.config['COMPRESS_MIMETYPES']
+
+    def compress(self, body, encoding, route):
+        if encoding == 'zstd':
+            stream = ZstdStream(app.config['COMPRESS_ZSTD_LEVEL'])
+        else:
+            stream = GzipStream(app.config['COMPRESS_LEVEL'])
+
+        size = sent = 0
+        try:
+            for chunk in body:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                out = stream.compress(chunk)
+                sent += len(out)
+                yield out
+
+            out = stream.finish()
+            sent += len(out)
+            yield out
+        finally:
+            labels = (('route', route), ('encoding', encoding))
+            metrics.inc('accounting_response_bytes_total', labels, size)
+            metrics.inc('accounting_compressed_bytes_total', labels, sent)
+
+
+app.wsgi_app = CompressionMiddleware(app.wsgi_app)
 
-    return True, ""
 
+# Copy the live database (including pages still in the WAL) with the backup API.
+# It copies in one step: under WAL that read doesn't block writers, while a step-wise
+# copy restarts whenever another connection commits and may never finish.
+def snapshot_db(dest_path, source_path=None):
+    source = connect_db(source_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        source.backup(dest, pages=-1)
+        # Make the copy a standalone file that doesn't need a -wal next to it
+        dest.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        dest.close()
+        source.close()
+
+
+# Compress src into dest and return the SHA-256 of the compressed file
+def compress_file(src_path, dest_path, compression='gzip'):
+    if compression == 'zstd':
+        out = zstd.open(dest_path, 'wb')
+    else:
+        out = gzip.GzipFile(dest_path, 'wb', mtime=0)
+
+    with open(src_path, 'rb') as src, out:
+        shutil.copyfileobj(src, out, BACKUP_CHUNK_SIZE)
+
+    digest = hashlib.sha256()
+    with open(dest_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BACKUP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Write a compressed snapshot to BACKUP_DIR and prune the oldest beyond BACKUP_KEEP
+def write_local_snapshot(compression='gzip', source_path=None, prefix='expense_backup_'):
+    backup_dir = app.config['BACKUP_DIR']
+    os.makedirs(backup_dir, exist_ok=True)
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    archive_path = os.path.join(backup_dir, f'{prefix}{timestamp}.db{BACKUP_COMPRESSORS[compression][0]}')
+
+    with tempfile.TemporaryDirectory(dir=backup_dir) as workdir:
+        snapshot_path = os.path.join(workdir, 'snapshot.db')
+        snapshot_db(snapshot_path, source_path)
+        checksum = compress_file(snapshot_path, archive_path + '.tmp', compression)
+        os.replace(archive_path + '.tmp', archive_path)
+
+    with open(archive_path + '.sha256', 'w') as f:
+        f.write(f'{checksum}  {os.path.basename(archive_path)}\n')
+
+    snapshots = sorted(
+        name for name in os.listdir(backup_dir)
+        if name.startswith(prefix) and not name.endswith(('.sha256', '.tmp'))
+    )
+    keep = app.config['BACKUP_KEEP']
+    removed = snapshots[:-keep] if keep > 0 else []
+    for name in removed:
+        for path in (os.path.join(backup_dir, name), os.path.join(backup_dir, name + '.sha256')):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return archive_path, checksum, removed
+
+
+# Validate one expense with the newExpense rules; used by the form and the CSV import.
+# Returns (error message, None) or (None, values ready to insert)
+def validate_expense(purchase_date, category, payment_method, item, amount_str, currency, ref):
+    if not purchase_date:
+        return "Purchase date cannot be empty!", None
+    if not category:
+        return "Category cannot be empty!", None
+    if not payment_method:
+        return "Please select a payment method!", None
+    if not item:
+        return "Item cannot be empty!", None
+    if not amount_str:
+        return "Amount cannot be empty!", None
+    if not currency:
+        return "Please select a currency!", None
+
+    try:
+        purchase_date = date.fromisoformat(purchase_date).isoformat()
+    except ValueError:
+        return "Invalid date format!", None
+
+    # Validate "amount" input
+    try:
+        amount = round(float(amount_str), 2)  # 兩位小數
+    except ValueError:
+        return "Invalid amount!", None
+    if not amount > 0:
+        return "Amount must be greater than 0!", None
+
+    category_id = ref.category_ids.get(category)
+    if category_id is None:
+        return "Invalid category selected!", None
+
+    method_id = ref.method_ids.get(payment_method)
+    if method_id is None:
+        return "Invalid payment method selected!", None
+
+    currency_id = ref.currency_ids.get(currency)
+    if currency_id is None:
+        return "Invalid currency selected!", None
+
+    return None, {
+        'purchase_date': purchase_date,
+        'category_id': category_id,
+        'method_id': method_id,
+        'item': item,
+        'amount': amount,
+        'currency_id': currency_id
+    }
+
+
+# CSV import columns; alternative header names map onto these
+IMPORT_COLUMNS = ('date', 'category', 'method', 'item', 'amount', 'currency')
+IMPORT_ALIASES = {'purchase_date': 'date', 'payment_method': 'method', 'category_name': 'category'}
+
+
+# Validate every CSV row and insert the valid ones for a trip in one transaction.
+# With skip_invalid off, a file with any bad row imports nothing.
+def import_expenses(c, trip_id, csv_file, skip_invalid=False):
+    ref = reference_data()
+    rates = rate_table(c, fresh=True)
+    report = {'rows': 0, 'imported': 0, 'errors': []}
+
+    reader = csv.reader(csv_file)
+    # Decoding and CSV syntax errors stop the import at the line they occur on
+    try:
+        header = next(reader, None)
+        if header is None:
+            report['errors'].append({'row': 1, 'error': 'The file is empty!'})
+            return report
+
+        header = [IMPORT_ALIASES.get(h.strip().lower(), h.strip().lower()) for h in header]
+        missing = [col for col in IMPORT_COLUMNS if col not in header]
+        if missing:
+            report['errors'].append({'row': 1, 'error': f"Missing column(s): {', '.join(missing)}"})
+            return report
+        positions = [header.index(col) for col in IMPORT_COLUMNS]
+
+        rows = []
+        for line_no, record in enumerate(reader, start=2):
+            if not any(field.strip() for field in record):
+                continue
+            report['rows'] += 1
+
+            if len(record) < len(header):
+                report['errors'].append({'row': line_no, 'error': 'Missing fields!'})
+                continue
+
+            purchase_date, category, method, item, amount_str, currency = (record[p].strip() for p in positions)
+            error, expense = validate_expense(
+                purchase_date, category.lower(), method.lower(), item.lower(), amount_str, currency.upper(), ref
+            )
+            if error:
+                report['errors'].append({'row': line_no, 'error': error})
+                continue
+
+            rows.append((
+                trip_id, expense['category_id'], expense['method_id'], expense['item'],
+                expense['amount'], expense['currency_id'], expense['purchase_date'],
+                base_amount_for(rates, expense['amount'], expense['currency_id'], expense['purchase_date'])
+            ))
+    except UnicodeDecodeError:
+        report['errors'].append({'row': reader.line_num + 1, 'error': 'The file is not UTF-8 encoded!'})
+        return report
+    except csv.Error as e:
+        report['errors'].append({'row': reader.line_num, 'error': f'Invalid CSV: {e}'})
+        return report
+
+    if report['errors'] and not skip_invalid:
+        return report
+
+    c.executemany('''
+        INSERT INTO expenses (trip_id, category_id, method_id, item, amount, currency_id, purchase_date, base_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+    # One trip_totals update for the whole batch
+    priced = [r[7] for r in rows if r[7] is not None]
+    adjust_trip_total(c, trip_id, sum(priced), len(priced))
+
+    report['imported'] = len(rows)
+    return report
 
 
 # register
@@ -219,8 +2964,8 @@ def is_strong_password(password):
 def register():
     errors = False
     
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
+    # Users always live in the main database
+    with get_db(DB_FILE) as conn:
         c = conn.cursor()
         
         if request.method == 'POST':
@@ -259,7 +3004,7 @@ def register():
             
             if not errors:
                 try:
-                    hashPass = generate_password_hash(password)
+                    hashPass = password_hasher.hash(password)
                     
                     c.execute('''
                             INSERT INTO users (username, password_hash) VALUES (?, ?)
@@ -284,8 +3029,20 @@ def register():
 def login():
     errors = False
     
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
+    # Drop floods from one address before they cost a password hash
+    if request.method == 'POST':
+        allowed, retry_after = login_limiter.take(
+            request.remote_addr, app.config['LOGIN_RATE_BURST'], app.config['LOGIN_RATE_PER_MINUTE']
+        )
+        if not allowed:
+            metrics.inc('accounting_login_throttled_total')
+            flash("Too many login attempts! Please try again later.", "error")
+            response = make_response(render_template('login.html', errors=True), 429)
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response
+    
+    # Users always live in the main database
+    with get_db(DB_FILE) as conn:
         c = conn.cursor()
         
         if request.method == 'POST':
@@ -300,35 +3057,41 @@ def login():
             elif not uiPassword:
                 flash("Password cannot be empty!", "error")
                 errors = True
-            else:
-                # Validate username
-                c.execute('''
-                       SELECT username FROM users WHERE username = ?
-                   ''', (uiUsername,))
-                dbUsername = c.fetchone()
-                
-                if not dbUsername:
-                    flash("Username not found!", "error")
-                    errors = True
             
             if not errors:
                 try:
-                    # get password
+                    # Validate username and get password
                     c.execute('''
                            SELECT id, password_hash 
                            FROM users 
                            WHERE username = ?
                        ''', (uiUsername,))
                     dbPassword = c.fetchone()
-                    user_id = dbPassword[0]
-                    pass_hashed = dbPassword[1]
                     
+                    if not dbPassword:
+                        flash("Username not found!", "error")
+                        errors = True
                 
-                    if check_password_hash(pass_hashed, uiPassword):
+                    elif password_hasher.verify(dbPassword[1], uiPassword):
+                        user_id = dbPassword[0]
+
+                        # Upgrade hashes made with older parameters while the password is at hand
+                        if password_hasher.needs_rehash(dbPassword[1]):
+                            c.execute(
+                                'UPDATE users SET password_hash = ? WHERE id = ?',
+                                (password_hasher.hash(uiPassword), user_id)
+                            )
+                            conn.commit()
+                            metrics.inc('accounting_password_rehash_total')
+
                         flash("Login successful!", "success")
                         session['user_id'] = user_id
                         session['username'] = uiUsername
 
+                        # Sharded mode: create or migrate this user's own database now
+                        if app.config['SHARD_DIR']:
+                            ensure_db(user_db_path(user_id))
+
                         return redirect(next_page or url_for('index'))
                     else:
                         flash("Wrong password!", "error")
@@ -354,7 +3117,7 @@ def logout():
 @app.route('/')
 @login_required
 def index():
-     with sqlite3.connect(DB_FILE) as conn:
+     with get_db() as conn:
         c = conn.cursor()
         
         countries = []
@@ -386,8 +3149,9 @@ def index():
 # tripSelection
 @app.route('/tripSelection', methods=['GET', 'POST'])
 @login_required
+@conditional_get(lambda args: ['global'])
 def tripSelection():
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_db() as conn:
         c = conn.cursor()
         
         countries = []
@@ -399,9 +3163,8 @@ def tripSelection():
         start_date = ''
         end_date = ''
         
-        # Fetch countries for dropdown
-        c.execute('SELECT * FROM countries')
-        for r in c.fetchall():
+        # Countries for dropdown
+        for r in reference_data().countries:
             countries.append({
                 'id': r[0],
                 'country_name': r[1],
@@ -455,49 +3218,27 @@ def tripSelection():
                 except sqlite3.IntegrityError:
                     flash(f'"{ui_trip_name}" already exists!', "error")
 
-        # Refresh trips after potential insertion
+        # Refresh trips after potential insertion; totals come from trip_totals
         c.execute('''
-                SELECT t.id, t.trip_name, t.start_date, t.end_date, c.country_code
+                SELECT t.id, t.trip_name, t.start_date, t.end_date, c.country_code,
+                       strftime('%w', t.start_date), strftime('%w', t.end_date),
+                       COALESCE(tt.total_in_base, 0)
                 FROM trips t
                 JOIN countries c ON t.country_id = c.id
-
+                LEFT JOIN trip_totals tt ON tt.trip_id = t.id
         ''')
-        trips_list = c.fetchall()
 
-        
-        # Calculate total expenses in base currency for each trip
-        trips_with_total = []
-        for trip in trips_list:
-            trip_start_date = trip[2]
-            trip_end_date = trip[3]
-            
-            # convert DB dates → datetime
-            start_dt = datetime.strptime(trip_start_date, "%Y-%m-%d")
-            end_dt = datetime.strptime(trip_end_date, "%Y-%m-%d")
-            
-            start_weekday = start_dt.strftime("%a")
-            end_weekday = end_dt.strftime("%a")
-            
-            trip_id = trip[0]
-            c.execute('''
-                SELECT SUM(e.amount * r.rate_to_base) 
-                FROM expenses e
-                JOIN exchange_rates r ON e.currency_id = r.currency_id
-                WHERE e.trip_id = ?
-            ''', (trip_id,))
-            
-            row = c.fetchone()
-            total_in_base = row[0] if row[0] is not None else 0
-            
+        trips_with_total = []
+        for trip in c.fetchall():
             trips_with_total.append({
-                'id': trip_id,
+                'id': trip[0],
                 'trip_name': trip[1],
                 'start_date': trip[2],
                 'end_date': trip[3],
-                'start_weekday': start_weekday,
-                'end_weekday': end_weekday,
+                'start_weekday': WEEKDAYS[int(trip[5])] if trip[5] else '',
+                'end_weekday': WEEKDAYS[int(trip[6])] if trip[6] else '',
                 'flag': country_flag(trip[4]),
-                'total_in_base': total_in_base
+                'total_in_base': trip[7]
             })
 
       
@@ -516,8 +3257,9 @@ def tripSelection():
 # newExpense
 @app.route('/newExpense', methods=['GET', 'POST'])
 @login_required
+@conditional_get(lambda args: ['trips', f"trip:{args.get('trip_id', type=int)}"])
 def newExpense():
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_db() as conn:
         c = conn.cursor()
         
         errors = False
@@ -527,7 +3269,6 @@ def newExpense():
         categories_list = []
         paymentMethods_list = []
         currencies_list = []
-        all_expenses = []
         
         category = ''
         payment_method = ''
@@ -540,7 +3281,7 @@ def newExpense():
         trips = [{'id': r[0], 'trip_name': r[1]} for r in c.fetchall()]
         
         trip_id = request.args.get('trip_id', type=int)
-        if request.method == 'POST':
+        if request.method == 'POST' and not trip_id:
             flash("Please select a trip before add a new expense!", "error")        
             
         if trip_id:
@@ -562,17 +3303,11 @@ def newExpense():
             else:
                 trip_name = start_date = trip_flag = None
         
-            # Fetch categories table for dropdown
-            c.execute('SELECT * FROM categories')
-            categories_list = c.fetchall()
-        
-            # Fetch paymentMethods table for dropdown
-            c.execute('SELECT * FROM paymentMethods')
-            paymentMethods_list = c.fetchall()
-        
-            # Fetch currencies table for dropdown
-            c.execute('SELECT * FROM currencies')
-            currencies_list = c.fetchall()
+            # Lookup tables for dropdowns (cached)
+            ref = reference_data()
+            categories_list = ref.categories
+            paymentMethods_list = ref.payment_methods
+            currencies_list = ref.currencies
         
             if request.method == 'POST':
             
@@ -583,119 +3318,66 @@ def newExpense():
                 amount_str = request.form.get('amount', '').strip()
                 currency = request.form.get('currency', '').strip()
             
-                # Validation
-                if not purchase_date:
-                    flash("Purchase date cannot be empty!", "error")
-                    errors = True
-                elif not category:
-                    flash("Category cannot be empty!", "error")
-                    errors = True
-                elif not payment_method:
-                    flash("Please select a payment method!", "error")
-                    errors = True
-                elif not item:
-                    flash("Item cannot be empty!", "error")
-                    errors = True
-                elif not amount_str:
-                    flash("Amount cannot be empty!", "error")
-                    errors = True
-                elif not currency:
-                    flash("Please select a currency!", "error")
+                # Validation (same rules as the CSV import)
+                error, expense = validate_expense(
+                    purchase_date, category, payment_method, item, amount_str, currency, ref
+                )
+                if error:
+                    flash(error, "error")
                     errors = True
-                else:
-                    # Validate "amount" input
-                    try:
-                        amount = round(float(amount_str), 2)  # 兩位小數
-                        if amount <= 0:
-                            flash("Amount must be greater than 0!", "error")
-                            errors = True
-                            
-                    except ValueError:
-                        flash("Invalid amount!", "error")
-                        errors = True
-            
-                if not errors:
-                
-                    # Get category ID
-                    c.execute('SELECT id FROM categories WHERE cat_name = ?', (category,))
-                    category_row = c.fetchone()
-                    if not category_row:
-                        flash("Invalid category selected!", "error")
-                        errors = True
-                        
-                    else:
-                        category_id = category_row[0]
-
-                    # Get payment method ID
-                    c.execute('SELECT id FROM paymentMethods WHERE method_name = ?', (payment_method,))
-                    payment_row = c.fetchone()
-                    if not payment_row:
-                        flash("Invalid payment method selected!", "error")
-                        errors = True
-                    else:
-                        payment_id = payment_row[0]
-
-                    # Get currency ID
-                    c.execute('SELECT id FROM currencies WHERE code = ?', (currency,))
-                    currency_row = c.fetchone()
-                    if not currency_row:
-                        flash("Invalid currency selected!", "error")
-                        errors = True
-                    else:
-                        currency_id = currency_row[0]
                 
+                if not errors:
                     # Ensure insert successfully or not
                     try:
-                        c.execute('''
-                            INSERT INTO expenses (trip_id, category_id, method_id, item, amount, currency_id, purchase_date)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                        ''', (trip_id, category_id, payment_id, item, amount, currency_id, purchase_date))
-                        
-                        conn.commit()
-                        flash("Expense added successfully!", "success")
+                        run_write(insert_expense, trip_id, expense)
+                        budget = budget_status(c, trip_id, expense['category_id'])
+                        if budget and budget['warning']:
+                            flash(f"Expense added, but: {budget['message']}", "error")
+                        elif budget:
+                            flash(f"Expense added successfully! {budget['remaining']:.2f} TWD left in the budget.", "success")
+                        else:
+                            flash("Expense added successfully!", "success")
                         return redirect(url_for('newExpense', trip_id=trip_id))
-                    
+                
                     except sqlite3.IntegrityError:
                         flash("Oh no! Something went wrong!", "error")
                         errors = True
-                        
-        # Fetch expenses only for selected trip
+                    
+        # First page of the selected trip's expenses, newest first
+        next_cursor = None
+        grouped_expenses = {}
+        expense_groups_html = ''
+
         if trip_id:
-            c.execute('''
-                SELECT e.id, e.purchase_date, c.cat_name, e.item, e.amount, cu.code, cu.symbol
-                FROM expenses e
-                JOIN categories c ON e.category_id = c.id
-                JOIN currencies cu ON e.currency_id = cu.id
-                WHERE trip_id = ? 
-                ORDER BY e.purchase_date DESC
-            ''', (trip_id,))
-            rows = c.fetchall()
+            def load_page():
+                expenses, next_cursor = fetch_expense_page(c, trip_id, descending=True)
+                grouped = {}
+                for e in expenses:
+                    grouped.setdefault(e['purchase_date'], []).append(e)
+                return grouped, next_cursor
 
-            for e in rows:
-                all_expenses.append({
-                'id': e[0],
-                'purchase_date': e[1],
-                'category': e[2],
-                'item': e[3],
-                'amount': e[4],
-                'code': e[5],
-                'symbol': e[6]
-                })
-    
-        grouped_expenses = {}
-    
-        for e in all_expenses:
-            date = e['purchase_date']
-            grouped_expenses.setdefault(date, []).append(e)
+            grouped_expenses, next_cursor = fragment_cache.get_or_set(
+                trip_cache_key(c, 'newExpense', trip_id), load_page
+            )
+            expense_groups_html = fragment_cache.get_or_set(
+                trip_cache_key(c, 'newExpense:html', trip_id, request.path),
+                lambda: render_expense_groups(
+                    grouped_expenses, 'date', trip_id, next_cursor, request.path,
+                    url_for('apiTripExpenses', trip_id=trip_id, order='desc')
+                )
+            )
     
     return render_template(
         'newExpense.html', 
         errors=errors,
+        expense_groups_html=expense_groups_html,
+        edit_options=reference_data() if trip_id else None,
         
         selected_trip=trip_id,
         row=row,
         trips=trips,
         grouped_expenses=grouped_expenses,
+        next_cursor=next_cursor,
         
         categories_list=categories_list,
         paymentMethods_list=paymentMethods_list,
@@ -712,6 +3394,7 @@ def newExpense():
 # viewExpense
 @app.route('/viewExpense')
 @login_required
+@conditional_get(lambda args: ['trips', f"trip:{args.get('trip_id', type=int)}"])
 def viewExpense():
     errors = False
     
@@ -725,6 +3408,8 @@ def viewExpense():
     
     trip = None
     payment_method = None
+    next_cursor = None
+    expense_groups_html = ''
     
     total_in_base = 0
 
@@ -735,7 +3420,7 @@ def viewExpense():
     selected_paymentMethod = request.args.get('payment_method')
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             c = conn.cursor()
 
             # Fetch all trips for dropdown
@@ -745,32 +3430,13 @@ def viewExpense():
             
             # Fetch for dropdown
             if trip_id:
-                # Fetch only purchase dates that exist for this trip
-                c.execute('''
-                    SELECT DISTINCT purchase_date
-                    FROM expenses
-                    WHERE trip_id = ?
-                    ORDER BY purchase_date
-                ''', (trip_id,))
-                dates = [r[0] for r in c.fetchall()]
-                
-                # Fetch all categoies that exist for this trip
-                c.execute('''
-                    SELECT DISTINCT c.cat_name
-                    FROM categories c
-                    JOIN expenses e ON e.category_id = c.id
-                    WHERE e.trip_id = ?
-                    ORDER BY c.order_index
-                ''', (trip_id,))
-                categories = [r[0] for r in c.fetchall()]
+                dates, categories = fragment_cache.get_or_set(
+                    trip_cache_key(c, 'viewExpense:filters', trip_id),
+                    lambda: trip_filter_options(c, trip_id)
+                )
                 
-                # Fetch all payment methods
-                c.execute('''
-                    SELECT method_name
-                    FROM paymentMethods 
-                    ORDER BY id
-                ''')
-                paymentMethods_list = [r[0] for r in c.fetchall()]
+                # All payment methods (cached)
+                paymentMethods_list = [r[1] for r in reference_data().payment_methods]
 
             if trip_id:
                 # Fetch trip info if user select a trip
@@ -807,47 +3473,30 @@ def viewExpense():
                     trip_id = None  # prevent further queries
 
             if trip_id:
-                # Filter expenses by trip and optionally by selected date
-                query = '''
-                    SELECT e.id, c.cat_name, e.item, e.amount, cu.code, cu.symbol, r.rate_to_base
-                    FROM expenses e
-                    JOIN categories c ON e.category_id = c.id
-                    JOIN currencies cu ON e.currency_id = cu.id
-                    JOIN exchange_rates r ON e.currency_id = r.currency_id
-                    JOIN paymentMethods p ON e.method_id = p.id
-                    WHERE e.trip_id = ?
-                '''
-                params = [trip_id]
-
-                if selected_date:
-                    query += ' AND e.purchase_date = ?'
-                    params.append(selected_date)
-                    
-                if selected_cat:
-                    query += ' AND c.cat_name = ? '
-                    params.append(selected_cat)
-                    
-                if selected_paymentMethod:
-                    query += ' AND p.method_name = ? '
-                    params.append(selected_paymentMethod)
-
-                query += ' ORDER BY c.order_index'
-
-                c.execute(query, params)
-                rows = c.fetchall()
-
-                for e in rows:
-                    expense = {
-                        'id': e[0],
-                        'category': e[1],
-                        'item': e[2],
-                        'amount': e[3],
-                        'code': e[4],
-                        'symbol': e[5]
-                    }
-                    expenses.append(expense)
-                    grouped_expenses.setdefault(e[1], []).append(expense)
-                    total_in_base += e[3] * e[6]  # sum in base currency
+                filters = (selected_date, selected_cat, selected_paymentMethod)
+
+                # First page of expenses matching the filters, grouped by category
+                def load_page():
+                    expenses, next_cursor = fetch_expense_page(c, trip_id, *filters)
+                    grouped = {}
+                    for expense in sorted(expenses, key=lambda e: e['category_order']):
+                        grouped.setdefault(expense['category'], []).append(expense)
+                    return expenses, grouped, next_cursor, filtered_trip_total(c, trip_id, *filters)
+
+                expenses, grouped_expenses, next_cursor, total_in_base = fragment_cache.get_or_set(
+                    trip_cache_key(c, 'viewExpense', trip_id, filters), load_page
+                )
+
+                expense_groups_html = fragment_cache.get_or_set(
+                    trip_cache_key(c, 'viewExpense:html', trip_id, request.full_path),
+                    lambda: render_expense_groups(
+                        grouped_expenses, 'category', trip_id, next_cursor, request.full_path,
+                        url_for('apiTripExpenses', trip_id=trip_id,
+                                purchase_date=selected_date or None,
+                                category_name=selected_cat or None,
+                                payment_method=selected_paymentMethod or None)
+                    )
+                )
 
     except NameError:
         flash("Category name not found.", "error")
@@ -857,6 +3506,7 @@ def viewExpense():
 
     return render_template(
         'viewExpense.html',
+        expense_groups_html=expense_groups_html,
 
         trips=trips,
         dates=dates,
@@ -872,8 +3522,11 @@ def viewExpense():
         selected_paymentMethod=selected_paymentMethod,
         
         expenses=expenses,
-        grouped_expenses=grouped_expenses
-        
+        grouped_expenses=grouped_expenses,
+        next_cursor=next_cursor,
+
+        # Lookup tables for the in-place edit form
+        edit_options=reference_data() if trip_id else None
     )
     
     
@@ -884,8 +3537,7 @@ def viewExpense():
 def editTrip(trip_id):
     errors = False
     
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
+    with get_db() as conn:
         c = conn.cursor()
         
         c.execute('''
@@ -942,10 +3594,11 @@ def editTrip(trip_id):
 @app.route('/deleteTrip/<int:trip_id>', methods=['POST'])
 @login_required
 def deleteTrip(trip_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
+    with get_db() as conn:
         c = conn.cursor()
         
+        c.execute('DELETE FROM trip_totals WHERE trip_id = ?', (trip_id,))
+
         # Delete trip and its related expenses (if you have a foreign key)
         c.execute('''
                 DELETE FROM trips 
@@ -960,8 +3613,7 @@ def deleteTrip(trip_id):
 @app.route('/editExpense/<int:trip_id>/<int:expense_id>', methods=['GET', 'POST'])
 @login_required
 def editExpense(trip_id, expense_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
+    with get_db() as conn:
         c = conn.cursor()
         
         next_url = request.args.get('next')  # Get the next page from query string
@@ -971,6 +3623,7 @@ def editExpense(trip_id, expense_id):
         
         errors = False
         expense_info = None
+        ref = reference_data()
         
         new_purchase_date = ''
         new_category = ''
@@ -1019,18 +3672,10 @@ def editExpense(trip_id, expense_id):
                     errors = True
             
             if not errors:
-               # Lookup IDs for foreign keys
-                c.execute('SELECT id FROM categories WHERE cat_name = ?', (new_category,))
-                category_row = c.fetchone()
-                category_id = category_row[0] if category_row else None
-
-                c.execute('SELECT id FROM paymentMethods WHERE method_name = ?', (new_payment_method,))
-                method_row = c.fetchone()
-                method_id = method_row[0] if method_row else None
-
-                c.execute('SELECT id FROM currencies WHERE code = ?', (new_currency,))
-                currency_row = c.fetchone()
-                currency_id = currency_row[0] if currency_row else None
+                # Lookup IDs for foreign keys
+                category_id = ref.category_ids.get(new_category)
+                method_id = ref.method_ids.get(new_payment_method)
+                currency_id = ref.currency_ids.get(new_currency)
 
                 # Make sure all IDs exist
                 if None in [category_id, method_id, currency_id]:
@@ -1039,29 +3684,19 @@ def editExpense(trip_id, expense_id):
 
                 if not errors:
                     # Now update the expense
-                    c.execute('''
-                        UPDATE expenses
-                        SET purchase_date = ?, category_id = ?, method_id = ?, item = ?, amount = ?, currency_id = ?
-                        WHERE id = ?
-                    ''', (new_purchase_date, category_id, method_id, new_item, new_amount, currency_id, expense_id))
-
-                    conn.commit()
+                    run_write(
+                        update_expense, expense_id, new_purchase_date, category_id, method_id,
+                        new_item, new_amount, currency_id
+                    )
                     flash("Expense updated successfully!", "success")
                     return redirect(next_url)
         
         
         
-        # Fetch categories table for dropdown
-        c.execute('SELECT * FROM categories ')
-        categories_list = c.fetchall()
-        
-        # Fetch paymentMethods table for dropdown
-        c.execute('SELECT * FROM paymentMethods')
-        paymentMethods_list = c.fetchall()
-        
-        # Fetch currencies table for dropdown
-        c.execute('SELECT * FROM currencies')
-        currencies_list = c.fetchall()
+        # Lookup tables for dropdowns (cached)
+        categories_list = ref.categories
+        paymentMethods_list = ref.payment_methods
+        currencies_list = ref.currencies
         
         if expense_id:
             c.execute('''
@@ -1098,33 +3733,484 @@ def editExpense(trip_id, expense_id):
 @app.route('/deleteExpense/<int:expense_id>', methods=['POST'])
 @login_required
 def deleteExpense(expense_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
+    # Delete expense
+    run_write(delete_expense, expense_id)
+
+    return redirect(request.referrer or url_for('tripSelection'))
+
+# Paginated expenses of a trip as JSON; takes the viewExpense filters plus cursor/limit/order
+@app.route('/api/trips/<int:trip_id>/expenses')
+@login_required
+def apiTripExpenses(trip_id):
+    limit = request.args.get('limit', app.config['EXPENSES_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['EXPENSES_PAGE_MAX']))
+
+    cursor = request.args.get('cursor')
+    position = decode_cursor(cursor) if cursor else None
+    if cursor and position is None:
+        return jsonify(error='Invalid cursor.'), 400
+
+    with get_db() as conn:
         c = conn.cursor()
-        
-        # Delete expense
-        c.execute('DELETE FROM expenses WHERE id = ?', (expense_id,))
+
+        c.execute('SELECT 1 FROM trips WHERE id = ?', (trip_id,))
+        if not c.fetchone():
+            return jsonify(error='Trip not found.'), 404
+
+        expenses, next_cursor = fetch_expense_page(
+            c, trip_id,
+            request.args.get('purchase_date'),
+            request.args.get('category_name'),
+            request.args.get('payment_method'),
+            cursor=position,
+            limit=limit,
+            descending=request.args.get('order') == 'desc'
+        )
+
+    for e in expenses:
+        e['edit_url'] = url_for('editExpense', trip_id=trip_id, expense_id=e['id'])
+        e['delete_url'] = url_for('deleteExpense', expense_id=e['id'])
+
+    return jsonify(trip_id=trip_id, expenses=expenses, next_cursor=next_cursor)
+
+
+# Add / edit / delete without a page reload: each answers with just the affected expense and
+# the trip's total (for the viewExpense filters passed in the query string), which
+# static/js/expenseUpdates.js patches into the page
+
+# The expense form's fields, from a JSON body or a form post
+def expense_form_fields():
+    data = request.get_json(silent=True) or request.form
+    return [
+        str(data.get(name, '')).strip()
+        for name in ('purchase_date', 'category', 'payment_method', 'item', 'amount', 'currency')
+    ]
+
+
+def expense_change_json(c, trip_id, expense=None, **extra):
+    if expense is not None:
+        expense['edit_url'] = url_for('editExpense', trip_id=trip_id, expense_id=expense['id'])
+        expense['delete_url'] = url_for('deleteExpense', expense_id=expense['id'])
+
+    total = filtered_trip_total(
+        c, trip_id,
+        request.args.get('purchase_date'),
+        request.args.get('category_name'),
+        request.args.get('payment_method')
+    )
+    return dict(extra, expense=expense, trip={'id': trip_id, 'total_in_base': round(total, 2)})
+
+
+@app.route('/api/trips/<int:trip_id>/expenses', methods=['POST'])
+@login_required
+def apiCreateExpense(trip_id):
+    with get_db() as conn:
+        c = conn.cursor()
+
+        c.execute('SELECT 1 FROM trips WHERE id = ?', (trip_id,))
+        if not c.fetchone():
+            return jsonify(error='Trip not found.'), 404
+
+        purchase_date, category, payment_method, item, amount_str, currency = expense_form_fields()
+        error, expense = validate_expense(
+            purchase_date, category, payment_method, item.lower(), amount_str, currency, reference_data()
+        )
+        if error:
+            return jsonify(error=error), 400
+
+        try:
+            expense_id = run_write(insert_expense, trip_id, expense)
+        except sqlite3.IntegrityError:
+            return jsonify(error='Oh no! Something went wrong!'), 409
+
+        trip_id, created = fetch_expense(c, expense_id)
+        budget = budget_status(c, trip_id, expense['category_id'])
+        return jsonify(expense_change_json(c, trip_id, created, budget=budget)), 201
+
+
+@app.route('/api/expenses/<int:expense_id>', methods=['PATCH', 'DELETE'])
+@login_required
+def apiChangeExpense(expense_id):
+    with get_db() as conn:
+        c = conn.cursor()
+
+        found = fetch_expense(c, expense_id)
+        if not found:
+            return jsonify(error='Expense not found.'), 404
+        trip_id, old = found
+
+        if request.method == 'DELETE':
+            try:
+                run_write(delete_expense, expense_id)
+            except sqlite3.IntegrityError:
+                return jsonify(error='Oh no! Something went wrong!'), 409
+            return jsonify(expense_change_json(c, trip_id, deleted=old))
+
+        # Same normalisation as a new expense
+        purchase_date, category, payment_method, item, amount_str, currency = expense_form_fields()
+        error, expense = validate_expense(
+            purchase_date, category, payment_method, item.lower(), amount_str, currency, reference_data()
+        )
+        if error:
+            return jsonify(error=error), 400
+
+        try:
+            run_write(
+                update_expense, expense_id, expense['purchase_date'], expense['category_id'], expense['method_id'],
+                expense['item'], expense['amount'], expense['currency_id']
+            )
+        except sqlite3.IntegrityError:
+            return jsonify(error='Oh no! Something went wrong!'), 409
+
+        trip_id, updated = fetch_expense(c, expense_id)
+        budget = budget_status(c, trip_id, expense['category_id'])
+        return jsonify(expense_change_json(c, trip_id, updated, previous=old, budget=budget))
+
+
+# Per-day / category / method totals of a trip as JSON; takes the viewExpense filters
+@app.route('/api/trips/<int:trip_id>/summary')
+@login_required
+def apiTripSummary(trip_id):
+    with get_db() as conn:
+        c = conn.cursor()
+
+        c.execute('SELECT 1 FROM trips WHERE id = ?', (trip_id,))
+        if not c.fetchone():
+            return jsonify(error='Trip not found.'), 404
+
+        summary = trip_summary(
+            c, trip_id,
+            request.args.get('purchase_date'),
+            request.args.get('category_name'),
+            request.args.get('payment_method')
+        )
+
+    return jsonify(summary)
+
+
+# Burn rate, running totals, category shares, item cost percentiles and projected spend of a
+# trip as JSON; ?today=YYYY-MM-DD projects from another day
+@app.route('/api/trips/<int:trip_id>/stats')
+@login_required
+def apiTripStats(trip_id):
+    try:
+        today = date.fromisoformat(request.args['today']) if 'today' in request.args else date.today()
+    except ValueError:
+        return jsonify(error='Invalid date format!'), 400
+
+    with get_db() as conn:
+        c = conn.cursor()
+
+        c.execute('SELECT start_date, end_date FROM trips WHERE id = ?', (trip_id,))
+        trip = c.fetchone()
+        if not trip:
+            return jsonify(error='Trip not found.'), 404
+
+        stats = fragment_cache.get_or_set(
+            trip_cache_key(c, 'apiTripStats', trip_id, today.isoformat()),
+            lambda: trip_stats(c, trip_id, trip[0], trip[1], today.isoformat())
+        )
+
+    return jsonify(stats)
+
+
+# All trips side by side: totals, burn rate, projection and biggest category
+@app.route('/trips/compare')
+@login_required
+def compareTrips():
+    with get_db() as conn:
+        c = conn.cursor()
+        trips = compare_trips(c, date.today().isoformat())
+
+    return render_template('compareTrips.html', trips=trips, today=date.today().isoformat())
+
+
+# Budgets of every trip, from the running totals; the forms post to setBudget
+@app.route('/budgets')
+@login_required
+def budgetsOverview():
+    with get_db() as conn:
+        c = conn.cursor()
+        trips = budget_overview(c)
+
+    return render_template('budgets.html', trips=trips, categories_list=reference_data().categories)
+
+
+# Set or clear one budget: category empty = the whole trip, amount empty = remove it
+@app.route('/budgets/<int:trip_id>', methods=['POST'])
+@login_required
+def setBudget(trip_id):
+    with get_db() as conn:
+        c = conn.cursor()
+
+        c.execute('SELECT 1 FROM trips WHERE id = ?', (trip_id,))
+        if not c.fetchone():
+            flash("Trip not found!", "error")
+            return redirect(url_for('budgetsOverview'))
+
+        category = request.form.get('category', '').strip()
+        amount_str = request.form.get('amount', '').strip()
+
+        category_id = None
+        if category:
+            category_id = reference_data().category_ids.get(category)
+            if category_id is None:
+                flash("Invalid category selected!", "error")
+                return redirect(url_for('budgetsOverview'))
+
+        amount = None
+        if amount_str:
+            try:
+                amount = round(float(amount_str), 2)
+            except ValueError:
+                flash("Invalid amount!", "error")
+                return redirect(url_for('budgetsOverview'))
+            if not amount > 0:
+                flash("Amount must be greater than 0!", "error")
+                return redirect(url_for('budgetsOverview'))
+
+        run_write(set_budget, trip_id, category_id, amount)
+        flash("Budget saved!" if amount else "Budget removed!", "success")
+
+    return redirect(url_for('budgetsOverview'))
+
+
+# Item search across trips: q (words, last one as a prefix), trip_id, date_from, date_to, limit
+@app.route('/search')
+@login_required
+def search():
+    text = request.args.get('q', '').strip()
+    if not search_match_query(text):
+        return jsonify(error='Enter something to search for.'), 400
+
+    limit = request.args.get('limit', app.config['SEARCH_LIMIT'], type=int)
+    limit = max(1, min(limit, app.config['SEARCH_LIMIT_MAX']))
+
+    with get_db() as conn:
+        results = search_expenses(
+            conn.cursor(), text,
+            trip_id=request.args.get('trip_id', type=int),
+            date_from=request.args.get('date_from'),
+            date_to=request.args.get('date_to'),
+            limit=limit
+        )
+
+    for e in results:
+        e['edit_url'] = url_for('editExpense', trip_id=e['trip_id'], expense_id=e['id'])
+
+    return jsonify(query=text, results=results)
+
+
+# Columns of the CSV / NDJSON exports
+EXPORT_COLUMNS = (
+    'id', 'trip_id', 'trip_name', 'purchase_date', 'category', 'payment_method',
+    'item', 'amount', 'currency', 'rate_to_base', 'amount_in_base'
+)
+
+
+# Yields export rows as dicts, reading the cursor in fetchmany() batches
+def iter_export_rows(c, trip_id=None):
+    ref = reference_data()
+    rates = rate_table(c)
+    query = '''
+        SELECT e.id, e.trip_id, t.trip_name, e.purchase_date, e.category_id, e.method_id,
+               e.item, e.amount, e.currency_id, e.base_amount
+        FROM expenses e
+        JOIN trips t ON e.trip_id = t.id
+    '''
+    params = []
+    if trip_id is not None:
+        query += ' WHERE e.trip_id = ?'
+        params.append(trip_id)
+    query += ' ORDER BY e.trip_id, e.purchase_date, e.id'
+
+    c.execute(query, params)
+    while True:
+        rows = c.fetchmany(app.config['EXPORT_BATCH_SIZE'])
+        if not rows:
+            break
+        for e in rows:
+            rate = rates.rate_on(e[8], e[3])
+            yield {
+                'id': e[0],
+                'trip_id': e[1],
+                'trip_name': e[2],
+                'purchase_date': e[3],
+                'category': ref.category_by_id.get(e[4], (None, ''))[1],
+                'payment_method': ref.method_by_id.get(e[5], (None, ''))[1],
+                'item': e[6],
+                'amount': e[7],
+                'currency': ref.currency_by_id.get(e[8], (None, ''))[1],
+                'rate_to_base': rate,
+                'amount_in_base': round(e[9], 2) if e[9] is not None else None
+            }
+
+
+# Encodes export rows as CSV, one chunk per batch
+def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+
+    batch = app.config['EXPORT_BATCH_SIZE']
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if i % batch == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# Encodes export rows as newline-delimited JSON, one chunk per batch
+def ndjson_chunks(rows):
+    lines = []
+    batch = app.config['EXPORT_BATCH_SIZE']
+    for row in rows:
+        lines.append(json.dumps(row, ensure_ascii=False))
+        if len(lines) >= batch:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+# Streaming export of one trip (or all trips) as CSV or NDJSON
+@app.route('/export/all.<any(csv, ndjson):fmt>')
+@app.route('/export/<int:trip_id>.<any(csv, ndjson):fmt>')
+@login_required
+def exportExpenses(fmt, trip_id=None):
+    c = get_db().cursor()
+
+    if trip_id is not None:
+        c.execute('SELECT 1 FROM trips WHERE id = ?', (trip_id,))
+        if not c.fetchone():
+            abort(404)
+
+    rows = iter_export_rows(c, trip_id)
+    if fmt == 'csv':
+        chunks, mimetype = csv_chunks(rows), 'text/csv'
+    else:
+        chunks, mimetype = ndjson_chunks(rows), 'application/x-ndjson'
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    scope = f'trip_{trip_id}' if trip_id is not None else 'all_trips'
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename="expenses_{scope}_{timestamp}.{fmt}"',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+# Bulk CSV import (date, category, method, item, amount, currency) into one trip
+@app.route('/importExpenses/<int:trip_id>', methods=['POST'])
+@login_required
+def importExpenses(trip_id):
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    upload = request.files.get('file')
+
+    if not upload or not upload.filename:
+        if wants_json:
+            return jsonify(error='No file uploaded.'), 400
+        flash("Please choose a CSV file to import!", "error")
+        return redirect(url_for('newExpense', trip_id=trip_id))
+
+    with get_db() as conn:
+        c = conn.cursor()
+
+        c.execute('SELECT 1 FROM trips WHERE id = ?', (trip_id,))
+        if not c.fetchone():
+            if wants_json:
+                return jsonify(error='Trip not found.'), 404
+            flash("Trip not found.", "error")
+            return redirect(url_for('newExpense'))
+
+        csv_file = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        report = import_expenses(c, trip_id, csv_file, skip_invalid=bool(request.form.get('skip_invalid')))
         conn.commit()
 
-    return redirect(request.referrer or url_for('tripSelection'))
+    if wants_json:
+        return jsonify(report), 200 if report['imported'] or not report['errors'] else 422
+
+    if report['errors']:
+        shown = '; '.join(f"row {e['row']}: {e['error']}" for e in report['errors'][:5])
+        more = len(report['errors']) - 5
+        if more > 0:
+            shown += f'; and {more} more'
+        flash(f"Imported {report['imported']} of {report['rows']} rows. {shown}", "error")
+    else:
+        flash(f"Imported {report['imported']} expenses!", "success")
+    return redirect(url_for('newExpense', trip_id=trip_id))
+
+
+# Prometheus scrape endpoint (per worker process)
+@app.route('/metrics')
+def metricsEndpoint():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Connection pool statistics for this worker
+@app.route('/api/db/pool')
+@login_required
+def poolStats():
+    return jsonify(db_pool.stats())
+
 
+# Consistent, compressed snapshot of the live database (gzip by default, ?compression=zstd)
 @app.route('/downloadBackup')
 @login_required
 def downloadBackup():
-    db_path = DB_FILE
-
-    if not os.path.exists(db_path):
+    # The signed-in user's own file in sharded mode
+    source_path = current_db_path()
+    if not os.path.exists(source_path):
         abort(404)
 
+    compression = request.args.get('compression', 'gzip')
+    if compression not in BACKUP_COMPRESSORS:
+        abort(400)
+
+    workdir = tempfile.mkdtemp(prefix='expense_backup_')
+    try:
+        snapshot_path = os.path.join(workdir, 'snapshot.db')
+        snapshot_db(snapshot_path, source_path)
+
+        archive_path = snapshot_path + BACKUP_COMPRESSORS[compression][0]
+        checksum = compress_file(snapshot_path, archive_path, compression)
+        size = os.path.getsize(archive_path)
+    except Exception:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+
+    def chunks():
+        with open(archive_path, 'rb') as f:
+            while True:
+                chunk = f.read(BACKUP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_name = f'expense_backup_{timestamp}.db'
+    backup_name = f'expense_backup_{timestamp}.db{BACKUP_COMPRESSORS[compression][0]}'
 
-    return send_file(
-        db_path,
-        as_attachment=True,
-        download_name=backup_name,
-        mimetype='application/octet-stream'
+    response = Response(
+        chunks(),
+        mimetype=BACKUP_COMPRESSORS[compression][1],
+        headers={
+            'Content-Disposition': f'attachment; filename="{backup_name}"',
+            'Content-Length': str(size),
+            'X-Backup-SHA256': checksum
+        }
     )
+    # The server closes every response, including HEADs and downloads that never start
+    response.call_on_close(lambda: shutil.rmtree(workdir, ignore_errors=True))
+    return response
     
 # A helper to generate emoji flags
 def country_flag(code):
@@ -1133,8 +4219,243 @@ def country_flag(code):
     return chr(0x1F1E6 + ord(code[0].upper()) - 65) + \
            chr(0x1F1E6 + ord(code[1].upper()) - 65)
 
-    
-    
+
+# Database file a maintenance command works on: a user's own file when sharded
+def command_db_path(user_id):
+    if user_id is None:
+        return DB_FILE
+    if not app.config['SHARD_DIR']:
+        raise click.ClickException('--user needs SHARD_DIR to be set.')
+    path = user_db_path(user_id)
+    if not os.path.exists(path):
+        raise click.ClickException(f'User {user_id} has no database yet.')
+    ensure_db(path)
+    return path
+
+
+user_option = click.option('--user', 'user_id', type=int, help="Work on this user's database (sharded mode).")
+
+
+# flask --app wsgi trip-totals [--rebuild] [--user 3]
+@app.cli.command('trip-totals')
+@click.option('--rebuild', is_flag=True, help='Rewrite stored totals from the expenses table.')
+@user_option
+def trip_totals_command(rebuild, user_id):
+    """Verify stored trip totals against the expenses table."""
+    with get_db(command_db_path(user_id)) as conn:
+        c = conn.cursor()
+
+        expected = compute_trip_totals(c)
+        c.execute('SELECT trip_id, total_in_base, expense_count FROM trip_totals')
+        stored = {r[0]: (r[1], r[2]) for r in c.fetchall()}
+
+        drifted = 0
+        for trip_id, (total, count) in expected.items():
+            stored_total, stored_count = stored.get(trip_id, (0, 0))
+            if abs(stored_total - total) > TOTAL_DRIFT_TOLERANCE or stored_count != count:
+                drifted += 1
+                click.echo(
+                    f'trip {trip_id}: stored {stored_total:.2f} ({stored_count} expenses), '
+                    f'expected {total:.2f} ({count} expenses)'
+                )
+
+        orphans = set(stored) - set(expected)
+        for trip_id in sorted(orphans):
+            click.echo(f'trip {trip_id}: total stored for a trip that no longer exists')
+
+        if rebuild:
+            if orphans:
+                c.executemany('DELETE FROM trip_totals WHERE trip_id = ?', [(t,) for t in orphans])
+            rebuild_trip_totals(c)
+            conn.commit()
+            click.echo(f'Rebuilt totals for {len(expected)} trips.')
+        elif drifted or orphans:
+            raise SystemExit(1)
+        else:
+            click.echo(f'All {len(expected)} trip totals are up to date.')
+
+
+# flask --app wsgi rebuild-search [--user 3]
+@app.cli.command('rebuild-search')
+@user_option
+def rebuild_search_command(user_id):
+    """Repopulate the item search index from the expenses table."""
+    with get_db(command_db_path(user_id)) as conn:
+        c = conn.cursor()
+        started = time.perf_counter()
+        c.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+        c.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('optimize')")
+        conn.commit()
+
+        c.execute('SELECT COUNT(*) FROM expenses')
+        click.echo(f'Indexed {c.fetchone()[0]} expenses in {time.perf_counter() - started:.2f}s.')
+
+
+# flask --app wsgi snapshot [--user 3] (run it from cron / a systemd timer)
+@app.cli.command('snapshot')
+@click.option('--compression', type=click.Choice(sorted(BACKUP_COMPRESSORS)), default='gzip')
+@user_option
+def snapshot_command(compression, user_id):
+    """Write a compressed snapshot to BACKUP_DIR and apply the retention policy."""
+    if user_id is None:
+        archive_path, checksum, removed = write_local_snapshot(compression)
+    else:
+        archive_path, checksum, removed = write_local_snapshot(
+            compression, command_db_path(user_id), f'user_{user_id}_backup_'
+        )
+    click.echo(f'Wrote {archive_path} (sha256 {checksum}).')
+    for name in removed:
+        click.echo(f'Removed old snapshot {name}.')
+
+
+# flask --app wsgi build-assets (run it on deploy, before the workers start)
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Write content-hashed, precompressed copies of static/ and their manifest."""
+    if not app.config['ASSET_DIR']:
+        raise click.ClickException('ASSET_DIR is not set.')
+    files = asset_manifest.build()
+    for filename, hashed in sorted(files.items()):
+        click.echo(f'{filename} -> {hashed} ({", ".join(asset_manifest.encodings[hashed]) or "uncompressed"})')
+
+
+# flask --app wsgi import-expenses 3 expenses.csv [--skip-invalid] [--user 3]
+@app.cli.command('import-expenses')
+@click.argument('trip_id', type=int)
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--skip-invalid', is_flag=True, help='Import the valid rows even if some rows have errors.')
+@user_option
+def import_expenses_command(trip_id, csv_path, skip_invalid, user_id):
+    """Import expenses for a trip from a CSV file in one transaction."""
+    with get_db(command_db_path(user_id)) as conn:
+        c = conn.cursor()
+
+        c.execute('SELECT 1 FROM trips WHERE id = ?', (trip_id,))
+        if not c.fetchone():
+            raise click.ClickException(f'Trip {trip_id} not found.')
+
+        started = time.perf_counter()
+        with open(csv_path, encoding='utf-8-sig', newline='') as f:
+            report = import_expenses(c, trip_id, f, skip_invalid)
+        conn.commit()
+
+    for e in report['errors']:
+        click.echo(f"row {e['row']}: {e['error']}")
+    click.echo(
+        f"Imported {report['imported']} of {report['rows']} rows "
+        f"in {time.perf_counter() - started:.2f}s."
+    )
+    if report['errors'] and not report['imported']:
+        raise SystemExit(1)
+
+
+# flask --app wsgi set-rate JPY 0.21 [--date 2025-01-01] [--no-wait]
+@app.cli.command('set-rate')
+@click.argument('code')
+@click.argument('rate', type=float)
+@click.option('--date', 'effective_date', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='First day the rate applies (default today).')
+@click.option('--no-wait', is_flag=True, help="Leave re-pricing to the running app's background workers.")
+def set_rate_command(code, rate, effective_date, no_wait):
+    """Record a currency's rate to the base currency from a date on."""
+    effective_date = (effective_date.date() if effective_date else date.today()).isoformat()
+
+    # Rates are copied into every database file when sharded. Each file takes the rate in
+    # an open transaction and none is committed until all of them have accepted it.
+    written = []
+    try:
+        for path in database_paths():
+            ensure_db(path)
+            conn = get_db(path)
+            written.append((path, conn))
+            if not set_exchange_rate(conn.cursor(), code.upper(), rate, effective_date):
+                raise click.ClickException(f'Unknown currency "{code}" in {path}.')
+    except Exception:
+        for path, conn in written:
+            conn.rollback()
+        raise
+
+    # DB_FILE last: the background workers only look at the shards once its job is visible
+    for path, conn in reversed(written):
+        conn.commit()
+
+    if not no_wait:
+        for path, conn in written:
+            click.echo(f'{path}: re-priced {run_recompute_jobs(conn)} expenses.')
+
+    click.echo(f'{code.upper()} rate set to {rate} from {effective_date}.')
+
+
+# flask --app wsgi recompute-base
+@app.cli.command('recompute-base')
+def recompute_base_command():
+    """Finish any queued re-pricing of expenses after rate changes."""
+    for path in database_paths():
+        ensure_db(path)
+        with get_db(path) as conn:
+            click.echo(f'{path}: re-priced {run_recompute_jobs(conn)} expenses.')
+
+
+
+# Configures the app from ACCOUNTING_* environment variables (JSON values are parsed, e.g.
+# ACCOUNTING_WRITE_QUEUE=true) and then from config, and does the start-up work before
+# gunicorn --preload forks: schema check, compiled templates and warm lookup-table caches.
+# Routes live on the module-level app, so this configures and returns that one app; call it
+# once per process (wsgi.py does). A later call, e.g. from tests, repoints the same app and
+# closes the connection pool and hashing threads it replaces.
+def create_app(config=None):
+    global DB_FILE, db_pool, password_hasher
+    started = time.perf_counter()
+
+    app.config.from_prefixed_env('ACCOUNTING')
+    if config:
+        app.config.update(config)
+    DB_FILE = app.config['DATABASE']
+
+    # Objects sized from config, built fresh so nothing stays tied to a previous database
+    db_pool.close()
+    db_pool = ConnectionPool(app.config['SQLITE_POOL_SIZE'], app.config['SQLITE_POOL_MAX_IDLE'])
+    password_hasher.shutdown()
+    password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
+    fragment_cache.clear()
+
+    # Behind reverse proxies, take the client address from their headers (wrapped once)
+    if app.config['PROXY_FIX_X_FOR'] and not isinstance(app.wsgi_app, ProxyFix):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'], x_proto=app.config['PROXY_FIX_X_FOR'])
+
+    # Schema check (skipped by workers forked from an app that already ran it)
+    ensure_db(DB_FILE)
+
+    # Compile every template now; workers share them and restarts reuse the bytecode
+    if app.config['JINJA_CACHE_DIR']:
+        cache_dir = os.path.join(app.root_path, app.config['JINJA_CACHE_DIR'])
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    # Hashed static assets; on a read-only deploy, use the manifest from `flask build-assets`
+    if app.config['ASSET_DIR']:
+        try:
+            asset_manifest.build()
+        except OSError:
+            if not asset_manifest.load():
+                raise
+    else:
+        asset_manifest.use({}, {})
+
+    # Lookup tables and rates of the main database (each shard warms on first use)
+    conn = connect_db()
+    try:
+        c = conn.cursor()
+        reference_cache.get(c, fresh=True)
+        rate_cache.get(c, fresh=True)
+    finally:
+        conn.close()
+
+    app.logger.info('App ready in %.0f ms', (time.perf_counter() - started) * 1000)
+    return app
+
+
 if __name__ == '__main__':
-    init_db()
-    app.run(debug=True)
+    create_app().run(debug=True)
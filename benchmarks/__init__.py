@@ -0,0 +1,4 @@
+# Benchmarks for the accounting app.
+#
+#   python -m benchmarks.run --trips 50 --expenses 100000 --out baseline.json
+#   python -m benchmarks.run --trips 50 --expenses 100000 --compare baseline.json
@@ -0,0 +1,108 @@
+# Seeded synthetic dataset for benchmarks: fills the real schema (from create_app)
+# with N trips and M expenses spread over currencies, categories and methods.
+import argparse
+import random
+import sqlite3
+from datetime import date, timedelta
+
+ITEMS = (
+    'ramen', 'sushi', 'coffee', 'taxi', 'subway', 'bus', 'hotel', 'hostel', 'museum',
+    'temple', 'souvenir', 'snacks', 'train', 'ferry', 'beer', 'breakfast', 'dinner',
+    'lunch', 'market', 'tour', 'tickets', 'sim card', 'laundry', 'pharmacy'
+)
+
+# Rough spread of amounts per currency so base-currency totals look realistic
+AMOUNT_RANGES = {
+    'NTD': (50, 3000),
+    'JPY': (200, 30000),
+    'KRW': (2000, 200000),
+    'VND': (20000, 2000000),
+    'USD': (2, 300),
+    'EUR': (2, 300),
+    'GBP': (2, 300)
+}
+
+
+def generate(db_path, trips=20, expenses=10000, seed=1):
+    """Create (or extend) db_path with the app schema and synthetic data."""
+    import app as accounting
+
+    # Configures the app for db_path and brings its schema up to date
+    accounting.create_app({'DATABASE': db_path})
+
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    try:
+        c = conn.cursor()
+        countries = [r[0] for r in c.execute('SELECT id FROM countries')]
+        categories = [r[0] for r in c.execute('SELECT id FROM categories')]
+        methods = [r[0] for r in c.execute('SELECT id FROM paymentMethods')]
+        currencies = list(c.execute('SELECT id, code FROM currencies'))
+        rates = accounting.rate_table(c)
+
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM trips')
+        first_trip = c.fetchone()[0] + 1
+
+        trip_rows = []
+        for n in range(trips):
+            start = date(2020, 1, 1) + timedelta(days=rng.randrange(0, 5 * 365))
+            end = start + timedelta(days=rng.randrange(2, 30))
+            trip_rows.append((f'bench trip {first_trip + n}', start.isoformat(), end.isoformat(), rng.choice(countries)))
+        c.executemany('INSERT INTO trips (trip_name, start_date, end_date, country_id) VALUES (?, ?, ?, ?)', trip_rows)
+
+        c.execute('SELECT id, start_date, end_date FROM trips WHERE id >= ?', (first_trip,))
+        trip_ranges = [(r[0], date.fromisoformat(r[1]), (date.fromisoformat(r[2]) - date.fromisoformat(r[1])).days) for r in c.fetchall()]
+
+        # A few long trips and many short ones, like real usage
+        weights = [rng.paretovariate(1.2) for _ in trip_ranges]
+
+        batch = []
+        for _ in range(expenses):
+            trip_id, start, days = rng.choices(trip_ranges, weights)[0]
+            currency_id, code = rng.choice(currencies)
+            low, high = AMOUNT_RANGES.get(code, (1, 1000))
+            amount = round(rng.uniform(low, high), 2)
+            purchase_date = (start + timedelta(days=rng.randint(0, days))).isoformat()
+            batch.append((
+                trip_id,
+                rng.choice(categories),
+                rng.choice(methods),
+                rng.choice(ITEMS),
+                amount,
+                currency_id,
+                purchase_date,
+                accounting.base_amount_for(rates, amount, currency_id, purchase_date)
+            ))
+            if len(batch) >= 10000:
+                insert_expenses(c, batch)
+                batch = []
+        insert_expenses(c, batch)
+
+        accounting.rebuild_trip_totals(c)
+        conn.commit()
+        c.execute('ANALYZE')
+    finally:
+        conn.close()
+
+
+def insert_expenses(c, rows):
+    c.executemany('''
+        INSERT INTO expenses (trip_id, category_id, method_id, item, amount, currency_id, purchase_date, base_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic expenses database.')
+    parser.add_argument('db_path')
+    parser.add_argument('--trips', type=int, default=20)
+    parser.add_argument('--expenses', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    generate(args.db_path, args.trips, args.expenses, args.seed)
+    print(f'Wrote {args.trips} trips and {args.expenses} expenses to {args.db_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+# Benchmark runner: drives the hot routes through the Flask test client and the
+# underlying SQL directly, then records latency percentiles, query counts and
+# peak memory to JSON, optionally comparing against a stored baseline.
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.datagen import generate
+
+
+# Counts the statements the app executes itself, through the same hook as its per-request
+# SQL counter; a trace callback would also see SQL run inside triggers and FTS5
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement):
+        # Statements run by the pragmas on connect are not part of a request
+        if not str(statement).startswith('PRAGMA'):
+            self.count += 1
+
+    def install(self, accounting):
+        record_sql = accounting.record_sql
+
+        def counting_record_sql(statement, elapsed, executed=True):
+            if executed:
+                self(statement)
+            record_sql(statement, elapsed, executed)
+
+        accounting.record_sql = counting_record_sql
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(fn, repeat, warmup, counter):
+    for _ in range(warmup):
+        fn()
+
+    timings = []
+    queries = []
+    for _ in range(repeat):
+        counter.count = 0
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+        queries.append(counter.count)
+
+    # Peak memory in a separate call so tracemalloc doesn't skew the timings
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p90_ms': round(percentile(timings, 90), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'queries': max(queries),
+        'peak_kib': round(peak / 1024, 1)
+    }
+
+
+def scenarios(accounting, client, db_path, counter):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+
+    # The trip with the most expenses is the worst case for per-trip pages
+    c.execute('SELECT trip_id FROM expenses GROUP BY trip_id ORDER BY COUNT(*) DESC LIMIT 1')
+    big_trip = c.fetchone()[0]
+    c.execute('SELECT MIN(purchase_date) FROM expenses WHERE trip_id = ?', (big_trip,))
+    some_date = c.fetchone()[0]
+
+    # Trip and meals budgets on the big trip, so expense writes also update their running totals
+    for category, amount in (('', '1000000'), ('meals', '100000')):
+        response = client.post(f'/budgets/{big_trip}', data={'category': category, 'amount': amount}, follow_redirects=True)
+        assert response.status_code == 200, response.status_code
+
+    def get(url):
+        def run():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+        return run
+
+    # Repeat view of an unchanged trip page (answered with 304)
+    def get_unchanged(url):
+        etag = client.get(url).headers['ETag']
+
+        def run():
+            response = client.get(url, headers={'If-None-Match': etag})
+            assert response.status_code == 304, (url, response.status_code)
+        return run
+
+    def post_expense():
+        response = client.post(f'/newExpense?trip_id={big_trip}', data={
+            'purchase_date': some_date,
+            'category': 'meals',
+            'payment_method': 'cash',
+            'item': 'benchmark',
+            'amount': '123.45',
+            'currency': 'JPY'
+        })
+        assert response.status_code == 302, response.status_code
+
+    # The same expense added through the JSON endpoint the Add Expense page uses
+    def post_expense_api():
+        response = client.post(f'/api/trips/{big_trip}/expenses', data={
+            'purchase_date': some_date,
+            'category': 'meals',
+            'payment_method': 'cash',
+            'item': 'benchmark',
+            'amount': '123.45',
+            'currency': 'JPY'
+        })
+        assert response.status_code == 201, response.status_code
+
+    # 8 signed-in clients adding 5 expenses each at the same time
+    burst_clients = []
+    for _ in range(8):
+        burst_client = accounting.app.test_client()
+        with burst_client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'benchmark'
+        burst_clients.append(burst_client)
+
+    def post_burst():
+        def post(burst_client):
+            for _ in range(5):
+                response = burst_client.post(f'/newExpense?trip_id={big_trip}', data={
+                    'purchase_date': some_date,
+                    'category': 'meals',
+                    'payment_method': 'cash',
+                    'item': 'benchmark burst',
+                    'amount': '12.34',
+                    'currency': 'JPY'
+                })
+                assert response.status_code == 302, response.status_code
+
+        threads = [threading.Thread(target=post, args=(b,)) for b in burst_clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def sql(query, params=()):
+        def run():
+            counter(query)
+            c.execute(query, params)
+            c.fetchall()
+        return run
+
+    return conn, {
+        'route:tripSelection': get('/tripSelection'),
+        'route:viewExpense': get(f'/viewExpense?trip_id={big_trip}'),
+        'route:viewExpense_filtered': get(
+            f'/viewExpense?trip_id={big_trip}&purchase_date={some_date}&category_name=meals&payment_method=cash'
+        ),
+        'route:viewExpense_304': get_unchanged(f'/viewExpense?trip_id={big_trip}'),
+        'route:newExpense': get(f'/newExpense?trip_id={big_trip}'),
+        'route:newExpense_post': post_expense,
+        'route:newExpense_post_burst': post_burst,
+        'route:api_expense_post': post_expense_api,
+        'route:api_expenses': get(f'/api/trips/{big_trip}/expenses'),
+        'route:api_summary': get(f'/api/trips/{big_trip}/summary'),
+        'route:api_stats': get(f'/api/trips/{big_trip}/stats'),
+        'route:compareTrips': get('/trips/compare'),
+        'route:budgets': get('/budgets'),
+        'route:search': get('/search?q=tax'),
+        'route:search_trip': get(f'/search?q=coffee&trip_id={big_trip}'),
+        'sql:trip_list': sql('''
+            SELECT t.id, t.trip_name, COALESCE(tt.total_in_base, 0)
+            FROM trips t LEFT JOIN trip_totals tt ON tt.trip_id = t.id
+        '''),
+        'sql:trip_sum': sql('SELECT SUM(base_amount) FROM expenses WHERE trip_id = ?', (big_trip,)),
+        'sql:trip_expenses': sql('''
+            SELECT e.id, e.purchase_date, e.item, e.amount
+            FROM expenses e WHERE e.trip_id = ? ORDER BY e.purchase_date
+        ''', (big_trip,))
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"\n{'scenario':32} {'baseline p50':>14} {'current p50':>14} {'change':>9}  queries")
+    for name, current in results.items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            print(f'{name:32} {"-":>14} {current["p50_ms"]:>12.3f}ms {"new":>9}')
+            continue
+
+        change = (current['p50_ms'] - before['p50_ms']) / before['p50_ms'] if before['p50_ms'] else 0
+        flag = ''
+        if change > tolerance or current['queries'] > before['queries']:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print(
+            f'{name:32} {before["p50_ms"]:>12.3f}ms {current["p50_ms"]:>12.3f}ms {change:>+8.1%}'
+            f'  {before["queries"]} -> {current["queries"]}{flag}'
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the accounting app.')
+    parser.add_argument('--trips', type=int, default=20)
+    parser.add_argument('--expenses', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--db', help='Reuse this database instead of generating a temporary one.')
+    parser.add_argument('--out', help='Write results as JSON (e.g. a new baseline).')
+    parser.add_argument('--compare', help='Baseline JSON to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed p50 slowdown (0.2 = 20%%).')
+    parser.add_argument('--only', help='Run only scenarios whose name contains this text.')
+    parser.add_argument('--write-queue', action='store_true', help='Send expense writes through the group-commit write queue.')
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory(prefix='accounting_bench_')
+    db_path = args.db or os.path.join(workdir.name, 'bench.db')
+    if not args.db:
+        print(f'Generating {args.trips} trips / {args.expenses} expenses (seed {args.seed})...')
+        generate(db_path, args.trips, args.expenses, args.seed)
+
+    import app as accounting
+
+    # The app as deployed (ACCOUNTING_* settings apply), pointed at the benchmark database
+    accounting.create_app({'DATABASE': db_path, 'TESTING': True, 'WRITE_QUEUE': args.write_queue})
+
+    # Count every statement sent through the app's connections
+    counter = QueryCounter()
+    counter.install(accounting)
+
+    client = accounting.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['username'] = 'benchmark'
+
+    conn, cases = scenarios(accounting, client, db_path, counter)
+
+    results = {}
+    for name, fn in cases.items():
+        if args.only and args.only not in name:
+            continue
+        results[name] = measure(fn, args.repeat, args.warmup, counter)
+        r = results[name]
+        print(f"{name:32} p50 {r['p50_ms']:9.3f}ms  p99 {r['p99_ms']:9.3f}ms  "
+              f"queries {r['queries']:3}  peak {r['peak_kib']:9.1f} KiB")
+    conn.close()
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'trips': args.trips,
+            'expenses': args.expenses,
+            'seed': args.seed,
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nWrote {args.out}')
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            status = 1
+
+    workdir.cleanup()
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
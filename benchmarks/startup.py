@@ -0,0 +1,75 @@
+# Start-up benchmark: launches fresh interpreters that import the app and serve their
+# first request, and reports process start, import of wsgi (create_app) and first-response times.
+# The first run fills the Jinja bytecode cache; later runs show a warm restart.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.datagen import generate
+
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import wsgi
+imported = time.perf_counter()
+response = wsgi.app.test_client().get('/login')
+assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'first_response_ms': (done - imported) * 1000}))
+'''
+
+
+def run_once(env, workdir):
+    started = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, '-c', PROBE], env=env, cwd=workdir,
+        capture_output=True, text=True, check=True
+    ).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    result['total_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold start to first response.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--trips', type=int, default=20)
+    parser.add_argument('--expenses', type=int, default=10000)
+    parser.add_argument('--no-bytecode-cache', action='store_true', help='Compile templates from source every run.')
+    parser.add_argument('--out', help='Write results as JSON.')
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory(prefix='accounting_startup_')
+    db_path = os.path.join(workdir.name, 'bench.db')
+    generate(db_path, args.trips, args.expenses)
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get('PYTHONPATH')]))
+    env['EXPENSES_DB'] = db_path
+    env['ACCOUNTING_JINJA_CACHE_DIR'] = 'null' if args.no_bytecode_cache else json.dumps(os.path.join(workdir.name, 'jinja'))
+
+    runs = [run_once(env, workdir.name) for _ in range(args.runs)]
+
+    report = {'first': runs[0]}
+    if len(runs) > 1:
+        report['warm_p50'] = {key: statistics.median(r[key] for r in runs[1:]) for key in runs[0]}
+
+    for name, r in report.items():
+        print(f"{name:10} process {r['total_ms']:8.1f}ms  import {r['import_ms']:8.1f}ms  "
+              f"first response {r['first_response_ms']:7.1f}ms")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nWrote {args.out}')
+
+    workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
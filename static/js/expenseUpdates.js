@@ -0,0 +1,167 @@
+// Adds, edits and deletes expenses through the JSON API and patches the expense list in place
+// instead of reloading the page. Uses capitalize / expenseRow / expenseGroup from loadMore.js.
+// Without JavaScript (or if a request fails to reach the server) the forms post as before.
+
+function updateTripTotal(trip) {
+    const total = document.querySelector('.trip-total');
+    if (total) total.textContent = `Total: ${Number(trip.total_in_base).toFixed(2)} TWD`;
+}
+
+// New expenses go on top of their day; days are newest first on the Add Expense page
+function insertExpense(container, e) {
+    const list = expenseGroup(container, e.purchase_date, e.purchase_date);
+    const card = list.closest('.category-card');
+
+    const older = Array.from(container.children).find(el => el !== card && el.dataset.group < e.purchase_date);
+    container.insertBefore(card, older || null);
+
+    list.prepend(expenseRow(e, container.dataset.next));
+}
+
+function removeExpense(container, expenseId) {
+    const row = container.querySelector(`.expense-row[data-id="${expenseId}"]`);
+    if (!row) return;
+
+    const card = row.closest('.category-card');
+    row.remove();
+    if (!card.querySelector('.expense-row')) card.remove();
+}
+
+// An edited expense goes where the page's grouping puts it, or nowhere if it no longer
+// matches the View All Expenses filters in the query string
+function placeExpense(container, e) {
+    const filters = new URLSearchParams(window.location.search);
+    if ((filters.get('purchase_date') && filters.get('purchase_date') !== e.purchase_date) ||
+        (filters.get('category_name') && filters.get('category_name') !== e.category) ||
+        (filters.get('payment_method') && filters.get('payment_method') !== e.payment_method)) return;
+
+    if (container.dataset.groupBy === 'date') {
+        insertExpense(container, e);
+        return;
+    }
+
+    const list = expenseGroup(container, e.category, capitalize(e.category));
+    const later = Array.from(list.children).find(li => li.dataset.date > e.purchase_date);
+    list.insertBefore(expenseRow(e, container.dataset.next), later || null);
+}
+
+// Swaps a row's text for the edit form (from #expenseEditTemplate) filled with its values
+function editExpense(container, row) {
+    if (row.querySelector('.expense-edit-form')) return;
+
+    const form = document.getElementById('expenseEditTemplate').content.firstElementChild.cloneNode(true);
+    form.elements.purchase_date.value = row.dataset.date;
+    form.elements.category.value = row.dataset.category;
+    form.elements.payment_method.value = row.dataset.method;
+    form.elements.item.value = row.dataset.item;
+    form.elements.amount.value = row.dataset.amount;
+    form.elements.currency.value = row.dataset.currency;
+
+    const shown = Array.from(row.children);
+    shown.forEach(el => el.hidden = true);
+    row.appendChild(form);
+
+    form.querySelector('.btn-cancel-edit').addEventListener('click', () => {
+        form.remove();
+        shown.forEach(el => el.hidden = false);
+    });
+
+    form.addEventListener('submit', async event => {
+        event.preventDefault();
+        const button = form.querySelector('button[type="submit"]');
+        button.disabled = true;
+
+        try {
+            // The query string carries viewExpense's filters, so the total matches the page
+            const change = await sendExpense(
+                `/api/expenses/${row.dataset.id}${window.location.search}`, {method: 'PATCH', body: new FormData(form)}
+            );
+            removeExpense(container, row.dataset.id);
+            placeExpense(container, change.expense);
+            updateTripTotal(change.trip);
+            if (change.budget && change.budget.warning) {
+                openModal({type: 'error', text: `Expense updated, but: ${change.budget.message}`});
+            }
+        } catch (err) {
+            openModal({type: 'error', text: err.message});
+            button.disabled = false;
+        }
+    });
+
+    form.elements.item.focus();
+}
+
+async function sendExpense(url, options) {
+    const response = await fetch(url, {...options, headers: {'Accept': 'application/json'}});
+    const body = await response.json().catch(() => ({}));
+    if (!response.ok) throw new Error(body.error || 'Oh no! Something went wrong!');
+    return body;
+}
+
+document.addEventListener('DOMContentLoaded', function () {
+    const form = document.getElementById('expenseForm');
+    const modalForm = document.getElementById('modalForm');
+
+    // Add Expense
+    if (form && form.dataset.apiUrl) {
+        form.addEventListener('submit', async event => {
+            const container = document.getElementById('expenseGroups');
+            // The first expense of a trip also needs the list itself: let the page reload
+            if (!container) return;
+
+            event.preventDefault();
+            const button = form.querySelector('button[type="submit"]');
+            button.disabled = true;
+
+            try {
+                const change = await sendExpense(form.dataset.apiUrl, {method: 'POST', body: new FormData(form)});
+                insertExpense(container, change.expense);
+                updateTripTotal(change.trip);
+                if (change.budget && change.budget.warning) {
+                    openModal({type: 'error', text: `Expense added, but: ${change.budget.message}`});
+                }
+
+                // Keep date, category, method and currency for the next entry
+                form.elements.item.value = '';
+                form.elements.amount.value = '';
+                form.elements.item.focus();
+            } catch (err) {
+                openModal({type: 'error', text: err.message});
+            } finally {
+                button.disabled = false;
+            }
+        });
+    }
+
+    // Edit Expense in the row itself; without the edit form the link opens the edit page
+    const list = document.getElementById('expenseGroups');
+    if (list && document.getElementById('expenseEditTemplate')) {
+        list.addEventListener('click', event => {
+            const link = event.target.closest('.expense-buttons a');
+            if (!link) return;
+
+            event.preventDefault();
+            editExpense(list, link.closest('.expense-row'));
+        });
+    }
+
+    // Delete Expense (confirmed in the modal)
+    if (modalForm) {
+        modalForm.addEventListener('submit', async event => {
+            const expenseId = modalForm.dataset.expenseId;
+            const container = document.getElementById('expenseGroups');
+            if (!expenseId || !container) return;
+
+            event.preventDefault();
+            try {
+                // The query string carries viewExpense's filters, so the total matches the page
+                const change = await sendExpense(`/api/expenses/${expenseId}${window.location.search}`, {method: 'DELETE'});
+                removeExpense(container, expenseId);
+                updateTripTotal(change.trip);
+                closeModal();
+            } catch (err) {
+                openModal({type: 'error', text: err.message});
+            }
+        });
+    }
+});
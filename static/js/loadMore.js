@@ -0,0 +1,99 @@
+// "Load More" for long expense lists: fetches the next page from the JSON API
+// and appends the rows to the matching date / category card.
+
+function capitalize(text) {
+    text = String(text);
+    return text.charAt(0).toUpperCase() + text.slice(1).toLowerCase();
+}
+
+function expenseRow(e, nextUrl) {
+    const li = document.createElement('li');
+    li.className = 'expense-row';
+    li.dataset.id = e.id;
+    li.dataset.date = e.purchase_date;
+    li.dataset.category = e.category;
+    li.dataset.method = e.payment_method;
+    li.dataset.item = e.item;
+    li.dataset.amount = e.amount;
+    li.dataset.currency = e.code;
+
+    const text = document.createElement('span');
+    text.className = 'expense-text';
+    text.textContent = `${capitalize(e.item)} : ${e.code} ${e.symbol}${Number(e.amount).toFixed(2)}`;
+
+    const buttons = document.createElement('div');
+    buttons.className = 'expense-buttons';
+
+    const edit = document.createElement('a');
+    edit.className = 'btn btn-submit btn-small';
+    edit.href = `${e.edit_url}?next=${encodeURIComponent(nextUrl)}`;
+    edit.textContent = 'Edit';
+
+    const del = document.createElement('button');
+    del.type = 'button';
+    del.className = 'btn btn-delete-expense btn-small';
+    del.dataset.id = e.id;
+    del.dataset.item = e.item;
+    del.textContent = 'Delete';
+
+    buttons.append(edit, del);
+    li.append(text, buttons);
+    return li;
+}
+
+function expenseGroup(container, key, title) {
+    let card = Array.from(container.children).find(el => el.dataset.group === key);
+    if (!card) {
+        card = document.createElement('div');
+        card.className = 'category-card';
+        card.dataset.group = key;
+
+        const heading = document.createElement('h3');
+        heading.className = 'category-title';
+        heading.textContent = title;
+
+        const list = document.createElement('ul');
+        list.className = 'expense-list';
+
+        card.append(heading, list);
+        container.appendChild(card);
+    }
+    return card.querySelector('.expense-list');
+}
+
+document.addEventListener('DOMContentLoaded', function () {
+    const btn = document.getElementById('loadMoreBtn');
+    const container = document.getElementById('expenseGroups');
+    if (!btn || !container) return;
+
+    const groupBy = container.dataset.groupBy;
+
+    btn.addEventListener('click', async () => {
+        btn.disabled = true;
+
+        const url = new URL(btn.dataset.url, window.location.origin);
+        url.searchParams.set('cursor', btn.dataset.cursor);
+
+        try {
+            const response = await fetch(url, {headers: {'Accept': 'application/json'}});
+            if (!response.ok) throw new Error(response.statusText);
+            const page = await response.json();
+
+            page.expenses.forEach(e => {
+                const key = groupBy === 'date' ? e.purchase_date : e.category;
+                const title = groupBy === 'date' ? e.purchase_date : capitalize(e.category);
+                expenseGroup(container, key, title).appendChild(expenseRow(e, btn.dataset.next));
+            });
+
+            if (page.next_cursor) {
+                btn.dataset.cursor = page.next_cursor;
+                btn.disabled = false;
+            } else {
+                btn.remove();
+            }
+        } catch (err) {
+            btn.disabled = false;
+            openModal({type: 'error', text: 'Could not load more expenses.'});
+        }
+    });
+});
@@ -11,6 +11,7 @@ function openModal({type, text, formAction=null}) {
         modalForm.style.display = 'block';
         modalOkBtn.style.display = 'none';
         modalForm.action = formAction;
+        delete modalForm.dataset.expenseId;
         modalConfirmBtn.textContent = 'Yes, Delete';
     } else if(type === 'error' || type === 'success') {
         modalForm.style.display = 'none';
@@ -39,17 +40,19 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     });
 
-    // Expense delete buttons
-    document.querySelectorAll('.btn-delete-expense').forEach(btn => {
-        btn.addEventListener('click', () => {
-            const expenseId = btn.dataset.id;
-            const itemName = btn.dataset.item;
-            openModal({
-                type: 'delete',
-                text: `Are you sure you want to delete expense "${itemName}"?`,
-                formAction: `/deleteExpense/${expenseId}`
-            });
+    // Expense delete buttons (delegated so rows added later are covered too)
+    document.addEventListener('click', event => {
+        const btn = event.target.closest('.btn-delete-expense');
+        if (!btn) return;
+
+        const expenseId = btn.dataset.id;
+        const itemName = btn.dataset.item;
+        openModal({
+            type: 'delete',
+            text: `Are you sure you want to delete expense "${itemName}"?`,
+            formAction: `/deleteExpense/${expenseId}`
         });
+        // Lets expenseUpdates.js delete it in place
+        document.getElementById('modalForm').dataset.expenseId = expenseId;
     });
 });
-
@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Every create_app() call in the tests reads these: a throwaway database by default, and
+# no template cache or built assets in the checkout
+os.environ['EXPENSES_DB'] = os.path.join(tempfile.mkdtemp(prefix='accounting_tests_'), 'expenses.db')
+os.environ['ACCOUNTING_JINJA_CACHE_DIR'] = 'null'
+os.environ['ACCOUNTING_ASSET_DIR'] = 'null'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as accounting
+
+# create_app() configures the one module-level app; each test starts from the defaults
+DEFAULT_CONFIG = dict(accounting.app.config)
+
+
+# make_app(**config) -> the app on a fresh database in tmp_path
+@pytest.fixture
+def make_app(tmp_path):
+    def make(**config):
+        accounting.app.config.update(DEFAULT_CONFIG)
+        return accounting.create_app(dict({'DATABASE': str(tmp_path / 'expenses.db'), 'TESTING': True}, **config))
+    return make
+
+
+# A test client signed in as user 1
+@pytest.fixture
+def client(make_app):
+    client = make_app().test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['username'] = 'tests'
+    return client
+
+
+# query(sql, *params) -> rows, run and committed on a connection of its own
+@pytest.fixture
+def query(client):
+    def run(sql, *params):
+        conn = accounting.connect_db(accounting.DB_FILE)
+        try:
+            rows = conn.execute(sql, params).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+    return run
+
+
+# new_trip(name) -> trip id, created through the trip form (its flash message is shown)
+@pytest.fixture
+def new_trip(client, query):
+    def make(name, start_date='2025-01-01', end_date='2025-01-05'):
+        response = client.post('/tripSelection', data={
+            'trip_name': name, 'country_id': '2', 'start_date': start_date, 'end_date': end_date
+        }, follow_redirects=True)
+        assert response.status_code == 200
+        return query('SELECT id FROM trips WHERE trip_name = ?', name)[0][0]
+    return make
+
+
+# expense_form(**overrides) -> Add Expense form fields
+@pytest.fixture
+def expense_form():
+    def fields(**overrides):
+        return dict({
+            'purchase_date': '2025-01-02',
+            'category': 'meals',
+            'payment_method': 'cash',
+            'item': 'ramen',
+            'amount': '500',
+            'currency': 'JPY'
+        }, **overrides)
+    return fields
+
+
+# add_expense(trip_id, **overrides) -> expense id, through the JSON API
+@pytest.fixture
+def add_expense(client, expense_form):
+    def add(trip_id, **fields):
+        response = client.post(f'/api/trips/{trip_id}/expenses', data=expense_form(**fields))
+        assert response.status_code == 201, response.get_json()
+        return response.get_json()['expense']['id']
+    return add
@@ -0,0 +1,25 @@
+# Hashed static assets: served precompressed, and each build leaves only its own files.
+import app as accounting
+
+
+def test_build_serves_hashed_files_and_prunes_old_builds(make_app, tmp_path):
+    assets = tmp_path / 'assets'
+    stale = assets / 'js' / 'expenseUpdates.000000000000.js'
+    stale.parent.mkdir(parents=True)
+    stale.write_text('old build')
+    (assets / 'style.000000000000.css.gz').write_bytes(b'old build')
+
+    app = make_app(ASSET_DIR=str(assets))
+    assert not stale.exists()
+    assert not (assets / 'style.000000000000.css.gz').exists()
+
+    with app.test_request_context():
+        url = accounting.url_for('static', filename='style.css')
+    hashed = accounting.asset_manifest.files['style.css']
+    assert url == f'/static/{hashed}'
+    assert (assets / hashed).exists()
+
+    response = app.test_client().get(url, headers={'Accept-Encoding': 'br, gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == ('br' if accounting.brotli else 'gzip')
+    assert 'immutable' in response.headers['Cache-Control']
@@ -0,0 +1,47 @@
+# /downloadBackup streams a compressed copy of the user's whole database out of a
+# temporary directory, which must be gone however the download ends.
+import gzip
+import hashlib
+import sqlite3
+import tempfile
+
+import pytest
+
+
+@pytest.fixture
+def temp_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'tmp'
+    path.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(path))
+    return path
+
+
+def test_download_is_a_readable_snapshot(client, new_trip, temp_dir, tmp_path):
+    new_trip('osaka')
+
+    response = client.get('/downloadBackup')
+    assert response.status_code == 200
+    assert response.headers['X-Backup-SHA256'] == hashlib.sha256(response.data).hexdigest()
+
+    snapshot = tmp_path / 'snapshot.db'
+    snapshot.write_bytes(gzip.decompress(response.data))
+    response.close()
+    conn = sqlite3.connect(snapshot)
+    try:
+        assert conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        assert conn.execute('SELECT trip_name FROM trips').fetchall() == [('osaka',)]
+    finally:
+        conn.close()
+    assert not list(temp_dir.iterdir())
+
+
+@pytest.mark.parametrize('method', ['HEAD', 'GET'])
+def test_unread_download_leaves_no_copy(client, temp_dir, method):
+    # Not buffered: the body is never read, only closed, as a server does for a HEAD
+    # or a client that disconnects before the first chunk
+    response = client.open('/downloadBackup', method=method, buffered=False)
+    assert response.status_code == 200
+    assert len(list(temp_dir.iterdir())) == 1
+
+    response.close()
+    assert not list(temp_dir.iterdir())
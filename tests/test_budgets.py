@@ -0,0 +1,78 @@
+# Budgets keep a running spent total (triggers on expenses) and warn from
+# BUDGET_WARN_RATIO of their amount on.
+import pytest
+
+
+def set_budget(client, trip_id, amount, category=''):
+    response = client.post(f'/budgets/{trip_id}', data={'category': category, 'amount': amount})
+    assert response.status_code == 302
+
+
+@pytest.fixture
+def assert_spent(query):
+    def check():
+        budgets = query('''
+            SELECT b.trip_id, b.category_id, b.spent,
+                   (SELECT COALESCE(SUM(e.base_amount), 0) FROM expenses e
+                    WHERE e.trip_id = b.trip_id AND (b.category_id IS NULL OR e.category_id = b.category_id))
+            FROM budgets b
+        ''')
+        assert budgets
+        for trip_id, category_id, spent, total in budgets:
+            assert spent == pytest.approx(total), (trip_id, category_id)
+    return check
+
+
+def test_spent_follows_every_write(client, new_trip, add_expense, expense_form, query, assert_spent):
+    osaka, seoul = new_trip('osaka'), new_trip('seoul')
+    add_expense(osaka, item='museum', category='activities')
+    for trip_id in (osaka, seoul):
+        set_budget(client, trip_id, '100000')
+        set_budget(client, trip_id, '50000', 'meals')
+    # A budget set after spending starts from what was already spent
+    assert_spent()
+
+    ramen = add_expense(osaka)
+    taxi = add_expense(seoul, item='taxi', category='transportation', currency='KRW', amount='15000')
+    assert_spent()
+
+    # Into and out of the meals budgets
+    assert client.patch(f'/api/expenses/{ramen}', data=expense_form(category='others', amount='900')).status_code == 200
+    assert client.patch(f'/api/expenses/{taxi}', data=expense_form(currency='KRW', amount='9000')).status_code == 200
+    assert_spent()
+
+    query('UPDATE expenses SET trip_id = ? WHERE id = ?', seoul, ramen)
+    assert_spent()
+
+    assert client.delete(f'/api/expenses/{taxi}').status_code == 200
+    assert_spent()
+
+
+def test_warns_near_and_over_the_budget(client, new_trip, expense_form):
+    trip = new_trip('osaka')
+    set_budget(client, trip, '1000')
+
+    def add(amount):
+        response = client.post(f'/api/trips/{trip}/expenses', data=expense_form(amount=amount, currency='NTD'))
+        assert response.status_code == 201
+        return response.get_json()['budget']
+
+    budget = add('700')
+    assert not budget['warning'] and budget['remaining'] == 300
+
+    budget = add('150')
+    assert budget['warning']
+    assert budget['message'] == 'Only 150.00 TWD left in the trip budget.'
+
+    budget = add('200')
+    assert budget['budgets'][0]['exceeded']
+    assert budget['message'] == 'Over the trip budget by 50.00 TWD!'
+
+
+def test_empty_amount_removes_the_budget(client, new_trip, query):
+    trip = new_trip('osaka')
+    set_budget(client, trip, '1000', 'meals')
+    assert query('SELECT amount FROM budgets WHERE trip_id = ?', trip) == [(1000,)]
+
+    set_budget(client, trip, '', 'meals')
+    assert query('SELECT amount FROM budgets WHERE trip_id = ?', trip) == []
@@ -0,0 +1,63 @@
+# Trip pages carry a weak ETag built from the data versions they show; a matching
+# If-None-Match gets 304 until that data changes.
+from datetime import datetime, timedelta, timezone
+
+from werkzeug.http import http_date
+
+
+def test_unchanged_page_is_not_modified(client, new_trip, add_expense):
+    trip = new_trip('osaka')
+    url = f'/viewExpense?trip_id={trip}'
+
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag.startswith('W/"')
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    assert response.last_modified is not None
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert not response.data
+
+    # Adding an expense changes the trip's version, and so the tag
+    add_expense(trip)
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_if_modified_since_alone_never_gives_304(client, new_trip):
+    trip = new_trip('osaka')
+    future = http_date(datetime.now(timezone.utc) + timedelta(days=1))
+
+    response = client.get(f'/viewExpense?trip_id={trip}', headers={'If-Modified-Since': future})
+    assert response.status_code == 200
+
+
+def test_compressed_page_has_the_same_tag(client, new_trip, add_expense):
+    trip = new_trip('osaka')
+    for n in range(30):
+        add_expense(trip, item=f'item {n}')
+    url = f'/viewExpense?trip_id={trip}'
+
+    plain = client.get(url)
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['ETag'] == plain.headers['ETag']
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': compressed.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_pending_flash_is_always_rendered(client, new_trip):
+    trip = new_trip('osaka')
+    url = f'/newExpense?trip_id={trip}'
+    etag = client.get(url).headers['ETag']
+
+    # A rejected budget changes no data, but its message is due on the next page
+    client.post(f'/budgets/{trip}', data={'category': 'nope', 'amount': '5'})
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Invalid category selected!' in response.data
@@ -0,0 +1,61 @@
+# CSV import inserts the valid rows in one transaction and keeps the stored totals
+# in step; bad files are reported as import errors, never as server errors.
+import io
+
+import pytest
+
+import app as accounting
+
+HEADER = 'purchase_date,category,payment_method,item,amount,currency\n'
+
+
+def upload(client, trip_id, data, **form):
+    return client.post(
+        f'/importExpenses/{trip_id}', data=dict(form, file=(io.BytesIO(data), 'expenses.csv')),
+        headers={'Accept': 'application/json'}
+    )
+
+
+def test_import_keeps_totals(client, new_trip, add_expense, query):
+    trip = new_trip('osaka')
+    add_expense(trip)
+    client.post(f'/budgets/{trip}', data={'category': '', 'amount': '100000'})
+
+    rows = HEADER + '2025-01-01,meals,cash,sushi,1800,JPY\n2025-01-02,others,card,souvenir,25,USD\n'
+    response = upload(client, trip, rows.encode())
+    assert response.status_code == 200
+    assert response.get_json()['imported'] == 2
+
+    total, count = query('SELECT SUM(base_amount), COUNT(*) FROM expenses WHERE trip_id = ?', trip)[0]
+    assert count == 3
+    assert query('SELECT total_in_base, expense_count FROM trip_totals WHERE trip_id = ?', trip) == [(pytest.approx(total), 3)]
+    assert query('SELECT SUM(base_total) FROM expense_rollups WHERE trip_id = ?', trip) == [(pytest.approx(total),)]
+    assert query('SELECT spent FROM budgets WHERE trip_id = ?', trip) == [(pytest.approx(total),)]
+    assert accounting.app.test_cli_runner().invoke(args=['trip-totals']).exit_code == 0
+
+
+def test_invalid_rows_block_the_import_unless_skipped(client, new_trip, query):
+    trip = new_trip('osaka')
+    rows = (HEADER + '2025-01-01,meals,cash,sushi,1800,JPY\n2025-01-02,meals,cash,coffee,abc,JPY\n').encode()
+
+    response = upload(client, trip, rows)
+    assert response.status_code == 422
+    assert [e['row'] for e in response.get_json()['errors']] == [3]
+    assert query('SELECT COUNT(*) FROM expenses') == [(0,)]
+
+    response = upload(client, trip, rows, skip_invalid='1')
+    assert response.get_json()['imported'] == 1
+    assert query('SELECT item FROM expenses') == [('sushi',)]
+
+
+@pytest.mark.parametrize('data, error', [
+    ((HEADER + '2025-01-01,meals,cash,café,5,EUR\n').encode('latin-1'), 'The file is not UTF-8 encoded!'),
+    ((HEADER + '2025-01-01,meals,cash,' + 'x' * 200000 + ',5,EUR\n').encode(), 'Invalid CSV: field larger than field limit'),
+    (b'', 'The file is empty!'),
+], ids=['latin-1', 'malformed', 'empty'])
+def test_unreadable_files_are_import_errors(client, new_trip, query, data, error):
+    trip = new_trip('osaka')
+    response = upload(client, trip, data)
+    assert response.status_code == 422
+    assert response.get_json()['errors'][0]['error'].startswith(error)
+    assert query('SELECT COUNT(*) FROM expenses') == [(0,)]
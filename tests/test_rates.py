@@ -0,0 +1,141 @@
+# A rate change re-prices the expenses from its effective date on, in committed
+# batches, and moves the differences into every stored total.
+import time
+
+import pytest
+
+import app as accounting
+
+
+def set_rate(*args):
+    result = accounting.app.test_cli_runner().invoke(args=['set-rate', *args])
+    assert result.exit_code == 0, result.output
+    return result
+
+
+@pytest.fixture
+def priced_trip(client, new_trip, add_expense):
+    trip = new_trip('osaka')
+    client.post(f'/budgets/{trip}', data={'category': '', 'amount': '100000'})
+    ids = {
+        'before': add_expense(trip, purchase_date='2025-01-01', amount='1000'),
+        'usd': add_expense(trip, purchase_date='2025-01-03', currency='USD', amount='8')
+    }
+    for n in range(5):
+        ids[f'after{n}'] = add_expense(trip, purchase_date='2025-01-03', amount=str(100 * (n + 1)))
+    return trip, ids
+
+
+@pytest.fixture
+def assert_priced(query):
+    def check(trip, ids, jpy_rate):
+        base = dict(query('SELECT id, base_amount FROM expenses'))
+        for n in range(5):
+            assert base[ids[f'after{n}']] == pytest.approx(100 * (n + 1) * jpy_rate)
+        assert query('SELECT COUNT(*) FROM base_recompute_jobs') == [(0,)]
+
+        total = query('SELECT SUM(base_amount) FROM expenses WHERE trip_id = ?', trip)[0][0]
+        assert query('SELECT total_in_base FROM trip_totals WHERE trip_id = ?', trip) == [(pytest.approx(total),)]
+        assert query('SELECT SUM(base_total) FROM expense_rollups WHERE trip_id = ?', trip) == [(pytest.approx(total),)]
+        assert query('SELECT spent FROM budgets WHERE trip_id = ?', trip) == [(pytest.approx(total),)]
+    return check
+
+
+def test_set_rate_reprices_from_its_date(client, priced_trip, add_expense, query, assert_priced):
+    trip, ids = priced_trip
+    unchanged = dict(query('SELECT id, base_amount FROM expenses WHERE id IN (?, ?)', ids['before'], ids['usd']))
+
+    # Several batches, each its own transaction
+    accounting.app.config['RECOMPUTE_BATCH_SIZE'] = 2
+    set_rate('JPY', '0.25', '--date', '2025-01-02')
+
+    assert_priced(trip, ids, 0.25)
+    assert dict(query('SELECT id, base_amount FROM expenses WHERE id IN (?, ?)', ids['before'], ids['usd'])) == unchanged
+
+    # Later writes are priced at the new rate too
+    new = add_expense(trip, purchase_date='2025-01-04', amount='400')
+    assert query('SELECT base_amount FROM expenses WHERE id = ?', new) == [(pytest.approx(100),)]
+    assert_priced(trip, ids, 0.25)
+
+
+def test_background_worker_drains_queued_jobs(client, priced_trip, query, assert_priced):
+    trip, ids = priced_trip
+    set_rate('JPY', '0.3', '--date', '2025-01-02', '--no-wait')
+
+    accounting.app.config['RECOMPUTE_POLL_SECONDS'] = 0.05
+    accounting.recompute_worker.ensure_started()
+    accounting.recompute_worker.wake.set()
+
+    deadline = time.monotonic() + 5
+    while query('SELECT COUNT(*) FROM base_recompute_jobs') != [(0,)] and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert_priced(trip, ids, 0.3)
+
+
+@pytest.fixture
+def sharded(make_app, tmp_path):
+    app = make_app(SHARD_DIR=str(tmp_path / 'shards'))
+
+    # sign_in(user_id) -> a client whose trips live in that user's own file
+    def sign_in(user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+        assert client.get('/tripSelection').status_code == 200
+        return client
+    return sign_in
+
+
+def rate_in(path, code):
+    conn = accounting.connect_db(path)
+    try:
+        return conn.execute('''
+            SELECT r.rate_to_base FROM exchange_rates r JOIN currencies c ON c.id = r.currency_id
+            WHERE c.code = ?
+        ''', (code,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_set_rate_reaches_every_shard(sharded, expense_form):
+    client = sharded(1)
+    client.post('/tripSelection', data={
+        'trip_name': 'osaka', 'country_id': '2', 'start_date': '2025-01-01', 'end_date': '2025-01-05'
+    })
+    assert client.post('/api/trips/1/expenses', data=expense_form(amount='1000')).status_code == 201
+
+    set_rate('JPY', '0.25', '--date', '2025-01-01')
+    shard = accounting.user_db_path(1)
+    assert rate_in(accounting.DB_FILE, 'JPY') == rate_in(shard, 'JPY') == 0.25
+    conn = accounting.connect_db(shard)
+    try:
+        assert conn.execute('SELECT base_amount FROM expenses').fetchall() == [(pytest.approx(250),)]
+        assert conn.execute('SELECT total_in_base FROM trip_totals').fetchall() == [(pytest.approx(250),)]
+    finally:
+        conn.close()
+
+    # A user's first request after the change creates their file with the current rates
+    sharded(2)
+    assert rate_in(accounting.user_db_path(2), 'JPY') == 0.25
+
+
+def test_set_rate_is_all_or_nothing(sharded):
+    sharded(1)
+    sharded(2)
+    before = rate_in(accounting.DB_FILE, 'GBP')
+
+    # User 2's file can't take the rate
+    conn = accounting.connect_db(accounting.user_db_path(2))
+    try:
+        gbp = conn.execute("SELECT id FROM currencies WHERE code = 'GBP'").fetchone()[0]
+        for table in ('exchange_rate_history', 'exchange_rates', 'base_recompute_jobs'):
+            conn.execute(f'DELETE FROM {table} WHERE currency_id = ?', (gbp,))
+        conn.execute('DELETE FROM currencies WHERE id = ?', (gbp,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    result = accounting.app.test_cli_runner().invoke(args=['set-rate', 'GBP', '99'])
+    assert result.exit_code != 0
+    assert 'Unknown currency "GBP"' in result.output
+    assert rate_in(accounting.DB_FILE, 'GBP') == rate_in(accounting.user_db_path(1), 'GBP') == before
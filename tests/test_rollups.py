@@ -0,0 +1,63 @@
+# expense_rollups is kept by triggers; it must always equal grouping the expenses
+# table, whichever write changed them.
+import pytest
+
+
+@pytest.fixture
+def assert_rollups(query):
+    def check():
+        expected = {r[:4]: (r[4], r[5]) for r in query('''
+            SELECT trip_id, COALESCE(purchase_date, ''), COALESCE(category_id, 0), COALESCE(method_id, 0),
+                   COUNT(*), COALESCE(SUM(base_amount), 0)
+            FROM expenses
+            GROUP BY 1, 2, 3, 4
+        ''')}
+        rollups = {r[:4]: (r[4], r[5]) for r in query('''
+            SELECT trip_id, purchase_date, category_id, method_id, expense_count, base_total
+            FROM expense_rollups
+        ''')}
+        assert rollups.keys() == expected.keys()
+        for key, (count, total) in expected.items():
+            assert rollups[key] == (count, pytest.approx(total))
+    return check
+
+
+def test_writes_keep_rollups_in_step(client, new_trip, add_expense, expense_form, assert_rollups):
+    osaka, seoul = new_trip('osaka'), new_trip('seoul')
+    ramen = add_expense(osaka)
+    add_expense(osaka, item='train', category='transportation', currency='USD', amount='12.5')
+    taxi = add_expense(seoul, item='taxi', payment_method='card', currency='KRW', amount='15000')
+    assert client.post(f'/newExpense?trip_id={seoul}', data=expense_form(currency='KRW', amount='9000')).status_code == 302
+    assert_rollups()
+
+    # Every grouping column changes, and one group empties
+    response = client.patch(f'/api/expenses/{ramen}', data=expense_form(
+        category='activities', payment_method='card', currency='USD', amount='30', purchase_date='2025-01-04'
+    ))
+    assert response.status_code == 200
+    assert client.patch(f'/api/expenses/{taxi}', data=expense_form(amount='20000', currency='KRW')).status_code == 200
+    assert_rollups()
+
+    assert client.delete(f'/api/expenses/{ramen}').status_code == 200
+    assert_rollups()
+
+
+def test_moving_an_expense_between_trips(new_trip, add_expense, query, assert_rollups):
+    # The app never changes an expense's trip; the triggers must still follow a move
+    osaka, seoul = new_trip('osaka'), new_trip('seoul')
+    moved = add_expense(osaka)
+    add_expense(seoul, item='taxi', category='transportation')
+
+    query('UPDATE expenses SET trip_id = ?, category_id = 2 WHERE id = ?', seoul, moved)
+    assert_rollups()
+
+
+def test_summary_comes_from_the_rollups(client, new_trip, add_expense, query):
+    trip = new_trip('osaka')
+    add_expense(trip, purchase_date='2025-01-01')
+    add_expense(trip, purchase_date='2025-01-03', amount='1200', category='activities')
+    add_expense(trip, purchase_date='2025-01-03', currency='USD', amount='8')
+
+    summary = client.get(f'/api/trips/{trip}/summary').get_json()
+    total = query('SELECT SUM(base_amount) FROM expenses WHERE trip_id = ?', trip)[0][0]
+    assert summary['total'] == pytest.approx(total, abs=0.01)
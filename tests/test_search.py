@@ -0,0 +1,20 @@
+# Item search ranks every match, so an old exact match beats newer, weaker ones.
+import app as accounting
+
+
+def test_best_match_wins_regardless_of_age(client, new_trip):
+    trip = new_trip('osaka')
+
+    conn = accounting.connect_db(accounting.DB_FILE)
+    try:
+        c = conn.cursor()
+        expense = {'category_id': 1, 'method_id': 1, 'amount': 10, 'currency_id': 1}
+        old = accounting.insert_expense(c, trip, dict(expense, item='taxi', purchase_date='2025-01-01'))
+        for _ in range(300):
+            accounting.insert_expense(c, trip, dict(expense, item='taxi to the airport with luggage', purchase_date='2025-01-05'))
+        conn.commit()
+    finally:
+        conn.close()
+
+    results = client.get('/search?q=taxi&limit=1').get_json()
+    assert [r['id'] for r in results['results']] == [old]
@@ -0,0 +1,56 @@
+# trip_totals is kept in Python by every expense write; `flask trip-totals` compares it
+# with a fresh sum of expenses.base_amount.
+import pytest
+
+import app as accounting
+
+
+def trip_totals_command(*args):
+    return accounting.app.test_cli_runner().invoke(args=['trip-totals', *args])
+
+
+@pytest.fixture
+def assert_totals(query):
+    def check():
+        result = trip_totals_command()
+        assert result.exit_code == 0, result.output
+
+        stored = {r[0]: (r[1], r[2]) for r in query('SELECT trip_id, total_in_base, expense_count FROM trip_totals')}
+        for trip_id, total, count in query('''
+            SELECT t.id, COALESCE(SUM(e.base_amount), 0), COUNT(e.id)
+            FROM trips t LEFT JOIN expenses e ON e.trip_id = t.id
+            GROUP BY t.id
+        '''):
+            assert stored.get(trip_id, (0, 0)) == (pytest.approx(total), count)
+    return check
+
+
+def test_form_and_api_writes_keep_totals(client, new_trip, add_expense, expense_form, assert_totals):
+    osaka, seoul = new_trip('osaka'), new_trip('seoul')
+    ramen = add_expense(osaka)
+    add_expense(osaka, item='train', currency='USD', amount='12.5')
+    taxi = add_expense(seoul, item='taxi', currency='KRW', amount='15000')
+    assert client.post(f'/newExpense?trip_id={seoul}', data=expense_form(currency='KRW', amount='9000')).status_code == 302
+    assert_totals()
+
+    assert client.patch(f'/api/expenses/{ramen}', data=expense_form(currency='USD', amount='30')).status_code == 200
+    response = client.post(f'/editExpense/{seoul}/{taxi}', data=expense_form(currency='KRW', amount='20000'))
+    assert response.status_code == 302
+    assert_totals()
+
+    assert client.delete(f'/api/expenses/{ramen}').status_code == 200
+    assert client.post(f'/deleteExpense/{taxi}').status_code == 302
+    assert_totals()
+
+
+def test_command_reports_and_rebuilds_drift(new_trip, add_expense, query, assert_totals):
+    trip = new_trip('osaka')
+    add_expense(trip)
+    query('UPDATE trip_totals SET total_in_base = total_in_base + 1 WHERE trip_id = ?', trip)
+
+    result = trip_totals_command()
+    assert result.exit_code == 1
+    assert f'trip {trip}:' in result.output
+
+    assert trip_totals_command('--rebuild').exit_code == 0
+    assert_totals()
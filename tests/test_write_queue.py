@@ -0,0 +1,123 @@
+# With WRITE_QUEUE on, expense writes are committed in groups by one writer thread;
+# each write still succeeds or fails on its own and the totals stay in step.
+import threading
+
+import pytest
+
+import app as accounting
+
+
+@pytest.fixture
+def client(make_app):
+    client = make_app(WRITE_QUEUE=True, WRITE_GROUP_WINDOW_MS=50).test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+    return client
+
+
+def test_concurrent_writes_are_grouped_and_keep_totals(client, new_trip, expense_form, query):
+    trip = new_trip('osaka')
+    groups = accounting.write_queue.groups
+
+    def post(n):
+        response = client.post(f'/api/trips/{trip}/expenses', data=expense_form(amount=str(100 + n)))
+        assert response.status_code == 201
+        created.append(response.get_json()['expense']['id'])
+
+    created = []
+    threads = [threading.Thread(target=post, args=(n,)) for n in range(12)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(created) == 12
+    assert accounting.write_queue.groups - groups < 12
+    total = query('SELECT SUM(base_amount) FROM expenses')[0][0]
+    assert query('SELECT total_in_base, expense_count FROM trip_totals') == [(pytest.approx(total), 12)]
+    assert query('SELECT SUM(base_total) FROM expense_rollups') == [(pytest.approx(total),)]
+
+
+def test_a_failing_write_only_rolls_back_itself(client):
+    def add_trip(c, name, fail=False):
+        c.execute('INSERT INTO trips (trip_name) VALUES (?)', (name,))
+        if fail:
+            raise ValueError(name)
+        return name
+
+    path = accounting.DB_FILE
+    futures = [
+        accounting.write_queue.submit(path, add_trip, 'kept'),
+        accounting.write_queue.submit(path, add_trip, 'failed', True),
+        accounting.write_queue.submit(path, add_trip, 'also kept')
+    ]
+    assert futures[0].result(5) == 'kept'
+    with pytest.raises(ValueError):
+        futures[1].result(5)
+    assert futures[2].result(5) == 'also kept'
+
+    conn = accounting.connect_db(path)
+    try:
+        assert conn.execute('SELECT trip_name FROM trips ORDER BY id').fetchall() == [('kept',), ('also kept',)]
+        # The writer's synchronous=FULL doesn't leak into the pooled connection
+        pooled = accounting.db_pool.acquire(path)
+        assert pooled.execute('PRAGMA synchronous').fetchone()[0] == 1
+        accounting.db_pool.release(pooled)
+    finally:
+        conn.close()
+
+
+def block_writer(release):
+    blocker = accounting.write_queue.submit(accounting.DB_FILE, lambda c: release.wait(5))
+    # Running once its group is formed, so later writes wait in the queue
+    while not blocker.running():
+        threading.Event().wait(0.01)
+    return blocker
+
+
+def test_a_write_that_times_out_in_the_queue_is_dropped(client, new_trip, expense_form, query):
+    trip = new_trip('osaka')
+    accounting.app.config['WRITE_TIMEOUT'] = 0.2
+
+    release = threading.Event()
+    blocker = block_writer(release)
+    try:
+        response = client.post(f'/api/trips/{trip}/expenses', data=expense_form())
+        assert response.status_code == 503
+        assert b'was not saved' in response.data
+    finally:
+        release.set()
+    blocker.result(5)
+
+    assert query('SELECT COUNT(*) FROM expenses') == [(0,)]
+    assert query('SELECT COUNT(*) FROM trip_totals WHERE expense_count > 0') == [(0,)]
+
+
+def test_a_started_write_that_times_out_may_still_commit(client, new_trip, expense_form, query):
+    trip = new_trip('osaka')
+    accounting.app.config['WRITE_TIMEOUT'] = 0.5
+
+    # Queue a second blocked write and then the request's write behind the first one, so
+    # both start together as the next group
+    first, second = threading.Event(), threading.Event()
+    blockers = [block_writer(first), accounting.write_queue.submit(accounting.DB_FILE, lambda c: second.wait(5))]
+    responses = []
+    request = threading.Thread(target=lambda: responses.append(
+        client.post(f'/api/trips/{trip}/expenses', data=expense_form())
+    ))
+    request.start()
+    try:
+        while accounting.write_queue.queue.qsize() < 2:
+            threading.Event().wait(0.01)
+        first.set()
+        request.join()
+        assert responses[0].status_code == 503
+        assert b'may still be saved' in responses[0].data
+    finally:
+        first.set()
+        second.set()
+    for blocker in blockers:
+        blocker.result(5)
+
+    total = query('SELECT SUM(base_amount) FROM expenses')[0][0]
+    assert query('SELECT total_in_base, expense_count FROM trip_totals WHERE trip_id = ?', trip) == [(pytest.approx(total), 1)]
@@ -0,0 +1,4 @@
+# Entry point: gunicorn --preload wsgi:app, flask --app wsgi <command>
+from app import create_app
+
+app = create_app()